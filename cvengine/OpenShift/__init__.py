@@ -1,23 +1,33 @@
 import os
-from distutils.spawn import find_executable
 import urllib
 import logging as log
 
+from cvengine.util.toolchain import get_toolchain
+
 
 OC_DOWNLOAD = ('https://github.com/openshift/origin/releases/download/v1.4.1/'
                'openshift-origin-client-tools-v1.4.1-3f9807a-linux-64bit'
                '.tar.gz')
 OC_PATH = '/tmp/oc/oc'
 
+_oc_path = None
+
 
 def get_install_oc():
     """
     Finds or installs OC, the OpenShift Origin CLI client
+
+    The location is looked up in the cached toolchain record and remembered
+    for the rest of the process.
     """
+    global _oc_path
+    if _oc_path:
+        return _oc_path
+
     if os.path.isfile(OC_PATH):
         oc_path = OC_PATH
     else:
-        oc_path = find_executable('oc')
+        oc_path = get_toolchain()['oc']['path']
     if not oc_path:
         #  install oc from github
         urllib.urlretrieve(OC_DOWNLOAD, '/tmp/oc.tar.gz')
@@ -28,4 +38,5 @@ def get_install_oc():
         oc_path = '/tmp/oc/oc'
 
     log.info('OpenShift oc found: ' + oc_path)
+    _oc_path = oc_path
     return oc_path
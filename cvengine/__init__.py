@@ -1 +1,2 @@
-from .cvengine import run_container_validation
+from .cvengine import run_container_validation, run_multi_platform_validation
+from .batch import run_validation_batch
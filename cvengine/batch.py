@@ -0,0 +1,318 @@
+import json
+import os
+import ssl
+import time
+import traceback
+
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+from .cvdata import CVData, load_indexed_metadata
+from .cvengine import check_host_types, download_playbooks, \
+    environment_handlers, platform_handlers, run_scenario
+from .util import trace
+from .util.run import wait_for_result
+from .util.cache import DownloadCache, DEFAULT_WORKERS
+from .util.toolchain import get_toolchain, print_toolchain
+
+
+DEFAULT_BATCH_WORKERS = 4
+BATCH_MODES = ('thread', 'process')
+
+
+def run_validation_batch(jobs, config, artifacts_directory,
+                         extra_variables=None, workers=DEFAULT_BATCH_WORKERS,
+                         mode='thread', cancel_token=None):
+    """Validates many images in one process using a worker pool
+
+    Each job describes one validation: a container image, a metadata file
+    and optionally a target platform and extra variables. Work that is the
+    same for every job is only done once per batch: every distinct metadata
+    file and playbook is fetched and revalidated up front, and the jobs then
+    use those copies without contacting the servers again. The platform and
+    environment handlers of the jobs are resolved up front as well, so
+    their modules are imported once (before the worker processes are
+    forked in process mode). The toolchain is also only probed once.
+
+    The artifacts of each job are written to a subdirectory of the artifacts
+    directory named after the job, and an aggregated report of all jobs is
+    written to batch_results.json in the artifacts directory.
+
+    Args:
+        jobs (list): The jobs to run. Each job is either a dictionary with
+            the keys "image_url", "cvdata_url" and optionally
+            "target_host_platform", "extra_vars" and "name", or a tuple of
+            (image_url, cvdata_url, target_host_platform). Names must be
+            unique, as they name the artifact directories.
+        config (dict): The container validation config shared by all jobs.
+            The target platform of a job overrides "target_host_platform"
+            and "target_host_platforms".
+        artifacts_directory (str): The path to a directory where the
+            artifacts of all jobs will be written to
+        extra_variables (dict, optional): Extra variables passed to the
+            playbooks of every job. Variables of a job override these.
+        workers (int, optional): The maximum number of jobs to run at once
+        mode (str, optional): Either "thread" to run jobs on a thread pool
+            or "process" to run them on a process pool. Defaults to "thread".
+        cancel_token (:obj: `CancelToken`, optional): A token that aborts
+            all running jobs when cancelled. Only supported in thread mode,
+            as the token cannot be shared with worker processes.
+
+    Raises:
+        ValueError: If the mode is not supported, a job lacks its
+            image_url or cvdata_url, or two jobs have the same name
+
+    Returns:
+        list: The result of each job, in the same order as the jobs
+
+    """
+    if mode not in BATCH_MODES:
+        msg = '{0} is not a valid batch mode. Supported modes are: {1}'
+        raise ValueError(msg.format(mode, BATCH_MODES))
+
+    jobs = [normalize_job(job, i) for i, job in enumerate(jobs)]
+    names = set()
+    for job in jobs:
+        if job['name'] in names:
+            msg = 'More than one batch job is named {0}'
+            raise ValueError(msg.format(job['name']))
+        names.add(job['name'])
+    extra_variables = extra_variables or {}
+    cache_config = config.get('cache', {})
+    prefetch(jobs, config)
+
+    print_toolchain(get_toolchain(cache_config.get('directory')))
+
+    if mode != 'thread':
+        cancel_token = None
+    job_args = [(job, config, artifacts_directory, extra_variables,
+                 cancel_token) for job in jobs]
+    workers = max(1, min(workers, len(jobs)))
+    pool = ThreadPool(workers) if mode == 'thread' else Pool(workers)
+    try:
+        results = wait_for_result(pool.map_async(_run_batch_job, job_args))
+    finally:
+        pool.close()
+        pool.join()
+
+    write_batch_results(results, artifacts_directory)
+    return results
+
+
+def normalize_job(job, index):
+    """Converts a job definition into a job dictionary
+
+    Args:
+        job (dict or tuple): The job definition
+        index (int): The position of the job in the batch. Used to name jobs
+            that do not have a name.
+
+    Raises:
+        ValueError: If the job lacks its image_url or cvdata_url
+
+    Returns:
+        dict: The job dictionary
+    """
+    if isinstance(job, (list, tuple)):
+        keys = ('image_url', 'cvdata_url', 'target_host_platform')
+        job = dict(zip(keys, job))
+    job = dict(job)
+    job.setdefault('name', 'job-{0}'.format(index))
+    for key in ('image_url', 'cvdata_url'):
+        if not job.get(key):
+            msg = 'Batch job {0} does not define its {1}'
+            raise ValueError(msg.format(job['name'], key))
+    job.setdefault('extra_vars', {})
+    return job
+
+
+def prefetch(jobs, config):
+    """Fetches the metadata files and playbooks used by a batch
+
+    Every distinct metadata file is fetched and revalidated once, followed by
+    every distinct playbook of the platforms the jobs target. The handlers
+    of those platforms and their environments are resolved on the way.
+
+    Args:
+        jobs (list): The normalized jobs of the batch
+        config (dict): The container validation config shared by all jobs
+
+    """
+    cache_config = config.get('cache', {})
+    context = ssl._create_unverified_context()
+    metadata_cache = DownloadCache.from_config(cache_config, context=context)
+    playbook_urls = set()
+    for cvdata_url in set(job['cvdata_url'] for job in jobs):
+        metadata, platforms = load_indexed_metadata(cvdata_url,
+                                                    metadata_cache)
+        for job in jobs:
+            if job['cvdata_url'] != cvdata_url:
+                continue
+            # Unknown platforms are reported when the job runs
+            platform = platforms.get(job_platform(job, config, metadata), {})
+            for pb in platform.get('playbooks', []):
+                playbook_urls.add(pb['url'])
+            resolve_handlers(platform.get('host_type'), config)
+
+    playbook_cache = DownloadCache.from_config(cache_config)
+    playbook_cache.fetch_many(playbook_urls,
+                              workers=cache_config.get('workers',
+                                                       DEFAULT_WORKERS))
+
+
+def job_platform(job, config, metadata):
+    """Returns the platform a job validates against
+
+    This follows CVData, which runs a job on the first of the platforms
+    when the config lists several.
+
+    Args:
+        job (dict): The normalized job
+        config (dict): The container validation config shared by all jobs
+        metadata (dict): The metadata file of the job
+
+    Returns:
+        str: The host_type of the platform, or None for the default
+            platform of the metadata file
+    """
+    target = job.get('target_host_platform') or \
+        config.get('target_host_platform')
+    targets = config.get('target_host_platforms')
+    if target or not targets:
+        return target
+    if targets == 'all':
+        return metadata['Test'][0]['host_type'] if metadata['Test'] else None
+    return targets[0]
+
+
+def resolve_handlers(host_type, config):
+    """Imports the platform and environment handlers of a platform
+
+    The registries keep the resolved classes, so the jobs of a batch share
+    them. Handlers that cannot be resolved are reported when the job runs.
+
+    Args:
+        host_type (str): The host_type of the platform, or None
+        config (dict): The container validation config shared by all jobs
+
+    """
+    if host_type is None:
+        return
+    environment_config = config.get('environments', {}).get(
+        host_type, config.get('environment')) or {}
+    try:
+        platform_handlers.get(host_type)
+        environment_handlers.get(environment_config.get('handler',
+                                                        'preconfigured'))
+    except ImportError as e:
+        msg = 'Unable to resolve the handlers of {0}: {1}'
+        print(msg.format(host_type, e))
+
+
+def warm_caches(cache_config):
+    """Returns the caches used by the jobs of a batch
+
+    The files were revalidated when the batch started, so these caches
+    serve them without contacting the servers again.
+
+    Args:
+        cache_config (dict): The cache section of the config
+
+    Returns:
+        DownloadCache: The cache for metadata files
+        DownloadCache: The cache for playbooks
+    """
+    cache_config = dict(cache_config)
+    cache_config['max_age'] = float('inf')
+    context = ssl._create_unverified_context()
+    return (DownloadCache.from_config(cache_config, context=context),
+            DownloadCache.from_config(cache_config))
+
+
+def _run_batch_job(args):
+    """Runs a single job of a batch and records its result
+
+    This is a module level function so that it can be used with a process
+    pool.
+
+    Args:
+        args (tuple): The job, config, artifacts directory, extra variables
+            and cancellation token of the batch
+
+    Returns:
+        dict: The result of the job
+    """
+    job, config, artifacts_directory, extra_variables, cancel_token = args
+    result = {'name': job['name'],
+              'image_url': job['image_url'],
+              'cvdata_url': job['cvdata_url'],
+              'target_host_platform': job.get('target_host_platform'),
+              'artifacts_directory': os.path.join(artifacts_directory,
+                                                  job['name'])}
+    start_time = time.time()
+    trace_path = os.path.join(result['artifacts_directory'],
+                              trace.TRACE_FILE_NAME)
+    try:
+        job_config = dict(config)
+        if job.get('target_host_platform'):
+            # The platform of the job replaces the platforms of the config,
+            # as in job_platform
+            job_config.pop('target_host_platforms', None)
+            job_config['target_host_platform'] = job['target_host_platform']
+        metadata_cache, playbook_cache = warm_caches(config.get('cache', {}))
+
+        with trace.recording(trace_path), \
+                trace.span('validation', image_url=job['image_url']):
+            with trace.span('metadata_fetch', url=job['cvdata_url']):
+                cvdata = CVData(job['image_url'], job['cvdata_url'],
+                                job_config, cache=metadata_cache)
+            scenario = cvdata.scenario
+            check_host_types([scenario])
+            with trace.span('playbook_download',
+                            count=len(scenario['playbooks'])):
+                download_playbooks(scenario['playbooks'], playbook_cache)
+
+            job_variables = dict(extra_variables)
+            job_variables.update(job['extra_vars'])
+            job_variables['image_url'] = job['image_url']
+
+            run_scenario(scenario, cvdata.artifacts,
+                         cvdata.environment_config(scenario['host_type']),
+                         result['artifacts_directory'], job_variables,
+                         config=job_config, cancel_token=cancel_token)
+        result['status'] = 'passed'
+    except Exception:
+        result['status'] = 'failed'
+        result['error'] = traceback.format_exc()
+    result['duration'] = time.time() - start_time
+    return result
+
+
+def write_batch_results(results, artifacts_directory):
+    """Writes the aggregated report of a batch
+
+    The report is printed and written as json to batch_results.json in the
+    artifacts directory.
+
+    Args:
+        results (list): The result of each job
+        artifacts_directory (str): The path to the artifacts directory
+
+    """
+    if not os.path.isdir(artifacts_directory):
+        os.makedirs(artifacts_directory)
+    passed = len([r for r in results if r['status'] == 'passed'])
+    report = {'total': len(results),
+              'passed': passed,
+              'failed': len(results) - passed,
+              'jobs': results}
+    path = os.path.join(artifacts_directory, 'batch_results.json')
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+    print('Batch results: {0} passed, {1} failed'.format(report['passed'],
+                                                         report['failed']))
+    for result in results:
+        print('  {0} ({1}): {2} ({3:.1f}s)'.format(
+            result['name'], result['image_url'], result['status'],
+            result['duration']))
@@ -1,7 +1,84 @@
+import copy
 import ssl
-import urllib2
+import threading
 import yaml
 
+from collections import OrderedDict
+
+from .util.cache import DownloadCache
+
+
+# Prefer the libyaml-backed loader, which is an order of magnitude faster
+# than the pure python implementation
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# The most parsed metadata documents kept in memory
+MAX_PARSED_METADATA = 16
+
+# Parsed metadata documents and the positions of their platforms (see
+# index_platforms), keyed by the sha256 digest of the raw file. The least
+# recently used document is dropped once there are MAX_PARSED_METADATA.
+_parsed_metadata = OrderedDict()
+_parsed_metadata_lock = threading.Lock()
+
+
+def load_indexed_metadata(url, cache):
+    """Loads a metadata file along with the index of its platforms
+
+    The file is revalidated against the download cache with a conditional
+    GET. The parsed document and the index of its platforms are memoized by
+    content hash, so repeated loads of the same file skip the yaml parsing.
+
+    Args:
+        url (str): The URL to the metadata file
+        cache (:obj: `DownloadCache`): The cache to fetch the file through
+
+    Returns:
+        dict: A copy of the parsed metadata file that is safe to modify
+        dict: The platforms of the copy, keyed by host_type. The platform
+            marked as the default is additionally stored under the None key.
+    """
+    path, digest = cache.fetch_with_digest(url)
+    with _parsed_metadata_lock:
+        # Move the document to the end, as the most recently used one
+        parsed = _parsed_metadata.pop(digest, None)
+        if parsed is not None:
+            _parsed_metadata[digest] = parsed
+    if parsed is None:
+        with open(path) as f:
+            metadata = yaml.load(f, Loader=YAML_LOADER)
+        parsed = (metadata, index_platforms(metadata))
+        with _parsed_metadata_lock:
+            while len(_parsed_metadata) >= MAX_PARSED_METADATA:
+                _parsed_metadata.popitem(last=False)
+            _parsed_metadata[digest] = parsed
+    metadata, positions = parsed
+    # The scenario is modified while running, so never hand out the
+    # memoized document itself
+    metadata = copy.deepcopy(metadata)
+    platforms = dict((host_type, metadata['Test'][position])
+                     for host_type, position in positions.items())
+    return metadata, platforms
+
+
+def index_platforms(metadata):
+    """Builds a lookup table of the platforms defined in the metadata
+
+    Args:
+        metadata (dict): The scenario metadata information
+
+    Returns:
+        dict: The position of each platform in the "Test" list, keyed by
+            host_type. The platform marked as the default is additionally
+            stored under the None key.
+    """
+    index = {}
+    for position, platform in enumerate(metadata['Test']):
+        index.setdefault(platform['host_type'], position)
+        if platform.get('default', False):
+            index.setdefault(None, position)
+    return index
+
 
 class CVData():
     """Class to encapsulate all configuration information for running scenario
@@ -17,23 +94,55 @@ class CVData():
             file
         scenario (dict): The data for the target platform pulled from the
             metadata
+        scenarios (list): The data for every target platform when running
+            against several platforms at once. When a single platform is
+            targeted, this only contains the scenario.
         artifacts (list): A list of artifacts to be retrieved from the
             container and test host
         environment (dict): A dictionary of configuration information for
             the target environment
+        environments (dict): Per-platform environment configuration, keyed
+            by host_type. Platforms without an entry use the environment
+            attribute.
+        platforms (dict): The metadata for each platform, keyed by
+            host_type, with the default platform also under the None key
+        cache (:obj: `DownloadCache`): The cache the metadata file is
+            downloaded into
     """
-    def __init__(self, image_url, cvdata_url, config):
+    def __init__(self, image_url, cvdata_url, config, cache=None):
         self.image_url = image_url
+        if cache is None:
+            context = ssl._create_unverified_context()
+            cache = DownloadCache.from_config(config.get('cache', {}),
+                                              context=context)
+        self.cache = cache
         self.metadata = self.fetch_metadata(cvdata_url)
-        self.scenario = self.parse_scenario(self.metadata, config)
+        if 'target_host_platforms' in config:
+            self.scenarios = self.parse_scenarios(config)
+        else:
+            self.scenarios = [self.parse_scenario(config)]
+        self.scenario = self.scenarios[0]
         self.artifacts = self.metadata['Artifacts']
         self.environment = config.get('environment')
+        self.environments = config.get('environments', {})
+
+    def environment_config(self, host_type):
+        """Returns the environment configuration for a target platform
+
+        Args:
+            host_type (str): The host_type of the target platform
+
+        Returns:
+            dict: The environment configuration for the platform
+        """
+        return self.environments.get(host_type, self.environment)
 
     def fetch_metadata(self, url):
         """Downloads the metadata file and parses its contents
 
         Helper function to fetch the metadata file and parse the yaml contents
-        into a dictionary.
+        into a dictionary. Also sets the platforms attribute. See
+        load_indexed_metadata for how the file is cached.
 
         Args:
             url (str): The URL to the metadata file
@@ -42,39 +151,29 @@ class CVData():
             dict: The contents of the metadata file
         """
         print('Downloading metadata file from {0}'.format(url))
-        context = ssl._create_unverified_context()
-        raw_data = urllib2.urlopen(url, context=context).read()
-        metadata = yaml.load(raw_data)
+        metadata, self.platforms = load_indexed_metadata(url, self.cache)
 
         print 'The metadata contents are: {0}'.format(metadata)
         return metadata
 
-    def parse_scenario(self, metadata, config):
+    def parse_scenario(self, config):
         """Determines the target scenario from the metadata file
 
         Fetches the target container platform from the scenario config
-        then parses the corresponding config for the target platform
-        from the metadata information. If no target platform is specified,
-        a default target platform will be used.
+        then looks up the corresponding config for the target platform
+        in the platforms of the metadata file. If no target platform is
+        specified, a default target platform will be used.
 
         Args:
-            metadata (dict): The scenario metadata information
             config (dict): The scenario config
 
         Returns:
             dict: The metadata information for the target scenario
         """
         target_platform = config.get('target_host_platform', None)
-        implemented_platforms = []
-        scenario = None
-        for platform in metadata['Test']:
-            platform_name = platform['host_type']
-            implemented_platforms.append(platform_name)
-            if ((platform_name == target_platform) or
-                    (platform.get('default', False) and target_platform
-                     is None)):
-                scenario = platform
-                break
+        platforms = self.platforms
+        scenario = platforms.get(target_platform)
+        implemented_platforms = [p for p in platforms if p is not None]
 
         if not scenario:
             msg = ('The specified target host platform ({target}) did not '
@@ -85,3 +184,40 @@ class CVData():
                                         platforms=implemented_platforms))
 
         return scenario
+
+    def parse_scenarios(self, config):
+        """Determines every target scenario from the metadata file
+
+        Used when validating against several container platforms in one run.
+        The "target_host_platforms" key of the config is either a list of
+        host_type values or the string "all", which selects every platform
+        defined in the metadata file.
+
+        Args:
+            config (dict): The scenario config
+
+        Raises:
+            ValueError: If a requested platform is not defined in the
+                metadata file
+
+        Returns:
+            list: The metadata information for each target scenario
+        """
+        targets = config['target_host_platforms']
+        platforms = self.platforms
+        if targets == 'all':
+            targets = []
+            for platform in self.metadata['Test']:
+                if platform['host_type'] not in targets:
+                    targets.append(platform['host_type'])
+
+        missing = [t for t in targets if t not in platforms]
+        if missing or not targets:
+            msg = ('The specified target host platforms ({targets}) did not '
+                   'match the options configured in the metadata file. '
+                   'Definitions were found for the following container '
+                   'platforms: {platforms}')
+            implemented_platforms = [p for p in platforms if p is not None]
+            raise ValueError(msg.format(targets=targets,
+                                        platforms=implemented_platforms))
+        return [platforms[t] for t in targets]
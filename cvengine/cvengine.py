@@ -1,49 +1,66 @@
 #! /usr/bin/env python2
 
+import argparse
+import json
 import os
+import signal
+import time
 import traceback
-import urllib
-import urlparse
 import yaml
 
+from multiprocessing.pool import ThreadPool
+
 from .cvdata import CVData
-from .util import run
-from .environment_handlers.openstack_environment import OpenstackEnvironment
-from .environment_handlers.preconfigured_environment import \
-        PreConfiguredEnvironment
-from .platform_handlers.atomic_host_handler import AtomicHostHandler
-from .platform_handlers.fedora_handler import FedoraHandler
+from .util import run, trace
+from .util.cache import DownloadCache, DEFAULT_WORKERS
+from .util.checkpoint import RUN_STATE_FILE, RunState
+from .util.schedule import DEFAULT_PLAYBOOK_CONCURRENCY
+from .util.toolchain import get_toolchain, print_toolchain, write_toolchain
+from .registry import HandlerRegistry
+
 
+# Subdirectory of the artifacts directory holding the output of each command
+COMMAND_LOG_DIRECTORY = 'commands'
 
-environment_handlers = {
-    'preconfigured': PreConfiguredEnvironment,
-    'openstack': OpenstackEnvironment
-}
+# Handlers are imported on first use, so a run only pays for the
+# dependencies of the handlers it actually uses
+environment_handlers = HandlerRegistry('cvengine.environment_handlers', {
+    'preconfigured': ('cvengine.environment_handlers.preconfigured_environment'
+                      ':PreConfiguredEnvironment'),
+    'openstack': ('cvengine.environment_handlers.openstack_environment'
+                  ':OpenstackEnvironment')
+})
 
-platform_handlers = {
-    'dashost': AtomicHostHandler,
-    'atomic': AtomicHostHandler,
-    'fedora': FedoraHandler
-}
+platform_handlers = HandlerRegistry('cvengine.platform_handlers', {
+    'dashost': ('cvengine.platform_handlers.atomic_host_handler'
+                ':AtomicHostHandler'),
+    'atomic': ('cvengine.platform_handlers.atomic_host_handler'
+               ':AtomicHostHandler'),
+    'fedora': 'cvengine.platform_handlers.fedora_handler:FedoraHandler'
+})
 
 
 def run_container_validation(image_url, chidata_url, config,
-                             artifacts_directory, extra_variables):
+                             artifacts_directory, extra_variables,
+                             cancel_token=None, resume=False,
+                             keep_environment=False):
     """Runs a container validation against the target container image
 
     This is the main worker function of the cvengine. It takes the parameters
     for the container validation scenario, fetches the metadata file
     and playbooks, parses all config, orchestrates setup of the target
     environment, and finally executes the validation against the target
-    container platform.
+    container platform. The playbooks are downloaded in the background
+    while the environment and platform are set up.
 
     Args:
         image_url (str): Location of the container image. In most cases,
             this should be a string that can be passed to the "docker pull"
-            command. Alternatively, this could be a full URL to a file that
-            gets fetched by the test playbooks and then loaded in docker.
-            The latter method is not handled by the cvengine and is left to
-            the playbooks to implement.
+            command. Alternatively, this could be a full URL to an image
+            archive written by "docker save". cvengine downloads the archive
+            into its cache and loads it into docker on the remote host, and
+            playbooks get the ID of the loaded image as image_id (see
+            BasePlatformHandler.finish_image_pull).
         chidata_url (str): Location of the metadata file. This file will be
             fetched and parsed to get information about the current scenario
             (target platform, playbook locations, platform customizations,
@@ -59,56 +76,429 @@ def run_container_validation(image_url, chidata_url, config,
             the playbooks. These will be passed to ALL playbooks using the
             --extra-vars argument. NOTE: These variables will be overriden by
             any variables defined in the metadata file.
+        cancel_token (:obj: `CancelToken`, optional): A token that can be
+            used by an orchestrator to abort the validation. Teardown still
+            runs after the validation was cancelled.
+        resume (bool, optional): Continue the failed run recorded in the
+            artifacts directory. See run_scenario.
+        keep_environment (bool, optional): Keep the environment alive if
+            the validation fails, so the run can be resumed
 
     """
-    cvdata = CVData(image_url, chidata_url, config)
-    scenario = cvdata.scenario
-    artifacts = cvdata.artifacts
-    environment_config = cvdata.environment
-
-    if scenario['host_type'] not in platform_handlers:
-        msg = ('{0} is not a valid host_type. Support host_type values'
-               'are: {1}')
-        raise ValueError(msg.format(scenario['host_type'],
-                                    platform_handlers.keys()))
-
-    # pre-download playbook files
-    playbooks = scenario['playbooks']
-    for pb in playbooks:
-        url = pb['url']
-        base_name = os.path.basename(urlparse.urlsplit(url).path)
-        new_path = os.path.join('/tmp', base_name)
+    trace_path = os.path.join(artifacts_directory, trace.TRACE_FILE_NAME)
+    with trace.recording(trace_path), \
+            trace.span('validation', image_url=image_url):
+        with trace.span('metadata_fetch', url=chidata_url):
+            cvdata = CVData(image_url, chidata_url, config)
+        scenario = cvdata.scenario
+        check_host_types([scenario])
+
+        cache_config = config.get('cache', {})
+        download = start_playbook_download(scenario['playbooks'],
+                                           cache_config)
+
+        with trace.span('toolchain_probe'):
+            print_toolchain(get_toolchain(cache_config.get('directory')))
+
+        extra_variables['image_url'] = image_url
+
+        run_scenario(scenario, cvdata.artifacts,
+                     cvdata.environment_config(scenario['host_type']),
+                     artifacts_directory, extra_variables, config=config,
+                     cancel_token=cancel_token, resume=resume,
+                     keep_environment=keep_environment,
+                     playbook_download=download)
+
+
+def run_multi_platform_validation(image_url, chidata_url, config,
+                                  artifacts_directory, extra_variables,
+                                  platforms=None, cancel_token=None,
+                                  resume=False, keep_environment=False):
+    """Runs a container validation against several platforms concurrently
+
+    Every selected Test entry of the metadata file is validated in parallel
+    within the same process. Each platform gets its own environment and
+    platform handler, while the metadata file and playbooks are only
+    downloaded once, the playbooks in the background while the platforms
+    are set up. Artifacts for each platform are written to a
+    subdirectory of the artifacts directory named after its host_type, and a
+    combined summary is written to results.json in the artifacts directory.
+
+    Args:
+        image_url (str): Location of the container image. See
+            run_container_validation.
+        chidata_url (str): Location of the metadata file
+        config (dict): Configuration info for the target platforms and
+            environments. An "environments" key may map each host_type to its
+            own environment config. Platforms without an entry use the
+            "environment" key.
+        artifacts_directory (str): The path to a directory where test
+            artifacts will be written to
+        extra_variables (dict): Any extra variables that should be passed to
+            all playbooks of every platform
+        platforms (list, optional): The host_type values to validate against.
+            Defaults to the "target_host_platforms" key of the config, or
+            every platform in the metadata file if that key is not set.
+        cancel_token (:obj: `CancelToken`, optional): A token that can be
+            used by an orchestrator to abort the validation on all platforms
+        resume (bool, optional): Continue the failed runs recorded in the
+            artifacts directory of each platform. See run_scenario.
+        keep_environment (bool, optional): Keep the environment of each
+            platform that fails alive, so its run can be resumed
+
+    Raises:
+        Exception: A generic exception if the validation failed on any of
+            the platforms
+
+    Returns:
+        dict: The results for each platform, keyed by host_type
+
+    """
+    config = dict(config)
+    if platforms is not None:
+        config['target_host_platforms'] = platforms
+    config.setdefault('target_host_platforms', 'all')
+
+    trace_path = os.path.join(artifacts_directory, trace.TRACE_FILE_NAME)
+    with trace.recording(trace_path) as tracer, \
+            trace.span('validation', image_url=image_url) as validation:
+        with trace.span('metadata_fetch', url=chidata_url):
+            cvdata = CVData(image_url, chidata_url, config)
+        scenarios = cvdata.scenarios
+        check_host_types(scenarios)
+
+        cache_config = config.get('cache', {})
+        playbooks = [pb for scenario in scenarios
+                     for pb in scenario['playbooks']]
+        download = start_playbook_download(playbooks, cache_config)
+
+        with trace.span('toolchain_probe'):
+            print_toolchain(get_toolchain(cache_config.get('directory')))
+
+        extra_variables['image_url'] = image_url
+
+        def run_platform(scenario):
+            host_type = scenario['host_type']
+            result = {'host_type': host_type,
+                      'artifacts_directory': os.path.join(artifacts_directory,
+                                                          host_type)}
+            start_time = time.time()
+            try:
+                with trace.activate(tracer, parent=validation):
+                    run_scenario(scenario, cvdata.artifacts,
+                                 cvdata.environment_config(host_type),
+                                 result['artifacts_directory'],
+                                 dict(extra_variables), config=config,
+                                 cancel_token=cancel_token, resume=resume,
+                                 keep_environment=keep_environment,
+                                 playbook_download=download)
+                result['status'] = 'passed'
+            except Exception:
+                result['status'] = 'failed'
+                result['error'] = traceback.format_exc()
+            result['duration'] = time.time() - start_time
+            return result
+
+        pool = ThreadPool(len(scenarios))
+        try:
+            results = run.wait_for_result(
+                pool.map_async(run_platform, scenarios))
+        finally:
+            pool.close()
+            pool.join()
+
+    results = dict((r['host_type'], r) for r in results)
+    write_results(results, artifacts_directory)
+
+    failed = sorted(h for h, r in results.items() if r['status'] != 'passed')
+    if failed:
+        msg = 'Container validation failed on the following platforms: {0}'
+        raise Exception(msg.format(', '.join(failed)))
+    return results
+
+
+def run_scenario(scenario, artifacts, environment_config,
+                 artifacts_directory, extra_variables, config=None,
+                 cancel_token=None, resume=False, keep_environment=False,
+                 playbook_download=None):
+    """Runs the validation of a single scenario on its target platform
+
+    Prepares the environment, then sets up and runs the platform handler for
+    the scenario. Platform and environment teardown are always performed,
+    regardless of whether the validation succeeds. The scenario playbooks
+    must already have been downloaded, or be downloading through
+    playbook_download, which is waited for before the playbooks run. The
+    full output of every command
+    run for the scenario is logged to the commands subdirectory of the
+    artifacts directory.
+
+    Each phase can be given a deadline in seconds through the "timeouts"
+    section of the config, using the keys "prepare", "setup", "run",
+    "teardown" and "environment_teardown". The "command" key sets a timeout
+    for every command, and the "playbook" key a default timeout for each
+    playbook (which a playbook entry in the metadata file can override with
+    its own "timeout" key). A command that exceeds its deadline is killed
+    along with its process group.
+
+    The "ansible_backend" key of the config selects how playbooks are run
+    when the scenario does not set it: "cli" (the default) runs
+    ansible-playbook for each playbook, while "api" runs all of them through
+    the Ansible python API in one worker process. Independent playbooks run
+    at the same time, up to the "playbook_concurrency" of the scenario or
+    the config.
+
+    Once the environment is ready, the image is pulled on the remote host
+    in the background while the platform is set up, unless the scenario or
+    the config sets "prepull" to false. Playbooks only wait for the pull if
+    they need the image. The "image_pull" key of the "timeouts" section
+    sets a deadline for the pull.
+
+    Ansible facts are cached in the cache directory, as configured by the
+    "facts" and "fact_timeout" keys of the "cache" section of the config.
+    The "artifact_transfer" section sets how artifact directories are
+    fetched from remote hosts.
+
+    The progress of the run is recorded in RUN_STATE_FILE in the artifacts
+    directory (see cvengine.util.checkpoint.RunState). A resumed run
+    reattaches to the environment of the previous run, and skips the phases
+    and playbooks that it completed. If the environment was torn down, or
+    reattaching to it fails, the run starts over in a new environment.
+
+    Args:
+        scenario (dict): The metadata for the target platform
+        artifacts (dict): The artifacts to be retrieved after the run
+        environment_config (dict): The configuration of the environment
+            the platform runs in
+        artifacts_directory (str): The path to a directory where test
+            artifacts will be written to
+        extra_variables (dict): Any extra variables that should be passed to
+            the playbooks
+        config (dict, optional): The container validation config
+        cancel_token (:obj: `CancelToken`, optional): A token that aborts
+            the scenario when cancelled. Teardown still runs.
+        resume (bool, optional): Continue the previous run recorded in the
+            artifacts directory instead of starting a new one
+        keep_environment (bool, optional): Do not tear down the environment
+            if the run fails, so it can be resumed
+        playbook_download (:obj: `AsyncResult`, optional): The download of
+            the playbooks, as returned by start_playbook_download
+
+    """
+    config = config or {}
+    timeouts = config.get('timeouts', {})
+    command_log_directory = os.path.join(artifacts_directory,
+                                         COMMAND_LOG_DIRECTORY)
+    with trace.span('scenario', host_type=scenario['host_type']), \
+            run.command_logs(command_log_directory), \
+            run.run_context(cancel_token, timeouts.get('command')):
+        toolchain = get_toolchain(config.get('cache', {}).get('directory'))
+        write_toolchain(toolchain, artifacts_directory)
+
+        host_type = scenario['host_type']
+        state_path = os.path.join(artifacts_directory, RUN_STATE_FILE)
+        image_url = extra_variables.get('image_url')
+        if resume:
+            state = RunState.load(state_path, image_url, host_type)
+            if state.data['status'] == 'passed':
+                print('The previous run on {0} passed, nothing to '
+                      'resume'.format(host_type))
+                return
+            state.set('status', 'running')
+        else:
+            state = RunState(state_path, image_url, host_type)
+            state.save()
+
+        handler = environment_config.get('handler', 'preconfigured')
+        environment_class = environment_handlers[handler]
+        environment = environment_class(environment_config)
+        previous = state.environment
+        restored = False
+        if resume and previous is not None and \
+                previous['handler'] == handler and not previous['torn_down']:
+            print('Reattaching to the environment of the previous run')
+            try:
+                with trace.span('environment.restore', handler=handler), \
+                        run.phase(timeouts.get('prepare')):
+                    environment.restore(previous['details'])
+                restored = True
+            except run.Cancelled:
+                raise
+            except Exception:
+                print('Unable to reattach to the environment: {0}'.format(
+                    traceback.format_exc()))
+                environment = environment_class(environment_config)
+        if not restored:
+            if resume:
+                print('The environment of the previous run is gone, '
+                      'starting over')
+                state.reset_progress()
+            with trace.span('environment.prepare', handler=handler), \
+                    run.phase(timeouts.get('prepare')):
+                environment.prepare()
+            state.record_environment(handler, environment.checkpoint())
+            state.complete_phase('prepare')
+
+        platform_class = platform_handlers[host_type]
+        platform = platform_class(scenario, environment,
+                                  artifacts, extra_variables)
+        if platform.playbook_timeout is None:
+            platform.playbook_timeout = timeouts.get('playbook')
+        if platform.ansible_backend is None:
+            platform.ansible_backend = config.get('ansible_backend', 'cli')
+        if platform.playbook_concurrency is None:
+            platform.playbook_concurrency = config.get(
+                'playbook_concurrency', DEFAULT_PLAYBOOK_CONCURRENCY)
+        if platform.prepull is None:
+            platform.prepull = config.get('prepull', True)
+        platform.image_pull_timeout = timeouts.get('image_pull')
+        platform.toolchain = toolchain
+        platform.fact_cache_config = config.get('cache', {})
+        platform.download_cache_config = config.get('cache', {})
+        platform.artifact_transfer_config = config.get('artifact_transfer', {})
+        platform.attach_run_state(state)
+        failed = True
         try:
-            urllib.urlretrieve(url, new_path)
+            platform.start_image_pull()
+            with trace.span('platform.setup'), \
+                    run.phase(timeouts.get('setup')):
+                platform.setup()
+            state.complete_phase('setup')
+            if playbook_download is not None:
+                with trace.span('playbook_download.wait'):
+                    wait_for_download(playbook_download)
+            with trace.span('platform.run'), run.phase(timeouts.get('run')):
+                platform.run()
+            failed = False
         except Exception:
-            msg = 'Error when downloading playbook {0}: {1}'
-            msg = msg.format(url, traceback.format_exc())
-            raise Exception(msg)
-        pb['local_path'] = new_path
+            msg = 'Error encountered while running handler: {0}'
+            print(msg.format(traceback.format_exc()))
+            raise
+        finally:
+            state.set('status', 'failed' if failed else 'passed')
+            with run.shielded():
+                with trace.span('platform.teardown'), \
+                        run.phase(timeouts.get('teardown')):
+                    platform.teardown(artifacts_directory)
+                if failed and keep_environment:
+                    msg = ('Keeping the environment at {0} after the '
+                           'failure, resume the run with --resume')
+                    print(msg.format(environment.host_ip))
+                else:
+                    with trace.span('environment.teardown'), \
+                            run.phase(timeouts.get('environment_teardown')):
+                        environment.teardown()
+                    if environment.ephemeral:
+                        state.environment_torn_down()
+
 
-    run.run_cmd('ansible-playbook --version')
-    run.run_cmd('ansible --version')
+def check_host_types(scenarios):
+    """Verifies that a platform handler exists for each scenario
 
-    extra_variables['image_url'] = image_url
+    Args:
+        scenarios (list): The metadata for each target platform
 
-    environment = environment_config.get('handler', 'preconfigured')
-    environment_class = environment_handlers[environment]
-    environment = environment_class(environment_config)
-    environment.prepare()
+    Raises:
+        ValueError: If a scenario has an unsupported host_type
 
-    platform_class = platform_handlers[scenario['host_type']]
-    platform = platform_class(scenario, environment,
-                              artifacts, extra_variables)
+    """
+    for scenario in scenarios:
+        if scenario['host_type'] not in platform_handlers:
+            msg = ('{0} is not a valid host_type. Support host_type values'
+                   'are: {1}')
+            raise ValueError(msg.format(scenario['host_type'],
+                                        platform_handlers.keys()))
+
+
+def write_results(results, artifacts_directory):
+    """Writes a summary of a multi-platform run
+
+    The summary is printed and written as json to results.json in the
+    artifacts directory.
+
+    Args:
+        results (dict): The results for each platform, keyed by host_type
+        artifacts_directory (str): The path to the artifacts directory
+
+    """
+    if not os.path.isdir(artifacts_directory):
+        os.makedirs(artifacts_directory)
+    with open(os.path.join(artifacts_directory, 'results.json'), 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+    print('Container validation results:')
+    for host_type in sorted(results):
+        result = results[host_type]
+        print('  {0}: {1} ({2:.1f}s)'.format(host_type, result['status'],
+                                             result['duration']))
+
+
+def start_playbook_download(playbooks, cache_config):
+    """Starts downloading playbooks in the background
+
+    The playbooks are downloaded with download_playbooks on a thread of its
+    own, under the tracer of the calling thread.
+
+    Args:
+        playbooks (list): The playbook entries from the metadata file
+        cache_config (dict): The cache section of the config
+
+    Returns:
+        :obj: `AsyncResult`: The download. Pass it to wait_for_download.
+    """
+    cache = DownloadCache.from_config(cache_config)
+    workers = cache_config.get('workers', DEFAULT_WORKERS)
+    tracer = trace.current_tracer()
+    parent = tracer.current_span() if tracer is not None else None
+
+    def download():
+        with trace.activate(tracer, parent=parent), \
+                trace.span('playbook_download', count=len(playbooks)):
+            download_playbooks(playbooks, cache, workers=workers)
+
+    pool = ThreadPool(1)
     try:
-        platform.setup()
-        platform.run()
-    except Exception:
-        msg = 'Error encountered while running handler: {0}'
-        print(msg.format(traceback.format_exc()))
-        raise
+        return pool.apply_async(download)
     finally:
-        platform.teardown(artifacts_directory)
-        environment.teardown()
+        pool.close()
+
+
+def wait_for_download(download):
+    """Waits for a download started by start_playbook_download
+
+    Args:
+        download (:obj: `AsyncResult`): The download
+
+    Raises:
+        Cancelled: If the run of the current thread was cancelled
+        DeadlineExceeded: If the deadline of the current phase passed
+        Exception: A generic exception if any playbook cannot be downloaded
+
+    """
+    while not download.ready():
+        run.check_deadline()
+        download.wait(run.POLL_INTERVAL)
+    download.get()
+
+
+def download_playbooks(playbooks, cache, workers=DEFAULT_WORKERS):
+    """Downloads the playbooks for a scenario into the local cache
+
+    All playbooks are fetched in parallel. Each playbook dictionary gets a
+    "local_path" key pointing to its cached copy.
+
+    Args:
+        playbooks (list): The playbook entries from the metadata file
+        cache (:obj: `DownloadCache`): The cache to download playbooks into
+        workers (int, optional): The maximum number of concurrent downloads
+
+    Raises:
+        Exception: A generic exception if any playbook cannot be downloaded
+
+    """
+    urls = [pb['url'] for pb in playbooks]
+    paths = cache.fetch_many(urls, workers=workers)
+    for pb in playbooks:
+        pb['local_path'] = paths[pb['url']]
 
 
 def main():
@@ -118,15 +508,112 @@ def main():
     installing the package. It expects the required parameters to be set
     as environment variables. This function parses the environment variables
     and passes them as arguments to the run_container_validation function.
+    If CV_BATCH_FILE is set, the batch of jobs listed in that file is run
+    instead.
+
+    The --keep-environment option keeps the environment alive if the
+    validation fails, and --resume continues such a failed validation. Both
+    are not supported for batches.
     """
-    image_url = os.environ['CV_IMAGE_URL']
-    cvdata_url = os.environ['CV_CVDATA_URL']
+    parser = argparse.ArgumentParser(
+        description='Runs a container validation as configured by the CV_* '
+                    'environment variables')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue the failed validation recorded in '
+                             'the artifacts directory, skipping the work it '
+                             'completed')
+    parser.add_argument('--keep-environment', action='store_true',
+                        help='do not tear down the environment if the '
+                             'validation fails, so it can be resumed')
+    args = parser.parse_args()
+    if 'CV_BATCH_FILE' in os.environ and (args.resume or
+                                          args.keep_environment):
+        parser.error('--resume and --keep-environment are not supported '
+                     'with CV_BATCH_FILE')
+
     cv_config = yaml.load(os.environ['CV_CONFIG'])
     artifacts_directory = os.environ['CV_ARTIFACTS_DIRECTORY']
     extra_vars = yaml.load(os.environ.get('CV_EXTRA_VARS', '{}'))
+    cancel_token = install_cancel_handlers()
+
+    if 'CV_BATCH_FILE' in os.environ:
+        run_batch_from_file(os.environ['CV_BATCH_FILE'], cv_config,
+                            artifacts_directory, extra_vars,
+                            cancel_token=cancel_token)
+        return
+
+    image_url = os.environ['CV_IMAGE_URL']
+    cvdata_url = os.environ['CV_CVDATA_URL']
+    if 'target_host_platforms' in cv_config:
+        run_multi_platform_validation(image_url, cvdata_url, cv_config,
+                                      artifacts_directory, extra_vars,
+                                      cancel_token=cancel_token,
+                                      resume=args.resume,
+                                      keep_environment=args.keep_environment)
+    else:
+        run_container_validation(image_url, cvdata_url, cv_config,
+                                 artifacts_directory, extra_vars,
+                                 cancel_token=cancel_token,
+                                 resume=args.resume,
+                                 keep_environment=args.keep_environment)
+
+
+def install_cancel_handlers():
+    """Cancels the running validation when SIGTERM or SIGINT is received
+
+    The command that is running is killed and teardown is performed before
+    the process exits, so an aborted job does not leave hosts or processes
+    behind. A second signal terminates the process right away.
+
+    Returns:
+        CancelToken: The token that is cancelled by the signal handlers
+    """
+    cancel_token = run.CancelToken()
+
+    def cancel(signum, frame):
+        print('Received signal {0}, cancelling the validation'.format(signum))
+        cancel_token.cancel('Received signal {0}'.format(signum))
+        signal.signal(signum, signal.SIG_DFL)
+
+    signal.signal(signal.SIGTERM, cancel)
+    signal.signal(signal.SIGINT, cancel)
+    return cancel_token
+
+
+def run_batch_from_file(batch_file, config, artifacts_directory,
+                        extra_variables, cancel_token=None):
+    """Runs a batch of validations defined in a yaml file
+
+    The file contains a list of jobs in the format accepted by
+    run_validation_batch. The size and type of the worker pool are read
+    from the CV_BATCH_WORKERS and CV_BATCH_MODE environment variables.
+
+    Args:
+        batch_file (str): Path to the yaml file listing the jobs
+        config (dict): The container validation config shared by all jobs
+        artifacts_directory (str): The path to the artifacts directory
+        extra_variables (dict): Extra variables passed to every job
+        cancel_token (:obj: `CancelToken`, optional): A token that aborts
+            the batch when cancelled
+
+    Raises:
+        Exception: A generic exception if any job of the batch failed
+
+    """
+    # Imported here as the batch module builds on this one
+    from .batch import run_validation_batch, DEFAULT_BATCH_WORKERS
 
-    run_container_validation(image_url, cvdata_url, cv_config,
-                             artifacts_directory, extra_vars)
+    with open(batch_file) as f:
+        jobs = yaml.safe_load(f)
+    workers = int(os.environ.get('CV_BATCH_WORKERS', DEFAULT_BATCH_WORKERS))
+    mode = os.environ.get('CV_BATCH_MODE', 'thread')
+    results = run_validation_batch(jobs, config, artifacts_directory,
+                                   extra_variables, workers=workers,
+                                   mode=mode, cancel_token=cancel_token)
+    failed = [r['name'] for r in results if r['status'] != 'passed']
+    if failed:
+        msg = 'The following batch jobs failed: {0}'
+        raise Exception(msg.format(', '.join(failed)))
 
 
 if __name__ == '__main__':
@@ -18,7 +18,18 @@ class BaseEnvironmentHandler(object):
             to the container platform host
         port (int): The port number to be used to ssh to the container platform
             host
+        fresh_host (bool): Whether the host was provisioned for this run.
+            Anything cached about a host at the same address is discarded.
+        ssh_connection (:obj: `SSHClient`): An authenticated SSH connection
+            to the host, if the environment opened one while preparing it.
+            Platform handlers reuse it instead of logging in again.
+        ephemeral (bool): Whether teardown destroys the hosts, in which case
+            a run cannot be resumed after its environment was torn down
     """
+    fresh_host = False
+    ssh_connection = None
+    ephemeral = False
+
     def __init__(self):
         pass
 
@@ -61,6 +72,40 @@ class BaseEnvironmentHandler(object):
         self.ssh_key_path = ssh_key_path
         self.port = port
 
+    def checkpoint(self):
+        """Returns the details needed to reattach to the environment
+
+        Called after prepare. The details are recorded in the run state, so
+        a failed run can be resumed against the same hosts (see restore).
+        The run state is written to the artifacts directory, so the details
+        must not hold credentials such as the password.
+
+        Returns:
+            dict: The details, which must be serializable as json
+        """
+        return {'host_name': self.host_name, 'host_ip': self.host_ip,
+                'username': self.username,
+                'ssh_key_path': self.ssh_key_path, 'port': self.port}
+
+    def restore(self, details):
+        """Reattaches to the environment prepared by a previous run
+
+        Called instead of prepare when a run is resumed. The password is
+        not part of the details, the one read from the environment config
+        when the handler was created is kept.
+
+        Args:
+            details (dict): The details returned by checkpoint
+
+        Raises:
+            Exception: A generic exception if the environment is gone
+
+        """
+        self.set_required_data(details['host_name'], details['host_ip'],
+                               details['username'],
+                               getattr(self, 'password', None),
+                               details['ssh_key_path'], details['port'])
+
     def teardown(self):
         """Function to tear down the environment after the run
 
@@ -1,5 +1,6 @@
 import base64
-import random
+import hashlib
+import hmac
 import string
 import uuid
 
@@ -28,6 +29,8 @@ class OpenstackEnvironment(BaseEnvironmentHandler):
     VM. The IP, credentials, etc. for this VM are then used by the platform
     handler to interact with the container platform.
     """
+    ephemeral = True
+
     def __init__(self, env_config):
         """Function to initialize the environment handler
 
@@ -52,6 +55,9 @@ class OpenstackEnvironment(BaseEnvironmentHandler):
 
         This function connects to OpenStack, creates the server, assigns a
         floating IP to it, and then waits until it can be reached via SSH.
+        The "ssh_wait_time" key of the host config sets how many seconds to
+        wait for SSH (30 by default), and "wait_for_cloud_init" whether to
+        also wait until cloud-init has finished.
 
         """
         self.osp_conn, self.neutron, self.tenant = \
@@ -64,7 +70,55 @@ class OpenstackEnvironment(BaseEnvironmentHandler):
         ip = self.fip['floatingip']['floating_ip_address']
         self.set_required_data(self.server_name, ip, self.username,
                                self.password, None, 22)
-        run.wait_for_ssh(ip, self.username, self.password)
+        self.fresh_host = True
+        wait_time = self.host_conf.get('ssh_wait_time', 30)
+        cloud_init = self.host_conf.get('wait_for_cloud_init', False)
+        self.ssh_connection = run.wait_for_ssh(ip, self.username,
+                                               self.password,
+                                               wait_time=wait_time,
+                                               wait_for_cloud_init=cloud_init)
+
+    def checkpoint(self):
+        """Returns the details needed to reattach to the server
+
+        Returns:
+            dict: The host details, plus the IDs of the server and its
+                floating IP
+        """
+        details = super(OpenstackEnvironment, self).checkpoint()
+        details['server_id'] = self.server_id
+        details['floating_ip_id'] = self.fip['floatingip']['id']
+        return details
+
+    def restore(self, details):
+        """Reattaches to the server created by a previous run
+
+        Checks that the server still exists and waits until it can be
+        reached via SSH.
+
+        Args:
+            details (dict): The details returned by checkpoint
+
+        Raises:
+            Exception: A generic exception if the server is gone or cannot
+                be reached
+
+        """
+        self.server_name = details['host_name']
+        self.password = self.generate_password()
+        super(OpenstackEnvironment, self).restore(details)
+        self.server_id = details['server_id']
+        self.fip = {'floatingip': {'id': details['floating_ip_id'],
+                                   'floating_ip_address': self.host_ip}}
+        self.osp_conn, self.neutron, self.tenant = \
+            self.setup_osp_conn(self.osp_conf)
+        if self.osp_conn.compute.find_server(self.server_id) is None:
+            msg = 'The server {0} of the previous run no longer exists'
+            raise Exception(msg.format(self.server_name))
+        wait_time = self.host_conf.get('ssh_wait_time', 30)
+        self.ssh_connection = run.wait_for_ssh(self.host_ip, self.username,
+                                               self.password,
+                                               wait_time=wait_time)
 
     def teardown(self):
         """Tear down the floating IP and server
@@ -72,6 +126,8 @@ class OpenstackEnvironment(BaseEnvironmentHandler):
         Delete the floating IP that was attached to the server then delete
         the server
         """
+        if self.ssh_connection is not None:
+            self.ssh_connection.close()
         fip_id = self.fip['floatingip']['id']
         self.neutron.delete_floatingip(fip_id)
         self.osp_conn.compute.delete_server(self.server_id)
@@ -118,15 +174,20 @@ class OpenstackEnvironment(BaseEnvironmentHandler):
         return conn, neutron, token
 
     def generate_password(self):
-        """Function to generate a random password
+        """Function to generate the password of the server
+
+        The password is derived from the server name and the OpenStack
+        password of the config, so a resumed run can compute it again
+        instead of recording it in the run state.
 
         Returns:
             str: The password string
         """
         characters = string.ascii_letters + string.punctuation + string.digits
-        password = ''.join(random.choice(characters) for x in
-                           range(random.randint(8, 18)))
-        return password
+        digest = hmac.new(str(self.osp_conf['password']), self.server_name,
+                          hashlib.sha512).digest()
+        return ''.join(characters[ord(c) % len(characters)]
+                       for c in digest[:16])
 
     def generate_user_data(self, user, password):
         """Function to generate the cloud-init user data string
@@ -1,11 +1,28 @@
+import functools
 import json
+import os
 import tempfile
+import threading
 import traceback
 
-from cvengine.util.ansible_handler import write_ansible_config, \
-        write_ansible_inventory
-from cvengine.util.fetch import fetch_remote_artifact
-from cvengine.util.run import run_ansible_cmd, run_cmd
+from cvengine.util import trace
+from cvengine.util.ansible_api import ANSIBLE_BACKENDS, AnsibleApiRunner
+from cvengine.util.artifacts import ArtifactArchive, ArtifactBudget, \
+        ArtifactCollector, DEFAULT_ARTIFACT_WORKERS, budget_result, \
+        container_copy_script, copy_planned, fetch_planned, \
+        local_file_sizes, local_size, parse_container_copy_output
+from cvengine.util.ansible_handler import fact_cache_sections, \
+        invalidate_facts, write_ansible_config, write_ansible_inventory
+from cvengine.util.fetch import SSHConnectionPool, fetch_remote_artifact, \
+        stat_remote_paths
+from cvengine.util.cache import DownloadCache
+from cvengine.util.image import ImagePull, image_archive_url, \
+        load_image_archive, pull_image, pullable
+from cvengine.util.remote import RemoteExecutor
+from cvengine.util.run import DEFAULT_TAIL_LINES, phase, run_cmd
+from cvengine.util.schedule import DEFAULT_PLAYBOOK_CONCURRENCY, \
+        PlaybookGraph
+from cvengine.util.sync import list_remote_files
 
 
 class BasePlatformHandler(object):
@@ -22,10 +39,72 @@ class BasePlatformHandler(object):
         EXEC_CMD_SUFFIX (str): The suffix of commands used to execute a
             command against a running container. The prefix should be set by
             a platform handler subclass.
+        ANSIBLE_PROFILE (str): The ansible config profile used for the
+            playbooks of the platform, which a scenario can override with its
+            "ansible_profile" key. See
+            cvengine.util.ansible_handler.ANSIBLE_CONFIG_PROFILES.
+        toolchain (dict): The paths and versions of the local tools (ansible,
+            oc, docker) as returned by cvengine.util.toolchain.get_toolchain.
+            Set by run_scenario from the cache directory of the config.
+        playbook_timeout (float): The default number of seconds each
+            playbook may run. Set from the "playbook_timeout" key of the
+            scenario, and overridden by the "timeout" key of a playbook entry.
+        ansible_profile (str): The ansible config profile used for the
+            playbooks. Set from the "ansible_profile" key of the scenario.
+        fact_cache_config (dict): The cache section of the config, used to
+            set up the ansible fact cache. The fact cache is not used if this
+            is None.
+        download_cache_config (dict): The cache section of the config, used
+            to set up the download cache that image archives are fetched
+            into. The default download cache is used if this is None.
+        fresh_host (bool): Whether the environment provisioned the host for
+            this run, in which case any cached facts for its address are
+            discarded
+        ssh_connection (:obj: `SSHClient`): The SSH connection the
+            environment opened to the host, if any. Added to the SSH pool so
+            the handler does not log in again.
+        ansible_backend (str): How playbooks are run. Either "cli" to run
+            ansible-playbook for each playbook, or "api" to run them through
+            the Ansible python API in a long-lived worker process. Set from
+            the "ansible_backend" key of the scenario.
+        playbook_concurrency (int): The most playbooks that run at the same
+            time, when their dependencies allow it (see
+            cvengine.util.schedule.PlaybookGraph). Set from the
+            "playbook_concurrency" key of the scenario.
+        ansible_runners (list): The idle workers running the playbooks when
+            the "api" backend is used. Each playbook running at the same time
+            gets a worker of its own.
+        prepull (bool): Whether the image under validation is pulled (or
+            loaded from an image archive) on the remote host in the
+            background while the platform is set up (see start_image_pull).
+            Set from the "prepull" key of the scenario.
+        image_pull_timeout (float): The number of seconds the pre-pull may
+            take, or None
+        image_pull (:obj: `ImagePull`): The running pre-pull, or None if it
+            was not started
+        image_pull_result (dict): The outcome of the pre-pull once a
+            playbook waited for it (see finish_image_pull), or None
+        run_state (:obj: `RunState`): Records the completed phases and
+            playbooks, so a failed run can be resumed. None if the run is
+            not recorded. See attach_run_state.
+        artifact_transfer_config (dict): The artifact_transfer section of the
+            config, with the keys "method" ("tar" or "scp"), "compression"
+            and "compression_level" used to fetch artifact directories (see
+            cvengine.util.fetch.fetch_remote_artifact), "workers", the byte
+            budgets "max_artifact_bytes" and "max_run_bytes" (see
+            cvengine.util.artifacts.ArtifactBudget), and "archive" to collect
+            the artifacts into one compressed archive.
+        ssh_pool (:obj: `SSHConnectionPool`): The SSH connections to the
+            remote host, shared by the remote executor and artifact fetching.
+            Closed at teardown.
+        remote_executor (:obj: `RemoteExecutor`): A persistent SSH session
+            to the remote host, used to run ad-hoc commands on it. Opened on
+            first use.
 
     """
 
     EXEC_CMD_SUFFIX = 'exec -i {0}'
+    ANSIBLE_PROFILE = 'fast'
 
     def __init__(self, host_test, environment,
                  artifacts, common_vars):
@@ -68,7 +147,26 @@ class BasePlatformHandler(object):
                                               dir='/tmp')
         self.extra_vars_file = tempfile.NamedTemporaryFile(prefix='extra_vars',
                                                            suffix='.json')
-        self.ansible_config_file = write_ansible_config()
+        self.ansible_profile = self.host_test.get('ansible_profile',
+                                                  self.ANSIBLE_PROFILE)
+        self.ansible_config_file = None
+        self.fact_cache_config = None
+        self.download_cache_config = None
+        self.artifact_transfer_config = {}
+        self.fresh_host = getattr(environment, 'fresh_host', False)
+        self.ssh_connection = getattr(environment, 'ssh_connection', None)
+        self.toolchain = None
+        self.playbook_timeout = self.host_test.get('playbook_timeout')
+        self.ansible_backend = self.host_test.get('ansible_backend')
+        self.playbook_concurrency = self.host_test.get('playbook_concurrency')
+        self.ansible_runners = []
+        self._runner_lock = threading.Lock()
+        self.prepull = self.host_test.get('prepull')
+        self.image_pull_timeout = None
+        self.image_pull = None
+        self.image_pull_result = None
+        self._image_pull_lock = threading.Lock()
+        self.run_state = None
 
         ############################################################
         #                                                          #
@@ -83,6 +181,8 @@ class BasePlatformHandler(object):
         self.remote_host_creds = None
         self.ansible_inv = None
         ############################################################
+        self._ssh_pool = None
+        self._remote_executor = None
 
         self.extra_vars = {
             'instance_name': self.instance_name,
@@ -91,6 +191,153 @@ class BasePlatformHandler(object):
         self.extra_vars.update(self.host_test.get('common_vars', {}))
         self.extra_vars.update(common_vars)
 
+    def attach_run_state(self, run_state):
+        """Records the progress of the run, or resumes a previous one
+
+        If the run state comes from a previous run, the host_data_out
+        directory of that run is used again, so the artifacts its playbooks
+        left there are kept.
+
+        Args:
+            run_state (:obj: `RunState`): The state of the run
+
+        """
+        self.run_state = run_state
+        previous = run_state.data.get('host_data_out')
+        if previous and previous != self.host_data_out:
+            os.rmdir(self.host_data_out)
+            self.host_data_out = previous
+            self.extra_vars['host_data_out'] = previous
+        else:
+            run_state.set('host_data_out', self.host_data_out)
+
+    def phase_done(self, name):
+        """Returns whether a previous attempt of the run completed a phase
+
+        Args:
+            name (str): The name of the phase, such as "bootstrap"
+
+        Returns:
+            bool: True if the phase can be skipped
+        """
+        return self.run_state is not None and self.run_state.phase_done(name)
+
+    def complete_phase(self, name):
+        """Records that a phase was completed, if the run is recorded
+
+        Args:
+            name (str): The name of the phase
+        """
+        if self.run_state is not None:
+            self.run_state.complete_phase(name)
+
+    def start_image_pull(self):
+        """Starts pulling the image under validation on the remote host
+
+        The pull runs in the background while the platform is set up, so
+        the image is already on the host when the playbooks start. If the
+        image_url is the URL of an image archive, the archive is downloaded
+        into the download cache and loaded into docker on the host instead
+        (see cvengine.util.image.load_image_archive), with the compression
+        of the artifact transfer config. Nothing is pulled if pre-pulling is
+        disabled, for platforms running locally, or for other image_url
+        values, such as local paths. Platforms that have to install docker
+        first start the pull once it is installed.
+        """
+        image_url = self.extra_vars.get('image_url')
+        if not self.prepull or self.run_playbooks_locally or \
+                self.image_pull is not None:
+            return
+        if pullable(image_url):
+            pull = functools.partial(pull_image, self.run_host_cmd)
+        elif image_archive_url(image_url):
+            options = self.transfer_options()
+            pull = functools.partial(
+                load_image_archive, self.remote_executor,
+                DownloadCache.from_config(self.download_cache_config),
+                compression=options['compression'],
+                compression_level=options['compression_level'])
+        else:
+            return
+        print('Pre-pulling {0} on {1}'.format(image_url, self.remote_host))
+        self.image_pull = ImagePull(pull, image_url,
+                                    timeout=self.image_pull_timeout)
+        self.image_pull.start()
+
+    def finish_image_pull(self):
+        """Waits for the pre-pull and passes its outcome to the playbooks
+
+        Called before the container is deployed and before the first
+        playbook that needs the image, from whichever thread gets there
+        first. Later calls return right away.
+
+        The playbooks get the variables "image_pull_status" (one of
+        cvengine.util.image.IMAGE_PULL_STATUSES), "image_digest" and
+        "image_id". Playbooks validating an image archive can run the image
+        by its image_id once it was "loaded" or was "present" already. A
+        failed pull does not fail the run, the playbooks pulling the image
+        themselves report the problem.
+        """
+        with self._image_pull_lock:
+            if self.image_pull_result is not None:
+                return
+            if self.image_pull is None:
+                result = {'status': 'skipped', 'digest': None,
+                          'image_id': None}
+            else:
+                result = self.image_pull.wait()
+                msg = 'Pre-pull of {0} {1} in {2:.1f}s'
+                print(msg.format(self.image_pull.image_url, result['status'],
+                                 result['duration']))
+            self.extra_vars['image_pull_status'] = result['status']
+            self.extra_vars['image_digest'] = result['digest']
+            self.extra_vars['image_id'] = result['image_id']
+            self.image_pull_result = result
+
+    @property
+    def ssh_pool(self):
+        """SSHConnectionPool: The SSH connections to the remote host"""
+        if self._ssh_pool is None:
+            self._ssh_pool = SSHConnectionPool()
+            if self.ssh_connection is not None:
+                creds = self.remote_host_creds
+                self._ssh_pool.add(self.remote_host, creds,
+                                   self.ssh_connection,
+                                   port=creds.get('port', 22))
+        return self._ssh_pool
+
+    @property
+    def remote_executor(self):
+        """RemoteExecutor: The SSH session to the remote host"""
+        if self._remote_executor is None:
+            creds = self.remote_host_creds
+            self._remote_executor = RemoteExecutor(
+                self.remote_host, creds, port=creds.get('port', 22),
+                pool=self.ssh_pool)
+        return self._remote_executor
+
+    def run_host_cmd(self, cmd, sudo=True, tail_lines=DEFAULT_TAIL_LINES):
+        """Run an ad-hoc command on the host running the containers
+
+        Commands for remote hosts are sent over the persistent SSH session
+        of the remote executor. For platforms that run locally, the command
+        is executed in a local shell.
+
+        Args:
+            cmd (str): The shell command to be executed
+            sudo (bool, optional): Whether to execute the command on a remote
+                host with escalated privileges. Defaults to True.
+            tail_lines (int, optional): The number of output lines to return
+
+        Returns:
+            list: The last lines of output of the command
+
+        """
+        if self.run_playbooks_locally:
+            return run_cmd(cmd, tail_lines=tail_lines)
+        return self.remote_executor.run(cmd, sudo=sudo,
+                                        tail_lines=tail_lines)
+
     def deploy_container(self):
         """Deploy the container onto the target platform
 
@@ -105,20 +352,22 @@ class BasePlatformHandler(object):
         """
         raise NotImplementedError()
 
-    def dump_extra_vars(self, extra_vars):
+    def dump_extra_vars(self, extra_vars, path=None):
         """Write the extra variables to a file
 
         Helper function to write playbook variables to a file on disk. The
-        path to this file is sent to each playbook using the --extra-vars
-        argument. This file is updated/overwritten for each playbook that
-        gets executed.
+        path to this file is sent to the playbook using the --extra-vars
+        argument. Each playbook gets a file of its own, so playbooks running
+        at the same time do not overwrite each other's variables.
 
         Args:
             extra_vars (dict): Dictionary containing variables to be written
                 to the file.
+            path (str, optional): The file to write. Defaults to
+                extra_vars_file.
 
         """
-        with open(self.extra_vars_file.name, 'w') as f:
+        with open(path or self.extra_vars_file.name, 'w') as f:
             json.dump(extra_vars, f)
 
     def setup(self):
@@ -128,7 +377,21 @@ class BasePlatformHandler(object):
         is intended to be used when some level of setup/initialization
         is necessary to prepare the container platform. Not all platforms
         will make use of this.
+
+        The base implementation writes the ansible config and inventory.
         """
+        sections = {}
+        if self.fact_cache_config is not None:
+            port = None
+            if not self.run_playbooks_locally and self.remote_host_creds:
+                port = self.remote_host_creds.get('port') or 22
+            sections = fact_cache_sections(self.fact_cache_config, port)
+            if sections and self.fresh_host and self.remote_host:
+                invalidate_facts(self.fact_cache_config, self.remote_host,
+                                 port)
+        self.ansible_config_file = write_ansible_config(
+            sections=sections, profile=self.ansible_profile)
+
         if self.run_playbooks_locally:
             self.ansible_inv = 'localhost, '
         else:
@@ -142,40 +405,140 @@ class BasePlatformHandler(object):
         either locally or on a remote machine (depending on the platform). It
         then deploys the container (if applicable), and finally executes the
         playbooks enumerated in the metadata file (passing in any applicable
-        variables)
+        variables). Playbooks run in the order of their dependencies, and
+        independent ones run at the same time (see
+        cvengine.util.schedule.PlaybookGraph). The critical path of the
+        playbooks is printed at the end. Playbooks that passed in a previous
+        attempt of the run are not run again. Playbooks whose entry sets
+        "needs_image" to false start without waiting for the pre-pull of
+        the image, the others (and the container deploy) wait for it (see
+        finish_image_pull).
 
         Raises:
+            ValueError: If the playbook dependencies are invalid
             Exception: A generic exception if any of the playbooks fail
 
         """
-        run_ansible_cmd('mkdir {0}'.format(self.extra_vars['host_data_out']),
-                        self.ansible_inv,
-                        self.ansible_config_file,
-                        local=self.run_playbooks_locally)
+        graph = PlaybookGraph(self.playbooks)
+        host_data_out = self.extra_vars['host_data_out']
+        self.run_host_cmd('mkdir -p {0}'.format(host_data_out))
 
         do_container_deploy = self.host_test.get('do_container_deploy', False)
         if do_container_deploy:
+            self.finish_image_pull()
             self.deploy_container()
 
-        for playbook in self.playbooks:
-            print('Running playbook: ' + playbook['url'])
+        if self.ansible_backend not in ANSIBLE_BACKENDS:
+            msg = ('{0} is not a valid ansible_backend. Supported values '
+                   'are: {1}')
+            raise ValueError(msg.format(self.ansible_backend,
+                                        ANSIBLE_BACKENDS))
+        concurrency = self.playbook_concurrency
+        if concurrency is None:
+            concurrency = DEFAULT_PLAYBOOK_CONCURRENCY
+        completed = []
+        on_passed = None
+        if self.run_state is not None:
+            completed = [name for name in graph.names
+                         if self.run_state.playbook_done(name)]
+            on_passed = self.run_state.complete_playbook
+        try:
+            with trace.span('playbooks', count=len(graph.names),
+                            concurrency=concurrency,
+                            resumed=len(completed)) as span:
+                results = graph.run(self.run_playbook_entry, concurrency,
+                                    completed=completed, on_passed=on_passed)
+                path, seconds = graph.critical_path(results)
+                span.set('critical_path', path)
+        finally:
+            while self.ansible_runners:
+                self.ansible_runners.pop().close()
+
+        for name in graph.names:
+            result = results[name]
+            duration = ''
+            if 'start' in result:
+                duration = ' in {0:.1f}s'.format(result['end'] -
+                                                 result['start'])
+            elif result.get('resumed'):
+                duration = ' in a previous run'
+            print('Playbook {0}: {1}{2}'.format(name, result['status'],
+                                                duration))
+        if path:
+            print('Critical path ({0:.1f}s): {1}'.format(
+                seconds, ' -> '.join(path)))
+        failed = [name for name in graph.names
+                  if results[name]['status'] == 'failed']
+        if failed:
+            print('Playbook failed, stopping execution.')
+            raise results[failed[0]]['error']
+
+    def run_playbook_entry(self, playbook):
+        """Run a playbook entry of the metadata file
+
+        The playbook gets its own extra vars file, holding the common
+        variables updated with the "vars" of the entry. Unless the entry
+        sets "needs_image" to false, the playbook first waits for the
+        pre-pull of the image.
+
+        Args:
+            playbook (dict): The playbook entry
+
+        """
+        if playbook.get('needs_image', True):
+            self.finish_image_pull()
+        print('Running playbook: ' + playbook['url'])
+        playbook_extra_vars = self.extra_vars.copy()
+        playbook_extra_vars.update(playbook.get('vars', {}))
+        with tempfile.NamedTemporaryFile(prefix='extra_vars',
+                                         suffix='.json') as extra_vars_file:
+            self.dump_extra_vars(playbook_extra_vars, extra_vars_file.name)
+            timeout = playbook.get('timeout', self.playbook_timeout)
+            with trace.span('playbook', url=playbook['url'],
+                            host=self.remote_host or 'localhost'), \
+                    phase(timeout):
+                self.run_playbook(playbook['local_path'],
+                                  playbook_extra_vars, extra_vars_file.name)
+
+    def run_playbook(self, path, extra_vars, extra_vars_file=None):
+        """Run a single playbook with the configured ansible backend
 
-            playbook_extra_vars = self.extra_vars.copy()
-            playbook_extra_vars.update(playbook.get('vars', {}))
-            self.dump_extra_vars(playbook_extra_vars)
+        Args:
+            path (str): The local path to the playbook
+            extra_vars (dict): The extra variables for the playbook. These
+                must already have been written to the extra vars file.
+            extra_vars_file (str, optional): The path of the extra vars file.
+                Defaults to extra_vars_file.
 
+        """
+        if self.ansible_backend == 'api':
+            runner = self.acquire_ansible_runner()
             try:
-                path = playbook['local_path']
-                ev = '@{0}'.format(self.extra_vars_file.name)
-                cmd = self.ansible_cmd.format(cfg=self.ansible_config_file,
-                                              inventory=self.ansible_inv,
-                                              playbook_path=path,
-                                              extra_vars_file=ev)
-                run_cmd(cmd)
-            except Exception:
-                print('Playbook failed, stopping execution.')
-                print(traceback.format_exc())
-                raise
+                runner.run_playbook(path, extra_vars)
+            finally:
+                with self._runner_lock:
+                    self.ansible_runners.append(runner)
+            return
+        ev = '@{0}'.format(extra_vars_file or self.extra_vars_file.name)
+        cmd = self.ansible_cmd.format(cfg=self.ansible_config_file,
+                                      inventory=self.ansible_inv,
+                                      playbook_path=path,
+                                      extra_vars_file=ev)
+        run_cmd(cmd)
+
+    def acquire_ansible_runner(self):
+        """Takes an idle ansible API worker, or starts a new one
+
+        Returns:
+            AnsibleApiRunner: The worker. Append it to ansible_runners once
+                the playbook finished.
+        """
+        with self._runner_lock:
+            if self.ansible_runners:
+                return self.ansible_runners.pop()
+        connection = 'local' if self.run_playbooks_locally else 'smart'
+        return AnsibleApiRunner(self.ansible_inv, self.ansible_config_file,
+                                connection=connection)
 
     def teardown(self, artifacts_directory):
         """Perform cleanup and teardown steps
@@ -191,44 +554,267 @@ class BasePlatformHandler(object):
                 artifacts should be written to.
 
         """
-        if self.artifacts and 'container_artifacts' in self.artifacts:
-            print('Copying container artifacts to host')
-            for artifact in self.artifacts['container_artifacts']:
-                docker_cp = '{0} {1}:{2} {3}'.format(self.fetch_artifact_cmd,
-                                                     self.instance_name,
-                                                     artifact,
-                                                     self.host_data_out)
-                try:
-                    run_ansible_cmd(docker_cp,
-                                    self.ansible_inv, self.ansible_config_file)
-                except Exception:
-                    pass  # Not grounds for had fail if nonexistent dir
-
-            print('Fetching container artifacts from host')
-            try:
-                port = self.remote_host_creds['port']
-                fetch_remote_artifact(self.remote_host,
-                                      self.remote_host_creds,
-                                      self.host_data_out,
-                                      artifacts_directory,
-                                      target_port=port)
-            except Exception:
-                print traceback.format_exc()
-                raise
-
-        if self.artifacts and 'test_host_artifacts' in self.artifacts:
-            for artifact in self.artifacts['test_host_artifacts']:
-                try:
-                    print('Fetching container artifacts from host')
-                    if self.run_playbooks_locally:
-                        cmd = 'cp -r {0} {1}'.format(artifact,
-                                                     artifacts_directory)
-                        run_ansible_cmd(cmd, local=True)
-                    else:
-                        port = self.remote_host_creds['port']
-                        fetch_remote_artifact(self.remote_host,
-                                              self.remote_host_creds, artifact,
-                                              artifacts_directory,
-                                              target_port=port)
-                except Exception:
-                    pass  # Not grounds for had fail if nonexistent dir
+        if self.image_pull is not None:
+            self.image_pull.cancel()
+        try:
+            self.fetch_artifacts(artifacts_directory)
+        finally:
+            if self._ssh_pool is not None:
+                self._ssh_pool.close()
+
+    def transfer_options(self):
+        """Returns the options for fetching artifacts from the remote host
+
+        Returns:
+            dict: The transfer, compression and compression_level arguments
+                of fetch_remote_artifact
+        """
+        config = self.artifact_transfer_config
+        return {'transfer': config.get('method', 'tar'),
+                'compression': config.get('compression', 'auto'),
+                'compression_level': config.get('compression_level')}
+
+    def fetch_artifacts(self, artifacts_directory):
+        """Fetch the artifacts of the container validation
+
+        The test host artifacts are fetched in parallel on a bounded worker
+        pool while the container artifacts are copied to the host, which
+        happens in a single command. The host_data_out directory holding the
+        container artifacts is then fetched as well. The outcome of every
+        artifact is written to the artifacts manifest (see
+        cvengine.util.artifacts.ArtifactCollector).
+
+        If byte budgets are configured, artifacts that do not fit are
+        truncated or skipped, and if "archive" is set they are streamed into
+        one compressed archive instead of the artifacts directory.
+
+        Args:
+            artifacts_directory (str): Location on the local machine that
+                artifacts should be written to.
+
+        Raises:
+            Exception: A generic exception if the container artifacts could
+                not be fetched from the host
+
+        """
+        artifacts = self.artifacts or {}
+        config = self.artifact_transfer_config
+        collector = ArtifactCollector(
+            workers=config.get('workers', DEFAULT_ARTIFACT_WORKERS))
+        budget = ArtifactBudget(config.get('max_artifact_bytes'),
+                                config.get('max_run_bytes'))
+        archive = None
+        if config.get('archive', False) and artifacts:
+            archive = ArtifactArchive(artifacts_directory,
+                                      config.get('compression_level'))
+        try:
+            if 'test_host_artifacts' in artifacts:
+                print('Fetching test host artifacts')
+                self.submit_host_artifacts(
+                    collector, 'test_host', artifacts['test_host_artifacts'],
+                    artifacts_directory, budget, archive)
+
+            if 'container_artifacts' in artifacts:
+                print('Copying container artifacts to host')
+                self.copy_container_artifacts(
+                    collector, artifacts['container_artifacts'])
+                print('Fetching container artifacts from host')
+                self.submit_host_artifacts(collector, 'host_data_out',
+                                           [self.host_data_out],
+                                           artifacts_directory, budget,
+                                           archive)
+        finally:
+            collector.join()
+            if archive is not None:
+                archive.close()
+            if collector.entries:
+                collector.write_manifest(artifacts_directory)
+
+        failed = collector.failed('host_data_out')
+        if failed:
+            msg = 'Unable to fetch the container artifacts from {0}: {1}'
+            raise Exception(msg.format(self.remote_host or 'localhost',
+                                       failed[0]['error']))
+
+    def copy_container_artifacts(self, collector, paths):
+        """Copy artifacts out of the container into host_data_out
+
+        All artifacts are copied by one command on the host, which reports
+        the status of each.
+
+        Args:
+            collector (:obj: `ArtifactCollector`): Records the outcome of
+                each copy
+            paths (list): The paths of the artifacts in the container
+
+        """
+        script = container_copy_script(self.fetch_artifact_cmd,
+                                       self.instance_name, paths,
+                                       self.host_data_out)
+        try:
+            with trace.span('artifact.container_copy', count=len(paths),
+                            container=self.instance_name):
+                lines = self.run_host_cmd(script,
+                                          tail_lines=len(paths) + 20)
+        except Exception:
+            print(traceback.format_exc())
+            lines = []
+        for result in parse_container_copy_output(lines, paths):
+            collector.record('container', result['path'], result['status'],
+                             size=result['bytes'], seconds=result['seconds'],
+                             error=result['error'])
+
+    def submit_host_artifacts(self, collector, kind, paths,
+                              artifacts_directory, budget=None, archive=None):
+        """Fetch artifacts from the host running the containers in parallel
+
+        Remote paths are looked up with one batched request first, and
+        missing ones are recorded without being fetched.
+
+        Args:
+            collector (:obj: `ArtifactCollector`): Runs the fetches
+            kind (str): The kind of the artifacts, for the manifest
+            paths (list): The paths of the artifacts on the host
+            artifacts_directory (str): Location on the local machine that
+                artifacts should be written to.
+            budget (:obj: `ArtifactBudget`, optional): Limits the bytes
+                fetched
+            archive (:obj: `ArtifactArchive`, optional): Collects the
+                artifacts instead of the artifacts directory
+
+        """
+        remote_paths = {}
+        if not self.run_playbooks_locally:
+            remote_paths = self.stat_remote_artifacts(paths)
+        for path in paths:
+            destination = os.path.join(artifacts_directory,
+                                       os.path.basename(path.rstrip('/')))
+            file_type = remote_paths.get(path, {}).get('type')
+            if self.run_playbooks_locally and not os.path.lexists(path):
+                file_type = 'DoesNotExist'
+            if file_type == 'DoesNotExist':
+                collector.record(kind, path, 'missing',
+                                 error=remote_paths.get(path, {}).get(
+                                     'error', 'The path does not exist'))
+                continue
+            collector.submit(kind, path, functools.partial(
+                self.fetch_host_artifact, path, artifacts_directory,
+                destination, file_type, budget, archive,
+                split=path == self.host_data_out))
+
+    def fetch_host_artifact(self, path, artifacts_directory, destination,
+                            file_type=None, budget=None, archive=None,
+                            split=False):
+        """Fetch a single artifact from the host running the containers
+
+        Args:
+            path (str): The path of the artifact on the host
+            artifacts_directory (str): The local directory to fetch it into
+            destination (str): The local path the artifact ends up at
+            file_type (str, optional): The type of the remote path, if known
+            budget (:obj: `ArtifactBudget`, optional): Limits the bytes
+                fetched
+            archive (:obj: `ArtifactArchive`, optional): Collects the
+                artifact instead of the artifacts directory
+            split (bool, optional): Each top level entry of the artifact is
+                an artifact of its own for the per artifact budget
+
+        Returns:
+            int: The size of the fetched artifact in bytes, or the result of
+                cvengine.util.artifacts.budget_result if a budget or archive
+                is used
+
+        """
+        if archive is not None or (budget is not None and budget.limited):
+            return self.fetch_planned_artifact(path, artifacts_directory,
+                                               destination, file_type,
+                                               budget or ArtifactBudget(),
+                                               archive, split)
+        if self.run_playbooks_locally:
+            run_cmd('cp -r {0} {1}'.format(path, artifacts_directory))
+        else:
+            fetch_remote_artifact(self.remote_host, self.remote_host_creds,
+                                  path, artifacts_directory,
+                                  target_port=self.remote_host_creds['port'],
+                                  pool=self.ssh_pool, file_type=file_type,
+                                  **self.transfer_options())
+        return local_size(destination)
+
+    def fetch_planned_artifact(self, path, artifacts_directory, destination,
+                               file_type, budget, archive=None, split=False):
+        """Fetch an artifact within the byte budgets, or into an archive
+
+        The files of the artifact are listed first and planned with the
+        budget. An artifact that fits is fetched as usual unless it goes
+        into the archive.
+
+        Args:
+            path (str): The path of the artifact on the host
+            artifacts_directory (str): The local directory to fetch it into
+            destination (str): The local path the artifact ends up at
+            file_type (str): The type of the remote path, if known
+            budget (:obj: `ArtifactBudget`): Limits the bytes fetched
+            archive (:obj: `ArtifactArchive`, optional): Collects the
+                artifact instead of the artifacts directory
+            split (bool, optional): Each top level entry of the artifact is
+                an artifact of its own for the per artifact budget
+
+        Raises:
+            SyncUnavailable: If the remote host has no GNU find to list the
+                files of the artifact
+
+        Returns:
+            dict: The result of cvengine.util.artifacts.budget_result
+
+        """
+        ssh = None
+        if self.run_playbooks_locally:
+            sizes = local_file_sizes(path)
+        else:
+            creds = self.remote_host_creds
+            ssh = self.ssh_pool.get(self.remote_host, creds,
+                                    port=creds['port'])
+            sizes = dict((name, size) for name, (size, _) in
+                         list_remote_files(ssh, path).items())
+        plan = budget.plan(sizes, split=split)
+        used = 0
+        try:
+            if archive is None and not plan['truncated'] and \
+                    not plan['skipped']:
+                used = self.fetch_host_artifact(path, artifacts_directory,
+                                                destination, file_type)
+            elif ssh is None:
+                used = copy_planned(path, artifacts_directory, plan, archive)
+            else:
+                options = self.transfer_options()
+                used = fetch_planned(ssh, path, artifacts_directory, plan,
+                                     archive, options['compression'],
+                                     options['compression_level'])
+        finally:
+            budget.release(plan, used)
+        return budget_result(plan, used)
+
+    def stat_remote_artifacts(self, paths):
+        """Look up the type and size of artifacts on the remote host
+
+        All paths are looked up with a single batched SFTP request.
+
+        Args:
+            paths (list): The remote paths of the artifacts
+
+        Returns:
+            dict: The result of cvengine.util.fetch.stat_remote_paths, or an
+                empty dictionary if the lookup failed, in which case each
+                artifact is looked up when it is fetched.
+
+        """
+        creds = self.remote_host_creds
+        try:
+            with trace.span('artifact.stat', host=self.remote_host,
+                            paths=len(paths)):
+                ssh = self.ssh_pool.get(self.remote_host, creds,
+                                        port=creds['port'])
+                return stat_remote_paths(ssh, paths)
+        except Exception:
+            print(traceback.format_exc())
+            return {}
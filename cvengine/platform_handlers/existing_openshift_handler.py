@@ -43,11 +43,8 @@ class ExistingOpenshiftHandler(BasePlatformHandler):
                                                        self.EXEC_CMD_SUFFIX)
         self.fetch_artifact_cmd = '{0} rsync'.format(oc_path)
 
-        self.ansible_data = {
-            'host': 'localhost'
-        }
         self.run_playbooks_locally = True
         self.ansible_cmd = ('export ANSIBLE_HOST_KEY_CHECKING=False; '
                             'ansible-playbook '
-                            '-v -i "{host}," -c local {playbook_path} '
+                            '-v -i "{inventory}" -c local {playbook_path} '
                             '--extra-vars "{extra_vars_file}"')
@@ -1,5 +1,7 @@
 from atomic_host_handler import AtomicHostHandler
-from cvengine.util.run import run_ansible_cmd
+from cvengine.util import trace
+from cvengine.util.bootstrap import BOOTSTRAP_MARKER, bootstrap_script, \
+    parse_bootstrap_output
 
 
 class FedoraHandler(AtomicHostHandler):
@@ -10,28 +12,86 @@ class FedoraHandler(AtomicHostHandler):
     needs to be bootstrapped with docker installed and running. Once
     that condition is met, the container validation is the same as for an
     Atomic Host, so this class subclassed the AtomicHostHandler.
+
+    Attributes:
+        DOCKER_BOOTSTRAP_STEPS (list): The steps installing and starting
+            docker, as taken by bootstrap_script. They run first, so the
+            image can be pulled while the other steps run.
+        BOOTSTRAP_STEPS (list): The other steps bringing the host into a
+            state where playbooks can run against it
+        DOCKER_BOOTSTRAP_MARKER (str): The fingerprint marker of the docker
+            steps on the host
+        bootstrapped (bool): Whether docker was installed and started on
+            the host, so the image can be pulled
     """
+    DOCKER_BOOTSTRAP_STEPS = [
+        {'name': 'docker', 'packages': ['docker']},
+        {'name': 'docker enabled', 'probe': 'systemctl is-enabled docker',
+         'apply': 'systemctl enable docker'},
+        {'name': 'docker running', 'probe': 'systemctl is-active docker',
+         'apply': 'systemctl start docker'},
+    ]
+    BOOTSTRAP_STEPS = [
+        {'name': 'python2', 'packages': ['python2']},
+    ]
+    DOCKER_BOOTSTRAP_MARKER = '/var/lib/cvengine/docker-bootstrap.fingerprint'
+
+    def __init__(self, host_test, environment,
+                 artifacts, common_vars):
+
+        super(FedoraHandler, self).__init__(host_test, environment,
+                                            artifacts, common_vars)
+        self.bootstrapped = False
+
+    def start_image_pull(self):
+        """Starts pulling the image once the bootstrap installed docker"""
+        if self.bootstrapped:
+            super(FedoraHandler, self).start_image_pull()
 
     def setup(self):
         """Setup function for Fedora hosts
 
         This function performs the necessary steps to bootstrap the remote
-        Fedora host to run containers. Specifically, we install python2
-        (necessary to be able to run more ansible commands against the host,
-        then install, enable, and start Docker.
+        Fedora host to run containers. Specifically, we install, enable, and
+        start Docker, then install python2 (necessary to be able to run
+        ansible playbooks against the host). Each group of steps is run as a
+        single script over the SSH session of the remote executor: steps
+        that are already satisfied are skipped, the missing packages are
+        installed in one transaction, and a fingerprint of the steps is left
+        on the host so later runs against the same host skip them
+        altogether. A resumed run skips the bootstrap if the previous
+        attempt completed it.
+
+        The pre-pull of the image starts as soon as docker is running, and
+        goes on while the remaining steps run.
         """
         super(AtomicHostHandler, self).setup()
 
-        # Bootstrap the node to ensure python2 is installed
-        run_ansible_cmd('dnf -y install python2',
-                        self.ansible_inv,
-                        self.ansible_config_file,
-                        module='raw')
-
-        commands = ['dnf -y install docker',
-                    'systemctl enable docker',
-                    'systemctl start docker']
-        for command in commands:
-            run_ansible_cmd(command,
-                            self.ansible_inv,
-                            self.ansible_config_file)
+        if self.phase_done('bootstrap'):
+            print('Host was bootstrapped by a previous run, skipping')
+            self.bootstrapped = True
+            self.start_image_pull()
+            return
+        self.bootstrap(self.DOCKER_BOOTSTRAP_STEPS,
+                       self.DOCKER_BOOTSTRAP_MARKER)
+        self.bootstrapped = True
+        self.start_image_pull()
+        self.bootstrap(self.BOOTSTRAP_STEPS, BOOTSTRAP_MARKER)
+        self.complete_phase('bootstrap')
+
+    def bootstrap(self, steps, marker):
+        """Runs bootstrap steps on the host
+
+        Args:
+            steps (list): The bootstrap steps
+            marker (str): The path of their fingerprint marker on the host
+        """
+        with trace.span('bootstrap', steps=len(steps)):
+            lines = self.run_host_cmd(bootstrap_script(steps, marker=marker))
+        status, applied = parse_bootstrap_output(lines)
+        if status == 'skipped':
+            print('Host was bootstrapped with the same steps before, skipping')
+        elif applied:
+            print('Bootstrapped host: {0}'.format(', '.join(applied)))
+        else:
+            print('Host already satisfied all bootstrap steps')
@@ -0,0 +1,124 @@
+import importlib
+
+
+class HandlerRegistry(object):
+    """Maps handler names to handler classes, importing them on first use
+
+    Handlers are registered either as classes or as dotted paths in the
+    "package.module:ClassName" form. A handler registered by path is only
+    imported when it is first looked up, so the dependencies of handlers
+    that a run does not use (such as the OpenStack clients) are never
+    imported.
+
+    Handlers provided by other packages are discovered through setuptools
+    entry points in the registry's entry point group, for example:
+
+        entry_points={
+            'cvengine.platform_handlers': [
+                'myplatform = mypackage.handler:MyPlatformHandler'
+            ]
+        }
+
+    Entry points are only scanned when a name is not registered directly.
+
+    Attributes:
+        entry_point_group (str): The setuptools entry point group that is
+            searched for additional handlers
+    """
+    def __init__(self, entry_point_group, handlers=None):
+        """
+        Args:
+            entry_point_group (str): The setuptools entry point group
+            handlers (dict, optional): Handlers to register, keyed by name
+        """
+        self.entry_point_group = entry_point_group
+        self._handlers = {}
+        self._entry_points_loaded = False
+        for name, handler in (handlers or {}).items():
+            self.register(name, handler)
+
+    def register(self, name, handler):
+        """Registers a handler under a name
+
+        Args:
+            name (str): The name the handler is selected by
+            handler (type or str): The handler class, or its dotted path in
+                the "package.module:ClassName" form
+
+        """
+        self._handlers[name] = handler
+
+    def get(self, name, default=None):
+        """Returns the handler class registered under a name
+
+        Args:
+            name (str): The name of the handler
+            default (optional): The value to return if no handler is
+                registered under the name
+
+        Returns:
+            type: The handler class
+        """
+        if name not in self:
+            return default
+        handler = self._handlers[name]
+        if not isinstance(handler, type):
+            handler = resolve(handler)
+            self._handlers[name] = handler
+        return handler
+
+    def keys(self):
+        """Returns the names of all available handlers
+
+        Returns:
+            list: The handler names
+        """
+        self._load_entry_points()
+        return sorted(self._handlers.keys())
+
+    def __contains__(self, name):
+        if name not in self._handlers:
+            self._load_entry_points()
+        return name in self._handlers
+
+    def __getitem__(self, name):
+        handler = self.get(name)
+        if handler is None:
+            msg = ('{0} is not a registered handler. Available handlers '
+                   'are: {1}')
+            raise KeyError(msg.format(name, self.keys()))
+        return handler
+
+    def _load_entry_points(self):
+        if self._entry_points_loaded:
+            return
+        self._entry_points_loaded = True
+        try:
+            import pkg_resources
+        except ImportError:
+            return
+        for entry_point in pkg_resources.iter_entry_points(
+                self.entry_point_group):
+            if entry_point.name not in self._handlers:
+                self._handlers[entry_point.name] = entry_point
+
+
+def resolve(handler):
+    """Imports the object a handler reference points to
+
+    Args:
+        handler (str or :obj: `pkg_resources.EntryPoint`): Either a dotted
+            path in the "package.module:ClassName" or
+            "package.module.ClassName" form, or a setuptools entry point
+
+    Returns:
+        type: The handler class
+    """
+    if hasattr(handler, 'load'):
+        return handler.load()
+    if ':' in handler:
+        module_name, attribute = handler.split(':', 1)
+    else:
+        module_name, attribute = handler.rsplit('.', 1)
+    module = importlib.import_module(module_name)
+    return getattr(module, attribute)
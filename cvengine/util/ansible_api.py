@@ -0,0 +1,240 @@
+import json
+import os
+import signal
+import sys
+import time
+import traceback
+
+from collections import deque
+from multiprocessing import Pipe, Process
+
+from . import trace
+from .run import CommandError, CommandTimeout, DEFAULT_TAIL_LINES, \
+    KILL_GRACE_PERIOD, POLL_INTERVAL, check_deadline, command_deadline, \
+    command_log_path, open_log
+
+
+ANSIBLE_BACKENDS = ('cli', 'api')
+
+
+class AnsibleApiRunner(object):
+    """Runs playbooks through the Ansible python API in a worker process
+
+    Running ansible-playbook once per playbook starts a new interpreter,
+    loads every Ansible plugin and parses the inventory and config each
+    time. The runner instead starts one worker process that loads Ansible
+    once and keeps the inventory and connection plugins (including open ssh
+    control connections) for all of the playbooks it runs.
+
+    The worker reports the progress of each playbook as structured events
+    (see cvengine.util.ansible_worker.EventCallback). The events are written
+    as json lines to the command log, and a one line summary of each task
+    result is printed.
+
+    The worker runs in its own process group, which is killed if a playbook
+    exceeds its timeout or the run is cancelled. A new worker is started
+    for the next playbook.
+
+    Attributes:
+        inventory (str): An inventory path or a comma separated host list
+        ansible_config (str): The path to the Ansible config file
+        connection (str): The connection plugin to use
+        forks (int): The number of hosts to run tasks on at once
+    """
+    def __init__(self, inventory, ansible_config, connection='smart',
+                 forks=None):
+        """
+        Args:
+            inventory (str): An inventory path or a comma separated host list
+            ansible_config (str): The path to the Ansible config file
+            connection (str, optional): The connection plugin to use.
+                Defaults to "smart".
+            forks (int, optional): The number of hosts to run tasks on at
+                once. Defaults to the forks setting of the Ansible config.
+        """
+        self.inventory = inventory
+        self.ansible_config = ansible_config
+        self.connection = connection
+        self.forks = forks
+        self._process = None
+        self._conn = None
+
+    def start(self):
+        """Starts the worker process if it is not running"""
+        if self._process is not None and self._process.is_alive():
+            return
+        self._conn, child_conn = Pipe()
+        self._process = Process(target=_worker_main,
+                                args=(child_conn, self.inventory,
+                                      self.ansible_config, self.connection,
+                                      self.forks))
+        self._process.start()
+        child_conn.close()
+
+    def close(self):
+        """Stops the worker process"""
+        if self._process is None:
+            return
+        try:
+            self._conn.send(None)
+        except (IOError, OSError):
+            pass
+        self._process.join(KILL_GRACE_PERIOD)
+        if self._process.is_alive():
+            self.terminate()
+        self._conn.close()
+        self._process = None
+
+    def terminate(self):
+        """Kills the worker process along with its children"""
+        for sig in (signal.SIGTERM, signal.SIGKILL):
+            try:
+                os.killpg(self._process.pid, sig)
+            except OSError:
+                break
+            self._process.join(KILL_GRACE_PERIOD)
+            if not self._process.is_alive():
+                break
+        self._conn.close()
+        self._process = None
+
+    def run_playbook(self, playbook_path, extra_vars, timeout=None,
+                     tail_lines=DEFAULT_TAIL_LINES):
+        """Runs a playbook in the worker process
+
+        Args:
+            playbook_path (str): The path to the playbook
+            extra_vars (dict): The extra variables for the playbook
+            timeout (float, optional): The number of seconds the playbook may
+                run. Defaults to the command timeout of the current thread.
+            tail_lines (int, optional): The number of summary lines to keep
+                in memory
+
+        Raises:
+            CommandError: If a task failed or a host was unreachable
+            CommandTimeout: If the playbook did not finish in time
+            Cancelled: If the run was cancelled while the playbook was running
+
+        Returns:
+            list: The events of the run
+
+        """
+        cmd = 'ansible-playbook {0}'.format(playbook_path)
+        print('Running playbook through the Ansible API: {0}'.format(
+            playbook_path))
+        log_path = command_log_path(cmd)
+        check_deadline()
+        deadline = command_deadline(timeout)
+        tail = deque(maxlen=tail_lines)
+        events = []
+
+        with trace.span('command', cmd=cmd, log=log_path,
+                        backend='api') as span:
+            self.start()
+            log_file = open_log(log_path)
+            try:
+                self._conn.send((playbook_path, extra_vars))
+                while True:
+                    if not self._conn.poll(POLL_INTERVAL):
+                        if deadline is not None and time.time() > deadline:
+                            raise CommandTimeout(cmd, list(tail), log_path)
+                        check_deadline()
+                        if not self._process.is_alive():
+                            raise CommandError(cmd, None, list(tail),
+                                               log_path,
+                                               reason='Ansible worker died')
+                        continue
+                    event = self._conn.recv()
+                    if event['event'] == 'done':
+                        rc = event['returncode']
+                        break
+                    if log_file:
+                        log_file.write(json.dumps(event) + '\n')
+                    if event['event'] == 'error':
+                        print(event['traceback'])
+                        tail.extend(event['traceback'].splitlines())
+                        continue
+                    events.append(event)
+                    line = format_event(event)
+                    if line is not None:
+                        sys.stdout.write(line + '\n')
+                        tail.append(line)
+            except BaseException:
+                if self._process is not None:
+                    self.terminate()
+                raise
+            finally:
+                if log_file:
+                    log_file.close()
+            span.set('returncode', rc)
+
+        if rc != 0:
+            print('Non-success return code: ' + str(rc))
+            raise CommandError(cmd, rc, list(tail), log_path)
+        return events
+
+
+def format_event(event):
+    """Returns a one line summary of a playbook event
+
+    Args:
+        event (dict): The event
+
+    Returns:
+        str: The summary, or None for events that are not summarized
+    """
+    if event['event'] == 'play_start':
+        return 'PLAY [{0}]'.format(event['play'])
+    if event['event'] == 'task_start':
+        return 'TASK [{0}]'.format(event['task'])
+    if event['event'] == 'runner_result':
+        line = '{0}: [{1}]'.format(event['status'], event['host'])
+        if event['status'] in ('failed', 'unreachable'):
+            msg = event['result'].get('msg')
+            if msg:
+                line += ' {0}'.format(msg)
+            if event.get('ignore_errors'):
+                line += ' (ignored)'
+        return line
+    if event['event'] == 'stats':
+        return 'PLAY RECAP ' + ', '.join(
+            '{0}: {1}'.format(host, ' '.join(
+                '{0}={1}'.format(k, v) for k, v in sorted(counts.items())))
+            for host, counts in sorted(event['stats'].items()))
+    return None
+
+
+def _worker_main(conn, inventory, ansible_config, connection, forks):
+    """Entry point of the worker process
+
+    Runs playbooks as they are requested through the connection until None
+    is received. Every event is sent back, followed by a "done" event with
+    the return code of the run, or an "error" event with a traceback.
+
+    Args:
+        conn (:obj: `Connection`): The connection to the parent process
+        inventory (str): An inventory path or a comma separated host list
+        ansible_config (str): The path to the Ansible config file
+        connection (str): The connection plugin to use
+        forks (int): The number of hosts to run tasks on at once
+
+    """
+    os.setsid()
+    os.environ['ANSIBLE_CONFIG'] = ansible_config
+    engine = None
+    while True:
+        request = conn.recv()
+        if request is None:
+            break
+        playbook_path, extra_vars = request
+        try:
+            if engine is None:
+                from .ansible_worker import PlaybookEngine
+                engine = PlaybookEngine(inventory, connection=connection,
+                                        forks=forks)
+            rc = engine.run(playbook_path, extra_vars, conn.send)
+            conn.send({'event': 'done', 'returncode': rc})
+        except Exception:
+            conn.send({'event': 'error', 'time': time.time(),
+                       'traceback': traceback.format_exc()})
+            conn.send({'event': 'done', 'returncode': None})
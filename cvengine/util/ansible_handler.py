@@ -1,5 +1,13 @@
+import errno
+import os
 import tempfile
 
+from .cache import DEFAULT_CACHE_DIRECTORY
+
+
+FACT_CACHE_DIRECTORY = 'facts'
+DEFAULT_FACT_CACHE_TIMEOUT = 24 * 60 * 60
+
 
 def write_ansible_inventory(host, user, ssh_key_path=None,
                             password=None, port=None):
@@ -54,37 +62,167 @@ def write_ansible_inventory(host, user, ssh_key_path=None,
     return inventory_file.name
 
 
-def write_ansible_config(options={}):
+def write_ansible_config(options={}, sections=None, profile=None):
     """Writes an ansible config file
 
     Creates a file on disk to be used as an ansible configuration file.
     This config disables ansible host key checking and forces ANSI color
-    output on the terminal. It additionally enables any options that
-    are passed in. Currently, this only supports setting additional options
-    under the [defaults] section of the ansible config.
+    output on the terminal. A named profile from ANSIBLE_CONFIG_PROFILES can
+    be applied on top of that, followed by any sections and options that
+    are passed in.
 
     Args:
-        options (dict, optional): A set of options to be passed in
+        options (dict, optional): A set of options for the [defaults]
+            section of the config
+        sections (dict, optional): Options for any section of the config,
+            keyed by section name, e.g. {'ssh_connection': {'pipelining':
+            'True'}}
+        profile (str, optional): The name of a profile in
+            ANSIBLE_CONFIG_PROFILES to apply
 
-    Todo:
-        * Add support for specifying ansible options under additional
-          sections of the config
+    Raises:
+        ValueError: If the profile does not exist
 
     Returns:
         str: The path to the config file
 
     """
-    default_options = {'host_key_checking': 'False',
-                       'force_color': '1'}
-    default_options.update(options)
+    config = {'defaults': {'host_key_checking': 'False',
+                           'force_color': '1'}}
+    if profile is not None:
+        if profile not in ANSIBLE_CONFIG_PROFILES:
+            msg = '{0} is not a valid ansible profile. Profiles are: {1}'
+            raise ValueError(msg.format(profile,
+                                        sorted(ANSIBLE_CONFIG_PROFILES)))
+        merge_config_sections(config, ANSIBLE_CONFIG_PROFILES[profile]())
+    merge_config_sections(config, sections or {})
+    merge_config_sections(config, {'defaults': options})
+
     config_file = tempfile.NamedTemporaryFile(prefix='ansible_config_',
                                               suffix='.cfg',
                                               delete=False)
-    config_data = '[defaults]'
-    for key, val in default_options.items():
-        config_data += '\n{0} = {1}'.format(key, val)
+    # [defaults] comes first, the other sections in alphabetical order
+    names = sorted(config, key=lambda name: (name != 'defaults', name))
+    config_data = []
+    for name in names:
+        config_data.append('[{0}]'.format(name))
+        for key, val in sorted(config[name].items()):
+            config_data.append('{0} = {1}'.format(key, val))
+        config_data.append('')
 
     with open(config_file.name, 'w') as f:
-        f.write(config_data)
+        f.write('\n'.join(config_data))
 
     return config_file.name
+
+
+def merge_config_sections(config, sections):
+    """Merges config sections into a config, overriding existing options
+
+    Args:
+        config (dict): The config to update, keyed by section name
+        sections (dict): The sections to merge in, keyed by section name
+
+    """
+    for name, options in sections.items():
+        config.setdefault(name, {}).update(options)
+
+
+def fast_profile():
+    """Returns the options of the "fast" ansible config profile
+
+    The profile reduces the SSH overhead of each task. Pipelining runs
+    modules without copying them to the host first, which saves an SSH
+    command per task. Facts are only gathered once per host. The persistent
+    control master that lets all tasks share one SSH connection is already
+    part of the Ansible defaults, with the sockets in ~/.ansible/cp.
+
+    Note that pipelining requires that "requiretty" is disabled in the
+    sudoers file of the host when using become.
+
+    Returns:
+        dict: The config options, keyed by section name
+    """
+    return {
+        'defaults': {'gathering': 'smart'},
+        'ssh_connection': {'pipelining': 'True'}
+    }
+
+
+def fact_cache_sections(cache_config, port=None):
+    """Returns the ansible config options that enable the fact cache
+
+    Facts are cached as one json file per host in the facts subdirectory of
+    the cache directory, so that playbooks only gather the facts of a host
+    when there are no cached facts for it that are younger than the
+    timeout. This applies across playbooks as well as across runs against
+    the same host.
+
+    Ansible names the cache files after the inventory hostname only. Hosts
+    that share an address but listen on different SSH ports (such as
+    forwarded ports on localhost) are different machines, so the facts of
+    each port are kept in a directory of their own.
+
+    Args:
+        cache_config (dict): The cache section of the config. The keys
+            "facts" (whether to cache facts, defaults to True) and
+            "fact_timeout" (the number of seconds cached facts stay valid,
+            defaults to a day) are used.
+        port (int, optional): The SSH port of the host. None for hosts that
+            are not reached over SSH, such as localhost for local playbooks.
+
+    Returns:
+        dict: The config options, keyed by section name. Empty if the fact
+            cache is disabled.
+    """
+    if not cache_config.get('facts', True):
+        return {}
+    timeout = cache_config.get('fact_timeout', DEFAULT_FACT_CACHE_TIMEOUT)
+    return {'defaults': {'gathering': 'smart',
+                         'fact_caching': 'jsonfile',
+                         'fact_caching_connection':
+                             fact_cache_directory(cache_config, port),
+                         'fact_caching_timeout': str(int(timeout))}}
+
+
+def fact_cache_directory(cache_config, port=None):
+    """Returns the directory holding the cached facts
+
+    Args:
+        cache_config (dict): The cache section of the config
+        port (int, optional): The SSH port of the hosts whose facts are
+            cached
+
+    Returns:
+        str: The path to the fact cache directory
+    """
+    directory = cache_config.get('directory') or os.environ.get(
+        'CV_CACHE_DIRECTORY', DEFAULT_CACHE_DIRECTORY)
+    directory = os.path.join(directory, FACT_CACHE_DIRECTORY)
+    if port is not None:
+        directory = os.path.join(directory, 'port-{0}'.format(port))
+    return directory
+
+
+def invalidate_facts(cache_config, host, port=None):
+    """Removes the cached facts of a host
+
+    This is used when a host was freshly provisioned, as a new host can
+    reuse the address of an earlier one.
+
+    Args:
+        cache_config (dict): The cache section of the config
+        host (str): The inventory name of the host
+        port (int, optional): The SSH port of the host
+
+    """
+    path = os.path.join(fact_cache_directory(cache_config, port), host)
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+# Functions returning the options of each ansible config profile
+ANSIBLE_CONFIG_PROFILES = {'fast': fast_profile}
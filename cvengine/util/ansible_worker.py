@@ -0,0 +1,225 @@
+"""Runs playbooks through the Ansible python API
+
+This module imports Ansible at the top level, and Ansible reads its
+configuration when it is first imported. It is therefore only imported by
+the worker process started by cvengine.util.ansible_api, after
+ANSIBLE_CONFIG has been set.
+"""
+import json
+import time
+
+from ansible import constants as C
+from ansible.executor.task_queue_manager import TaskQueueManager
+from ansible.inventory.manager import InventoryManager
+from ansible.parsing.dataloader import DataLoader
+from ansible.playbook import Playbook
+from ansible.plugins.callback import CallbackBase
+from ansible.vars.manager import VariableManager
+
+
+class PlaybookEngine(object):
+    """Runs many playbooks against the same inventory
+
+    The data loader and inventory are created once and reused for every
+    playbook, so the inventory is only parsed once. Each playbook gets a
+    variable manager of its own, holding its extra vars. As with the "cli"
+    backend, facts carry over from one playbook to the next through the
+    fact cache of the Ansible config.
+
+    Attributes:
+        loader (:obj: `DataLoader`): The Ansible data loader
+        inventory (:obj: `InventoryManager`): The parsed inventory
+        connection (str): The connection plugin to use
+        forks (int): The number of hosts to run tasks on at once
+    """
+    def __init__(self, inventory, connection='smart', forks=None):
+        """
+        Args:
+            inventory (str): An inventory path or a comma separated host list
+            connection (str, optional): The connection plugin to use
+            forks (int, optional): The number of hosts to run tasks on at
+                once. Defaults to the forks setting of the Ansible config.
+        """
+        self.loader = DataLoader()
+        self.inventory = InventoryManager(loader=self.loader,
+                                          sources=inventory)
+        self.connection = connection
+        if forks is None:
+            forks = C.DEFAULT_FORKS
+        self.forks = forks
+
+    def run(self, playbook_path, extra_vars, send):
+        """Runs a playbook
+
+        The plays of the playbook run in order until one of them fails,
+        like ansible-playbook does.
+
+        Args:
+            playbook_path (str): The path to the playbook
+            extra_vars (dict): The extra variables for the playbook
+            send (callable): Called with a dictionary for every event of the
+                run
+
+        Returns:
+            int: The return code of the run, 0 if all tasks succeeded
+        """
+        options = playbook_options(self.connection, self.forks, extra_vars)
+        variable_manager = VariableManager(loader=self.loader,
+                                           inventory=self.inventory)
+        if options is not None:
+            # Before Ansible 2.8, callers load the extra vars themselves
+            from ansible.utils.vars import load_extra_vars
+            variable_manager.extra_vars = load_extra_vars(
+                loader=self.loader, options=options)
+        callback = EventCallback(send)
+        kwargs = {'inventory': self.inventory,
+                  'variable_manager': variable_manager,
+                  'loader': self.loader,
+                  'passwords': {},
+                  'stdout_callback': callback}
+        if options is not None:
+            kwargs['options'] = options
+        else:
+            kwargs['forks'] = self.forks
+        tqm = TaskQueueManager(**kwargs)
+        rc = 0
+        try:
+            playbook = Playbook.load(playbook_path,
+                                     variable_manager=variable_manager,
+                                     loader=self.loader)
+            for play in playbook.get_plays():
+                rc = tqm.run(play)
+                if rc != 0:
+                    break
+        finally:
+            tqm.cleanup()
+            self.loader.cleanup_all_tmp_files()
+        callback.send_stats()
+        return rc
+
+
+def playbook_options(connection, forks, extra_vars):
+    """Sets the command line options Ansible expects a playbook run to have
+
+    The options are the defaults of ansible-playbook, so become and the
+    remote user come from the Ansible config and the inventory as they do
+    for the "cli" backend. Ansible 2.8 and newer read the options from the
+    global CLI arguments, while older versions take them as a namedtuple.
+
+    Args:
+        connection (str): The connection plugin to use
+        forks (int): The number of hosts to run tasks on at once
+        extra_vars (dict): The extra variables of the playbook
+
+    Returns:
+        namedtuple: The options to pass to TaskQueueManager, or None if they
+            were set globally
+    """
+    values = {'connection': connection,
+              'forks': forks,
+              'become': C.DEFAULT_BECOME,
+              'become_method': C.DEFAULT_BECOME_METHOD,
+              'become_user': C.DEFAULT_BECOME_USER,
+              'check': False,
+              'diff': False,
+              'extra_vars': (json.dumps(extra_vars),),
+              'listhosts': False,
+              'listtasks': False,
+              'listtags': False,
+              'syntax': False,
+              'module_path': None,
+              'private_key_file': C.DEFAULT_PRIVATE_KEY_FILE,
+              'remote_user': C.DEFAULT_REMOTE_USER,
+              'ssh_common_args': None,
+              'ssh_extra_args': None,
+              'sftp_extra_args': None,
+              'scp_extra_args': None,
+              'start_at_task': None,
+              'tags': ('all',),
+              'skip_tags': (),
+              'timeout': C.DEFAULT_TIMEOUT,
+              'verbosity': 0}
+    try:
+        from ansible import context
+    except ImportError:
+        from collections import namedtuple
+        Options = namedtuple('Options', sorted(values))
+        return Options(**values)
+    from ansible.module_utils.common.collections import ImmutableDict
+    context.CLIARGS = ImmutableDict(values)
+    return None
+
+
+class EventCallback(CallbackBase):
+    """Forwards the progress of a playbook run as structured events
+
+    Every event is a json serializable dictionary with the keys "event"
+    and "time", plus "play", "task", "host", "status" and "result" where
+    they apply. The callback also counts the results of each host, which
+    send_stats sends as the final "stats" event.
+
+    Attributes:
+        stats (dict): The number of "ok", "changed", "failures",
+            "ignored", "skipped" and "unreachable" results of each host
+    """
+    STAT_KEYS = ('ok', 'changed', 'failures', 'ignored', 'skipped',
+                 'unreachable')
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = 'stdout'
+    CALLBACK_NAME = 'cvengine_events'
+
+    def __init__(self, send):
+        """
+        Args:
+            send (callable): Called with each event
+        """
+        super(EventCallback, self).__init__()
+        self.send = send
+        self.stats = {}
+
+    def emit(self, event, **fields):
+        fields['event'] = event
+        fields['time'] = time.time()
+        # Round trip through json to turn Ansible's string and dict types
+        # into plain ones that can be sent to the parent process
+        self.send(json.loads(json.dumps(fields, default=str)))
+
+    def v2_playbook_on_play_start(self, play):
+        self.emit('play_start', play=play.get_name())
+
+    def v2_playbook_on_task_start(self, task, is_conditional):
+        self.emit('task_start', task=task.get_name())
+
+    def v2_playbook_on_handler_task_start(self, task):
+        self.emit('task_start', task=task.get_name(), handler=True)
+
+    def _runner_event(self, result, status, counts, **fields):
+        host = result._host.get_name()
+        stats = self.stats.setdefault(
+            host, dict((key, 0) for key in self.STAT_KEYS))
+        for key in counts:
+            stats[key] += 1
+        self.emit('runner_result', status=status, host=host,
+                  task=result._task.get_name(),
+                  result=result._result, **fields)
+
+    def v2_runner_on_ok(self, result, **kwargs):
+        if result._result.get('changed', False):
+            self._runner_event(result, 'changed', ('ok', 'changed'))
+        else:
+            self._runner_event(result, 'ok', ('ok',))
+
+    def v2_runner_on_failed(self, result, ignore_errors=False):
+        counts = ('ok', 'ignored') if ignore_errors else ('failures',)
+        self._runner_event(result, 'failed', counts,
+                           ignore_errors=ignore_errors)
+
+    def v2_runner_on_skipped(self, result):
+        self._runner_event(result, 'skipped', ('skipped',))
+
+    def v2_runner_on_unreachable(self, result):
+        self._runner_event(result, 'unreachable', ('unreachable',))
+
+    def send_stats(self):
+        """Sends the results counted for each host as a "stats" event"""
+        self.emit('stats', stats=self.stats)
@@ -0,0 +1,793 @@
+import json
+import numbers
+import os
+import pipes
+import socket
+import stat
+import tarfile
+import threading
+import time
+import traceback
+
+from multiprocessing.pool import ThreadPool
+
+from . import run, trace
+from .fetch import ArtifactMissing, TRANSFER_POLL_INTERVAL, \
+    TRANSFER_READ_SIZE, fetch_directory_tar, select_compressor, send_input
+
+
+# Written to the artifacts directory, lists the outcome of every artifact
+ARTIFACT_MANIFEST = 'artifacts_manifest.json'
+DEFAULT_ARTIFACT_WORKERS = 4
+# "truncated" and "skipped" artifacts were cut short or left out to stay
+# within the byte budgets
+ARTIFACT_STATUSES = ('fetched', 'truncated', 'skipped', 'missing', 'failed')
+# Written to the artifacts directory when artifacts are collected into an
+# archive instead of a directory tree
+ARCHIVE_NAME = 'artifacts.tar.gz'
+ARCHIVE_INDEX = 'artifacts_index.json'
+COPY_READ_SIZE = 65536
+# Prefix of the status lines printed by the container copy script
+CONTAINER_COPY_MARKER = 'CVENGINE_ARTIFACT'
+# Error messages of docker cp for paths that do not exist in the container
+MISSING_MESSAGES = ('No such container:path', 'Could not find the file')
+
+CONTAINER_COPY_FUNCTION = '''copy_artifact() {{
+    start=$(date +%s.%N)
+    if out=$({copy_cmd} "$1" "$2" 2>&1); then
+        status=fetched
+        size=$(du -sb "$3" 2>/dev/null | cut -f1)
+    else
+        case "$out" in
+            {missing}) status=missing ;;
+            *) status=failed ;;
+        esac
+        size=
+    fi
+    end=$(date +%s.%N)
+    error=$(printf '%s' "$out" | head -n 1)
+    echo "{marker} $4 $status ${{size:--}} $start $end $error"
+}}
+'''
+
+
+class ArtifactCollector(object):
+    """Fetches artifacts concurrently and records the outcome of each
+
+    Fetches run on a bounded pool of worker threads. The workers inherit
+    the run context (deadlines, cancellation and command logs) and the
+    active tracer of the thread that submitted the fetch. Every artifact
+    gets a manifest entry with its kind, path, status (one of
+    ARTIFACT_STATUSES), size in bytes and the seconds its fetch took.
+
+    Attributes:
+        workers (int): The maximum number of concurrent fetches
+        entries (list): The manifest entries, in the order the artifacts
+            were added
+    """
+    def __init__(self, workers=DEFAULT_ARTIFACT_WORKERS):
+        """
+        Args:
+            workers (int, optional): The maximum number of concurrent fetches
+        """
+        self.workers = max(1, workers)
+        self.entries = []
+        self._pool = None
+        self._results = []
+
+    def record(self, kind, path, status, size=None, seconds=None,
+               error=None, reason=None):
+        """Adds a manifest entry for an artifact that was already handled
+
+        Args:
+            kind (str): The kind of artifact, such as "container" or
+                "test_host"
+            path (str): The path of the artifact
+            status (str): One of ARTIFACT_STATUSES
+            size (int, optional): The size of the fetched artifact in bytes
+            seconds (float, optional): The time the fetch took
+            error (str, optional): Why the artifact is missing or failed
+            reason (str, optional): Why the artifact was truncated or skipped
+
+        Returns:
+            dict: The entry
+        """
+        entry = {'kind': kind, 'path': path, 'status': status,
+                 'bytes': size, 'seconds': seconds}
+        if error:
+            entry['error'] = error
+        if reason:
+            entry['reason'] = reason
+        self.entries.append(entry)
+        return entry
+
+    def submit(self, kind, path, fetch):
+        """Fetches an artifact on the worker pool
+
+        Args:
+            kind (str): The kind of artifact
+            path (str): The path of the artifact
+            fetch (callable): Fetches the artifact and returns its size in
+                bytes (or None if unknown), or a dictionary with the keys
+                "bytes", and "status" and "reason" if the artifact did not
+                fit into the byte budgets. Raises ArtifactMissing if the
+                artifact does not exist.
+
+        Returns:
+            dict: The entry of the artifact, which is filled in once the
+                fetch finished
+        """
+        entry = self.record(kind, path, 'pending')
+        context = run.current_context()
+        tracer = trace.current_tracer()
+        parent = tracer.current_span() if tracer is not None else None
+
+        def work():
+            with run.adopt_context(context), \
+                    trace.activate(tracer, parent=parent):
+                self._fetch(entry, fetch)
+
+        if self._pool is None:
+            self._pool = ThreadPool(self.workers)
+        self._results.append(self._pool.apply_async(work))
+        return entry
+
+    def _fetch(self, entry, fetch):
+        start = time.time()
+        try:
+            with trace.span('artifact.fetch', kind=entry['kind'],
+                            path=entry['path']) as span:
+                result = fetch()
+                if not isinstance(result, dict):
+                    result = {'bytes': result}
+                entry.update(result)
+                entry.setdefault('status', 'fetched')
+                if entry['status'] == 'pending':
+                    entry['status'] = 'fetched'
+                span.set('bytes', entry['bytes'])
+        except ArtifactMissing as e:
+            entry['status'] = 'missing'
+            entry['error'] = str(e)
+        except Exception as e:
+            print('Failed to fetch artifact {0}: {1}'.format(
+                entry['path'], traceback.format_exc()))
+            entry['status'] = 'failed'
+            entry['error'] = str(e) or e.__class__.__name__
+        entry['seconds'] = time.time() - start
+
+    def join(self):
+        """Waits for all submitted fetches to finish
+
+        Returns:
+            list: The manifest entries
+        """
+        if self._pool is not None:
+            for result in self._results:
+                result.wait()
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+            self._results = []
+        return self.entries
+
+    def failed(self, kind=None):
+        """Lists the artifacts that could not be fetched
+
+        Args:
+            kind (str, optional): Only list artifacts of this kind
+
+        Returns:
+            list: The entries of the failed artifacts
+        """
+        return [e for e in self.entries if e['status'] == 'failed' and
+                (kind is None or e['kind'] == kind)]
+
+    def write_manifest(self, artifacts_directory):
+        """Writes the manifest and prints a summary of it
+
+        Args:
+            artifacts_directory (str): The directory the manifest is
+                written to
+
+        Returns:
+            str: The path of the manifest
+        """
+        if not os.path.isdir(artifacts_directory):
+            os.makedirs(artifacts_directory)
+        path = os.path.join(artifacts_directory, ARTIFACT_MANIFEST)
+        with open(path, 'w') as f:
+            json.dump({'artifacts': self.entries}, f, indent=2,
+                      sort_keys=True)
+        counts = dict((status, 0) for status in ARTIFACT_STATUSES)
+        for entry in self.entries:
+            counts[entry['status']] = counts.get(entry['status'], 0) + 1
+        print('Artifacts: ' + ', '.join(
+            '{0} {1}'.format(counts[status], status)
+            for status in ARTIFACT_STATUSES))
+        return path
+
+
+def container_copy_script(copy_cmd, instance_name, artifacts, destination):
+    """Builds one shell command that copies many artifacts out of a container
+
+    For each artifact the command prints a status line with its index,
+    status, size in bytes, start and end time and the first line of any
+    error, to be read with parse_container_copy_output.
+
+    Args:
+        copy_cmd (str): The copy command of the platform, such as "docker cp"
+        instance_name (str): The name of the container
+        artifacts (list): The paths of the artifacts in the container
+        destination (str): The directory on the host to copy them into
+
+    Returns:
+        str: The shell command
+    """
+    missing = '|'.join('*{0}*'.format(pipes.quote(message))
+                       for message in MISSING_MESSAGES)
+    script = CONTAINER_COPY_FUNCTION.format(copy_cmd=copy_cmd,
+                                            missing=missing,
+                                            marker=CONTAINER_COPY_MARKER)
+    for index, artifact in enumerate(artifacts):
+        copied = os.path.join(destination,
+                              os.path.basename(artifact.rstrip('/')))
+        script += 'copy_artifact {0} {1} {2} {3}\n'.format(
+            pipes.quote('{0}:{1}'.format(instance_name, artifact)),
+            pipes.quote(destination), pipes.quote(copied), index)
+    return script
+
+
+def parse_container_copy_output(lines, artifacts):
+    """Reads the status lines printed by a container copy script
+
+    Args:
+        lines (list): The output lines of the script
+        artifacts (list): The artifacts passed to container_copy_script
+
+    Returns:
+        list: A dictionary for each artifact with the keys "path", "status",
+            "bytes", "seconds" and "error"
+    """
+    results = [{'path': artifact, 'status': 'failed', 'bytes': None,
+                'seconds': None, 'error': 'No status was reported'}
+               for artifact in artifacts]
+    for line in lines:
+        fields = line.split(None, 6)
+        if len(fields) < 6 or fields[0] != CONTAINER_COPY_MARKER:
+            continue
+        try:
+            result = results[int(fields[1])]
+        except (ValueError, IndexError):
+            continue
+        result['status'] = fields[2]
+        result['error'] = fields[6] if len(fields) > 6 and \
+            fields[2] != 'fetched' else None
+        try:
+            result['bytes'] = int(fields[3])
+        except ValueError:
+            pass
+        try:
+            result['seconds'] = float(fields[5]) - float(fields[4])
+        except ValueError:
+            pass
+    return results
+
+
+def local_size(path):
+    """Returns the total size of a local file or directory tree
+
+    Args:
+        path (str): The path
+
+    Returns:
+        int: The size in bytes, or None if the path does not exist
+    """
+    if not os.path.lexists(path):
+        return None
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return size
+
+
+class ArtifactBudget(object):
+    """Limits the bytes fetched per artifact and per run
+
+    Each artifact is planned before it is fetched. Files that fit are
+    fetched whole, smallest first. The first file that does not fit keeps
+    only its last bytes, as the end of a log is usually the interesting
+    part, and the remaining files are skipped. The bytes an artifact may use
+    are reserved from the run budget when it is planned, and what it did not
+    use is given back once it was fetched, so artifacts fetched in parallel
+    never exceed the run budget together.
+
+    Attributes:
+        max_artifact_bytes (int): The most bytes fetched for one artifact,
+            or None for no limit
+        max_run_bytes (int): The most bytes fetched for all artifacts of the
+            run, or None for no limit
+        used (int): The bytes reserved or used so far
+    """
+    def __init__(self, max_artifact_bytes=None, max_run_bytes=None):
+        """
+        Args:
+            max_artifact_bytes (int, optional): The most bytes fetched for
+                one artifact
+            max_run_bytes (int, optional): The most bytes fetched for all
+                artifacts of the run
+        """
+        for name, value in (('max_artifact_bytes', max_artifact_bytes),
+                            ('max_run_bytes', max_run_bytes)):
+            if value is not None and (
+                    not isinstance(value, numbers.Integral) or value < 0):
+                msg = '{0} must be a non-negative number of bytes, not {1!r}'
+                raise ValueError(msg.format(name, value))
+        self.max_artifact_bytes = max_artifact_bytes
+        self.max_run_bytes = max_run_bytes
+        self.used = 0
+        self._lock = threading.Lock()
+
+    @property
+    def limited(self):
+        """bool: Whether any limit is set"""
+        return self.max_artifact_bytes is not None or \
+            self.max_run_bytes is not None
+
+    def plan(self, sizes, split=False):
+        """Decides which files of an artifact are fetched, and how much
+
+        Args:
+            sizes (dict): Maps the path of each file of the artifact,
+                relative to the artifact, to its size in bytes
+            split (bool, optional): Apply max_artifact_bytes to each top
+                level entry of the artifact instead of the artifact as a
+                whole. Used for the directory the container artifacts are
+                copied into.
+
+        Returns:
+            dict: The plan, with the files to fetch "whole", the
+                "truncated" files mapped to the number of bytes to keep,
+                the "skipped" files, the "reserved" bytes, the "sizes" of
+                all files and the "reason" if anything was left out
+        """
+        keep = dict(sizes)
+        reasons = []
+        if self.max_artifact_bytes is not None:
+            groups = {}
+            for name in keep:
+                group = name.split('/', 1)[0] if split else ''
+                groups.setdefault(group, []).append(name)
+            cut = False
+            for names in groups.values():
+                fitted = fit_files(dict((name, keep[name]) for name in names),
+                                   self.max_artifact_bytes)
+                cut = cut or any(fitted[name] < keep[name] for name in names)
+                keep.update(fitted)
+            if cut:
+                reasons.append('max_artifact_bytes ({0}) exceeded'.format(
+                    self.max_artifact_bytes))
+        wanted = sum(keep.values())
+        with self._lock:
+            if self.max_run_bytes is not None:
+                available = max(0, self.max_run_bytes - self.used)
+                if wanted > available:
+                    keep = fit_files(keep, available)
+                    wanted = sum(keep.values())
+                    reasons.append('max_run_bytes ({0}) reached'.format(
+                        self.max_run_bytes))
+            self.used += wanted
+        return {'whole': sorted(name for name, size in sizes.items()
+                                if keep[name] == size),
+                'truncated': dict((name, keep[name]) for name in sizes
+                                  if 0 < keep[name] < sizes[name]),
+                'skipped': sorted(name for name, size in sizes.items()
+                                  if keep[name] == 0 and size > 0),
+                'reserved': wanted,
+                'sizes': dict(sizes),
+                'reason': ', '.join(reasons) or None}
+
+    def release(self, plan, used):
+        """Gives back the reserved bytes an artifact did not use
+
+        Args:
+            plan (dict): The plan returned by plan
+            used (int): The bytes the artifact actually used
+        """
+        with self._lock:
+            self.used += (used or 0) - plan['reserved']
+
+
+class ArtifactArchive(object):
+    """A compressed tar archive the artifacts are streamed into
+
+    Artifacts are added as they arrive, without being written to the
+    artifacts directory first. Each artifact is stored under its own name,
+    as it would be in the artifacts directory. Adding is thread safe, one
+    member is written at a time. Once the archive is closed, an index of
+    its members is written next to it as ARCHIVE_INDEX.
+
+    Attributes:
+        path (str): The path of the archive
+        index (list): A dictionary for each member with its "name", the
+            "artifact" it belongs to, its size in "bytes", and its
+            "original_bytes" if it was truncated
+    """
+    def __init__(self, artifacts_directory, compression_level=None):
+        """
+        Args:
+            artifacts_directory (str): The directory the archive is
+                written to
+            compression_level (int, optional): The gzip compression level.
+                Defaults to 6.
+        """
+        if not os.path.isdir(artifacts_directory):
+            os.makedirs(artifacts_directory)
+        self.path = os.path.join(artifacts_directory, ARCHIVE_NAME)
+        self.index = []
+        level = 6 if compression_level is None else int(compression_level)
+        self._tar = tarfile.open(self.path, 'w:gz', compresslevel=level)
+        self._lock = threading.Lock()
+
+    def add(self, tarinfo, fileobj, artifact, original_size=None):
+        """Adds a member, reading its content from a file object
+
+        If the file object ends early or fails, the member is padded with
+        zeros so the archive stays readable, and the error is raised once
+        the member was written.
+
+        Args:
+            tarinfo (:obj: `TarInfo`): The header of the member
+            fileobj (file): Provides the tarinfo.size bytes of the member
+            artifact (str): The path of the artifact the member belongs to
+            original_size (int, optional): The size of the file before it
+                was truncated
+
+        Raises:
+            IOError: If the file object ended early
+        """
+        reader = _PaddedReader(fileobj, tarinfo.size)
+        with self._lock:
+            self._tar.addfile(tarinfo, reader)
+            entry = {'name': tarinfo.name, 'artifact': artifact,
+                     'bytes': tarinfo.size}
+            if original_size is not None:
+                entry['original_bytes'] = original_size
+            if reader.missing:
+                entry['missing_bytes'] = reader.missing
+            self.index.append(entry)
+        if reader.error is not None:
+            raise reader.error
+        if reader.missing:
+            raise IOError('{0} ended {1} bytes early'.format(tarinfo.name,
+                                                             reader.missing))
+
+    def close(self):
+        """Finishes the archive and writes its index
+
+        Returns:
+            str: The path of the index
+        """
+        with self._lock:
+            self._tar.close()
+            path = os.path.join(os.path.dirname(self.path), ARCHIVE_INDEX)
+            with open(path, 'w') as f:
+                json.dump({'archive': ARCHIVE_NAME, 'members': self.index},
+                          f, indent=2, sort_keys=True)
+        print('Archived {0} files into {1}'.format(len(self.index),
+                                                   self.path))
+        return path
+
+
+class RemoteStream(object):
+    """Reads the output of a remote command like a file
+
+    Attributes:
+        cmd (str): The command
+        errors (str): The end of the standard error of the command
+    """
+    def __init__(self, ssh_connection, cmd, stdin=None):
+        """
+        Args:
+            ssh_connection (:obj: `SSHClient`): The connection to the host
+            cmd (str): The command
+            stdin (str, optional): The input of the command
+        """
+        self.cmd = cmd
+        self.errors = ''
+        self._buffer = ''
+        self._eof = False
+        self._channel = ssh_connection.get_transport().open_session()
+        self._channel.settimeout(TRANSFER_POLL_INTERVAL)
+        self._channel.exec_command(cmd)
+        if stdin is None:
+            self._channel.shutdown_write()
+        else:
+            send_input(self._channel, stdin)
+
+    def read(self, size=-1):
+        """Reads up to size bytes, fewer only at the end of the output"""
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            run.check_deadline()
+            # Drain stderr too, it shares the flow control window
+            while self._channel.recv_stderr_ready():
+                self.errors += self._channel.recv_stderr(TRANSFER_READ_SIZE)
+                self.errors = self.errors[-TRANSFER_READ_SIZE:]
+            try:
+                data = self._channel.recv(TRANSFER_READ_SIZE)
+            except socket.timeout:
+                continue
+            if not data:
+                self._eof = True
+            self._buffer += data
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def close(self):
+        """Reads the rest of the output and waits for the command to exit
+
+        Raises:
+            Exception: A generic exception if the command failed
+
+        """
+        try:
+            while self.read(TRANSFER_READ_SIZE):
+                pass
+            rc = self._channel.recv_exit_status()
+        finally:
+            self._channel.close()
+        if rc != 0:
+            msg = 'Remote command {0} failed with rc {1}: {2}'
+            raise Exception(msg.format(self.cmd, rc, self.errors.strip()))
+
+    def abort(self):
+        """Stops reading without waiting for the command"""
+        self._channel.close()
+
+
+def fit_files(sizes, limit):
+    """Fits files into a number of bytes, smallest first
+
+    Args:
+        sizes (dict): Maps each file to its size in bytes
+        limit (int): The number of bytes available
+
+    Returns:
+        dict: Maps each file to the number of bytes to keep of it. The first
+            file that does not fit whole keeps what is left, later files
+            keep nothing.
+    """
+    keep = {}
+    left = limit
+    by_size = sorted(sizes.items(), key=lambda item: (item[1], item[0]))
+    for name, size in by_size:
+        keep[name] = min(size, left)
+        left -= keep[name]
+    return keep
+
+
+def budget_result(plan, used):
+    """Describes the outcome of a planned fetch for the manifest
+
+    Args:
+        plan (dict): The plan returned by ArtifactBudget.plan
+        used (int): The bytes fetched
+
+    Returns:
+        dict: The "bytes", "status" and "reason" of the manifest entry,
+            plus the "truncated_files" and "skipped_files" if there are any
+    """
+    result = {'bytes': used, 'status': 'fetched'}
+    if plan['truncated'] or plan['skipped']:
+        result['status'] = 'truncated' if used else 'skipped'
+        result['reason'] = plan['reason']
+    if plan['truncated']:
+        result['truncated_files'] = plan['truncated']
+    if plan['skipped']:
+        result['skipped_files'] = plan['skipped']
+    return result
+
+
+def local_file_sizes(path):
+    """Lists the regular files of a local artifact with their size
+
+    Args:
+        path (str): The path of the file or directory
+
+    Returns:
+        dict: Maps the path of each file relative to path ("" if path is a
+            file) to its size in bytes
+    """
+    if not os.path.isdir(path):
+        return {'': os.path.getsize(path)}
+    sizes = {}
+    for root, _, files in os.walk(path):
+        for name in files:
+            full = os.path.join(root, name)
+            info = os.lstat(full)
+            if stat.S_ISREG(info.st_mode):
+                sizes[os.path.relpath(full, path)] = info.st_size
+    return sizes
+
+
+def copy_planned(path, artifacts_directory, plan, archive=None):
+    """Copies a local artifact according to its plan
+
+    Args:
+        path (str): The path of the artifact
+        artifacts_directory (str): The directory to copy it into
+        plan (dict): The plan returned by ArtifactBudget.plan
+        archive (:obj: `ArtifactArchive`, optional): Add the files to this
+            archive instead of the artifacts directory
+
+    Returns:
+        int: The bytes copied
+    """
+    base = os.path.basename(path.rstrip('/'))
+    used = 0
+    names = [(name, None) for name in plan['whole']] + \
+        sorted(plan['truncated'].items())
+    for name, keep in names:
+        source = _join(path, name)
+        destination = _join(os.path.join(artifacts_directory, base), name)
+        with open(source, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if keep is not None:
+                f.seek(max(0, size - keep))
+                size = min(size, keep)
+            if archive is not None:
+                tarinfo = tarfile.TarInfo(_join(base, name))
+                tarinfo.size = size
+                tarinfo.mtime = os.path.getmtime(source)
+                archive.add(tarinfo, f, path, plan['sizes'][name]
+                            if keep is not None else None)
+            else:
+                _copy_to(f, destination, size)
+        used += size
+    return used
+
+
+def fetch_planned(ssh_connection, remote_path, artifacts_directory, plan,
+                  archive=None, compression='auto', compression_level=None):
+    """Fetch a remote artifact according to its plan
+
+    The whole files are fetched in one tar stream. Into the artifacts
+    directory, they are unpacked by fetch_directory_tar. Into an archive,
+    each member of the stream is copied as it arrives, which needs gzip or
+    no compression on the wire. Of the truncated files only the last bytes
+    are fetched, one command each.
+
+    Args:
+        ssh_connection (:obj: `SSHClient`): The connection to the host
+        remote_path (str): The path of the remote file or directory
+        artifacts_directory (str): The local directory to fetch it into
+        plan (dict): The plan returned by ArtifactBudget.plan
+        archive (:obj: `ArtifactArchive`, optional): Add the files to this
+            archive instead of the artifacts directory
+        compression (str, optional): The requested compression of the tar
+            stream, one of cvengine.util.fetch.COMPRESSIONS
+        compression_level (int, optional): The compression level
+
+    Raises:
+        Exception: A generic exception if the remote host has no tar, or a
+            transfer failed
+
+    Returns:
+        int: The bytes fetched
+    """
+    remote_path = remote_path.rstrip('/') or '/'
+    parent, base = os.path.split(remote_path)
+    used = 0
+    if plan['whole']:
+        compressor = select_compressor(ssh_connection, compression)
+        if compressor is None:
+            raise Exception('tar is not available to fetch {0}'.format(
+                remote_path))
+        if archive is None:
+            if not os.path.isdir(artifacts_directory):
+                os.makedirs(artifacts_directory)
+            fetch_directory_tar(ssh_connection, remote_path,
+                                artifacts_directory, compressor,
+                                compression_level, members=plan['whole'])
+            used += sum(plan['sizes'][name] for name in plan['whole'])
+        else:
+            used += _archive_tar_stream(ssh_connection, parent, base,
+                                        plan['whole'], archive, remote_path,
+                                        compressor)
+    for name, keep in sorted(plan['truncated'].items()):
+        remote_file = _join(remote_path, name)
+        stream = RemoteStream(ssh_connection, 'tail -c {0} {1}'.format(
+            keep, pipes.quote(remote_file)))
+        try:
+            if archive is not None:
+                tarinfo = tarfile.TarInfo(_join(base, name))
+                tarinfo.size = keep
+                tarinfo.mtime = time.time()
+                archive.add(tarinfo, stream, remote_path, plan['sizes'][name])
+            else:
+                _copy_to(stream, _join(os.path.join(artifacts_directory,
+                                                    base), name), keep)
+        except Exception:
+            stream.abort()
+            raise
+        stream.close()
+        used += keep
+    return used
+
+
+def _archive_tar_stream(ssh_connection, parent, base, names, archive,
+                        artifact, compressor):
+    """Copies the members of a remote tar stream into an archive"""
+    # tarfile only reads gzip streams, any other compressor is replaced
+    mode = 'r|gz' if compressor != 'none' else 'r|'
+    cmd = 'tar -C {0} -cf - --hard-dereference --null -T - | {1}'.format(
+        pipes.quote(parent or '/'),
+        'gzip -c' if compressor != 'none' else 'cat')
+    stream = RemoteStream(ssh_connection, cmd, ''.join(
+        _join(base, name) + '\0' for name in names))
+    used = 0
+    with trace.span('artifact.archive_stream', path=artifact) as span:
+        try:
+            source = tarfile.open(fileobj=stream, mode=mode)
+            for member in source:
+                if member.isfile():
+                    archive.add(member, source.extractfile(member), artifact)
+                    used += member.size
+            source.close()
+        except Exception:
+            stream.abort()
+            raise
+        stream.close()
+        span.set('bytes', used)
+    return used
+
+
+class _PaddedReader(object):
+    """Reads exactly size bytes of a file object, padding with zeros"""
+    def __init__(self, fileobj, size):
+        self.fileobj = fileobj
+        self.left = size
+        self.missing = 0
+        self.error = None
+
+    def read(self, size):
+        size = min(size, self.left)
+        data = ''
+        if self.error is None and not self.missing:
+            try:
+                data = self.fileobj.read(size)
+            except Exception as e:
+                self.error = e
+        if len(data) < size:
+            self.missing += size - len(data)
+            data += '\0' * (size - len(data))
+        self.left -= size
+        return data
+
+
+def _copy_to(source, destination, size):
+    """Writes exactly size bytes of a file object to a local file"""
+    directory = os.path.dirname(destination)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(destination, 'wb') as f:
+        left = size
+        while left > 0:
+            data = source.read(min(COPY_READ_SIZE, left))
+            if not data:
+                break
+            f.write(data)
+            left -= len(data)
+    if left > 0:
+        raise IOError('{0} ended {1} bytes early'.format(destination, left))
+
+
+def _join(path, name):
+    return os.path.join(path, name) if name else path
@@ -0,0 +1,117 @@
+import hashlib
+import json
+import pipes
+
+
+# Written on the host once it was bootstrapped. Holds the fingerprint of the
+# steps that were applied.
+BOOTSTRAP_MARKER = '/var/lib/cvengine/bootstrap.fingerprint'
+# Prefix of the status lines printed by the bootstrap script
+BOOTSTRAP_STATUS = 'CVENGINE_BOOTSTRAP'
+
+
+def bootstrap_fingerprint(steps):
+    """Computes the fingerprint of a list of bootstrap steps
+
+    Args:
+        steps (list): The bootstrap steps
+
+    Returns:
+        str: A hex digest that changes whenever the steps change
+    """
+    data = json.dumps(list(steps), sort_keys=True)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def bootstrap_script(steps, package_manager='dnf', marker=BOOTSTRAP_MARKER):
+    """Builds one shell script that brings a host into the bootstrapped state
+
+    Each step is a dictionary with a "name" (without commas) and either
+    "packages" to install, or an "apply" command. A "probe" command tells
+    whether the step is already satisfied. For package steps it defaults to
+    checking that the packages are installed with rpm.
+
+    All package steps are probed first, and the missing packages are
+    installed in a single transaction. The other steps are then probed and
+    applied in order. If the marker on the host holds the fingerprint of the
+    steps, the host was bootstrapped with the same steps before and nothing
+    is probed or applied. Otherwise the marker is written at the end.
+
+    The script ends with a status line saying whether the host was
+    "bootstrapped" or "skipped", and which steps were applied, to be read
+    with parse_bootstrap_output.
+
+    Args:
+        steps (list): The bootstrap steps
+        package_manager (str, optional): The command installing packages
+        marker (str, optional): The path of the fingerprint marker
+
+    Raises:
+        ValueError: If a step has neither packages nor an apply command
+
+    Returns:
+        str: The shell script
+    """
+    fingerprint = bootstrap_fingerprint(steps)
+    lines = ['set -e',
+             'if [ "$(cat {0} 2>/dev/null)" = {1} ]; then'.format(
+                 pipes.quote(marker), fingerprint),
+             '    echo {0} skipped'.format(BOOTSTRAP_STATUS),
+             '    exit 0',
+             'fi',
+             'packages=',
+             'applied=']
+    commands = []
+    for step in steps:
+        if step.get('packages'):
+            probe = step.get('probe') or 'rpm -q --quiet {0}'.format(
+                ' '.join(pipes.quote(p) for p in step['packages']))
+            lines += ['if ! ({0}) >/dev/null 2>&1; then'.format(probe),
+                      '    packages="$packages {0}"'.format(
+                          ' '.join(step['packages'])),
+                      '    applied="$applied,"{0}'.format(
+                          pipes.quote(step['name'])),
+                      'fi']
+        elif step.get('apply'):
+            commands.append(step)
+        else:
+            msg = 'Bootstrap step {0} has neither packages nor a command'
+            raise ValueError(msg.format(step.get('name')))
+    lines += ['if [ -n "$packages" ]; then',
+              '    {0} -y install $packages'.format(package_manager),
+              'fi']
+    for step in commands:
+        lines += ['if ! ({0}) >/dev/null 2>&1; then'.format(
+                      step.get('probe') or 'false'),
+                  '    {0}'.format(step['apply']),
+                  '    applied="$applied,"{0}'.format(
+                      pipes.quote(step['name'])),
+                  'fi']
+    lines += ['mkdir -p {0}'.format(pipes.quote(marker.rsplit('/', 1)[0])),
+              'echo {0} > {1}'.format(fingerprint, pipes.quote(marker)),
+              'echo {0} bootstrapped "${{applied#,}}"'.format(
+                  BOOTSTRAP_STATUS)]
+    return '\n'.join(lines) + '\n'
+
+
+def parse_bootstrap_output(lines):
+    """Reads the status lines printed by a bootstrap script
+
+    Args:
+        lines (list): The output lines of the script
+
+    Returns:
+        str: "skipped" if the marker matched, "bootstrapped" if the script
+            finished, or None if it did not report
+        list: The names of the steps that were applied
+    """
+    status = None
+    applied = []
+    for line in lines:
+        fields = line.strip().split(' ', 2)
+        if len(fields) < 2 or fields[0] != BOOTSTRAP_STATUS:
+            continue
+        status = fields[1]
+        applied = [name for name in fields[2].split(',') if name] \
+            if len(fields) == 3 else []
+    return status, applied
@@ -0,0 +1,319 @@
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import traceback
+import urllib2
+import urlparse
+
+from multiprocessing.pool import ThreadPool
+
+
+DEFAULT_CACHE_DIRECTORY = os.path.join(os.path.expanduser('~'), '.cache',
+                                       'cvengine')
+DEFAULT_MAX_BYTES = 2 * 1024 * 1024 * 1024
+DEFAULT_WORKERS = 4
+CHUNK_SIZE = 64 * 1024
+
+
+class DownloadCache(object):
+    """On-disk, content-addressed cache for files fetched over HTTP
+
+    Downloaded files are stored under objects/<sha256>/<basename> within the
+    cache directory, so two URLs with the same basename never clobber each
+    other and identical content is only stored once. An index maps each URL
+    to the content hash it last resolved to, along with the ETag and
+    Last-Modified headers used to revalidate the entry with a conditional GET.
+    When the cache grows past its size limit, the least recently used objects
+    are evicted.
+
+    The index is guarded by a lock file, so several cvengine processes on the
+    same worker can share one cache directory.
+
+    Attributes:
+        directory (str): The root directory of the cache
+        max_bytes (int): The size limit of the cache. Least recently used
+            objects are evicted once the stored objects exceed this size.
+        max_age (int): Number of seconds an entry is considered fresh after
+            it was last validated. Fresh entries are served without
+            contacting the server. Defaults to 0, which revalidates every
+            entry on each fetch.
+    """
+    def __init__(self, directory=None, max_bytes=DEFAULT_MAX_BYTES,
+                 max_age=0, context=None):
+        """
+        Args:
+            directory (str, optional): The root directory of the cache.
+                Defaults to $CV_CACHE_DIRECTORY or ~/.cache/cvengine.
+            max_bytes (int, optional): The size limit of the cache
+            max_age (int, optional): Number of seconds an entry is served
+                without revalidation
+            context (:obj: `ssl.SSLContext`, optional): The SSL context to
+                be used when opening HTTPS URLs
+        """
+        if directory is None:
+            directory = os.environ.get('CV_CACHE_DIRECTORY',
+                                       DEFAULT_CACHE_DIRECTORY)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.context = context
+        self.index_path = os.path.join(directory, 'index.json')
+        self.lock_path = os.path.join(directory, 'index.lock')
+        self.objects_directory = os.path.join(directory, 'objects')
+        self.tmp_directory = os.path.join(directory, 'tmp')
+        self._thread_lock = threading.Lock()
+        for path in (self.objects_directory, self.tmp_directory):
+            try:
+                os.makedirs(path)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    @classmethod
+    def from_config(cls, cache_config, context=None):
+        """Creates a cache from the "cache" section of the cvengine config
+
+        Args:
+            cache_config (dict): The cache configuration. Supported keys are
+                "directory", "max_bytes" and "max_age".
+            context (:obj: `ssl.SSLContext`, optional): The SSL context to
+                be used when opening HTTPS URLs
+
+        Returns:
+            DownloadCache: The configured cache
+        """
+        cache_config = cache_config or {}
+        return cls(directory=cache_config.get('directory'),
+                   max_bytes=cache_config.get('max_bytes', DEFAULT_MAX_BYTES),
+                   max_age=cache_config.get('max_age', 0),
+                   context=context)
+
+    def fetch(self, url):
+        """Returns a local path holding the current contents of a URL
+
+        If the URL is cached and still fresh, the cached path is returned
+        right away. Otherwise the server is asked for the file with a
+        conditional GET, and the body is only downloaded if it changed.
+
+        Args:
+            url (str): The URL to be fetched
+
+        Returns:
+            str: The path to the cached copy of the file
+        """
+        return self.fetch_with_digest(url)[0]
+
+    def fetch_with_digest(self, url):
+        """Returns a local path and content hash for the contents of a URL
+
+        This behaves like fetch, but additionally returns the sha256 digest
+        of the cached file so that callers can memoize work derived from
+        its contents.
+
+        Args:
+            url (str): The URL to be fetched
+
+        Returns:
+            str: The path to the cached copy of the file
+            str: The sha256 hex digest of the file contents
+        """
+        with self._locked() as index:
+            entry = index.get(url)
+            if entry and not self._exists(entry):
+                entry = None
+            if entry and time.time() - entry['validated'] < self.max_age:
+                entry['accessed'] = time.time()
+                return self._result(entry)
+
+        request = urllib2.Request(url)
+        if entry and entry.get('etag'):
+            request.add_header('If-None-Match', entry['etag'])
+        if entry and entry.get('last_modified'):
+            request.add_header('If-Modified-Since', entry['last_modified'])
+
+        try:
+            if self.context is not None and url.startswith('https'):
+                response = urllib2.urlopen(request, context=self.context)
+            else:
+                response = urllib2.urlopen(request)
+        except urllib2.HTTPError as e:
+            if e.code != 304 or entry is None:
+                raise
+            with self._locked() as index:
+                entry['validated'] = entry['accessed'] = time.time()
+                index[url] = entry
+            return self._result(entry)
+
+        try:
+            entry = self._store(url, response)
+        finally:
+            response.close()
+
+        with self._locked() as index:
+            index[url] = entry
+            self._evict(index, keep=entry['sha256'])
+        return self._result(entry)
+
+    def fetch_many(self, urls, workers=DEFAULT_WORKERS):
+        """Fetches several URLs in parallel on a bounded thread pool
+
+        Args:
+            urls (list): The URLs to be fetched. Duplicates are only fetched
+                once.
+            workers (int, optional): The maximum number of concurrent
+                downloads
+
+        Raises:
+            Exception: A generic exception naming the URL if any download
+                fails
+
+        Returns:
+            dict: A mapping of each URL to the path of its cached copy
+        """
+        unique_urls = sorted(set(urls))
+        if not unique_urls:
+            return {}
+
+        def fetch_one(url):
+            try:
+                return url, self.fetch(url)
+            except Exception:
+                msg = 'Error when downloading {0}: {1}'
+                raise Exception(msg.format(url, traceback.format_exc()))
+
+        pool = ThreadPool(max(1, min(workers, len(unique_urls))))
+        try:
+            return dict(pool.map(fetch_one, unique_urls))
+        finally:
+            pool.close()
+            pool.join()
+
+    def _store(self, url, response):
+        """Streams a response body into the object store
+
+        Args:
+            url (str): The URL the response was fetched from
+            response (file): The open response object
+
+        Returns:
+            dict: The index entry for the stored object
+        """
+        sha = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                while True:
+                    chunk = response.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    sha.update(chunk)
+                    size += len(chunk)
+                    f.write(chunk)
+
+            digest = sha.hexdigest()
+            base_name = os.path.basename(urlparse.urlsplit(url).path)
+            relative_path = os.path.join('objects', digest,
+                                         base_name or digest)
+            object_path = os.path.join(self.directory, relative_path)
+            if not os.path.exists(object_path):
+                try:
+                    os.makedirs(os.path.dirname(object_path))
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+                os.rename(tmp_path, object_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        headers = response.info()
+        now = time.time()
+        return {'sha256': digest,
+                'path': relative_path,
+                'size': size,
+                'etag': headers.getheader('ETag'),
+                'last_modified': headers.getheader('Last-Modified'),
+                'validated': now,
+                'accessed': now}
+
+    def _result(self, entry):
+        return os.path.join(self.directory, entry['path']), entry['sha256']
+
+    def _exists(self, entry):
+        return os.path.exists(os.path.join(self.directory, entry['path']))
+
+    def _evict(self, index, keep=None):
+        """Removes least recently used objects until the cache fits
+
+        Args:
+            index (dict): The loaded cache index. Entries for evicted objects
+                are removed from it.
+            keep (str, optional): The hash of an object that must not be
+                evicted, usually the one that was just stored
+        """
+        objects = {}
+        for url, entry in index.items():
+            obj = objects.setdefault(entry['sha256'],
+                                     {'size': entry['size'], 'accessed': 0,
+                                      'urls': []})
+            obj['accessed'] = max(obj['accessed'], entry['accessed'])
+            obj['urls'].append(url)
+
+        total = sum(obj['size'] for obj in objects.values())
+        by_age = sorted(objects.items(), key=lambda item: item[1]['accessed'])
+        for digest, obj in by_age:
+            if total <= self.max_bytes:
+                break
+            if digest == keep:
+                continue
+            shutil.rmtree(os.path.join(self.objects_directory, digest),
+                          ignore_errors=True)
+            for url in obj['urls']:
+                del index[url]
+            total -= obj['size']
+
+    def _locked(self):
+        return _LockedIndex(self)
+
+
+class _LockedIndex(object):
+    """Context manager that holds the cache lock while the index is in use
+
+    The index is loaded on entry and written back atomically on a clean exit.
+    """
+    def __init__(self, cache):
+        self.cache = cache
+
+    def __enter__(self):
+        self.cache._thread_lock.acquire()
+        try:
+            self.lock_file = open(self.cache.lock_path, 'a')
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+            try:
+                with open(self.cache.index_path) as f:
+                    self.index = json.load(f)
+            except (IOError, ValueError):
+                self.index = {}
+        except Exception:
+            self.cache._thread_lock.release()
+            raise
+        return self.index
+
+    def __exit__(self, exc_type, exc_value, tb):
+        try:
+            if exc_type is None:
+                fd, tmp_path = tempfile.mkstemp(dir=self.cache.tmp_directory)
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(self.index, f)
+                os.rename(tmp_path, self.cache.index_path)
+        finally:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+            self.lock_file.close()
+            self.cache._thread_lock.release()
@@ -0,0 +1,155 @@
+import json
+import os
+import threading
+import time
+
+
+# Written to the artifacts directory of each scenario
+RUN_STATE_FILE = 'run_state.json'
+RUN_STATE_VERSION = 1
+RUN_STATUSES = ('running', 'passed', 'failed')
+
+
+class RunState(object):
+    """Records the progress of a validation run so it can be resumed
+
+    The state lists the completed phases (such as "prepare" for the
+    environment, or "bootstrap" for a platform that installs packages on the
+    host) and the playbooks that passed, along with the details needed to
+    reattach to the environment. It is written to disk after every change,
+    so it survives a crash of the run. As the environment details may
+    include credentials, the file is only readable by its owner.
+
+    Attributes:
+        path (str): The path of the state file
+        data (dict): The recorded state
+    """
+    def __init__(self, path, image_url, host_type):
+        """
+        Args:
+            path (str): The path of the state file
+            image_url (str): The image being validated
+            host_type (str): The platform the scenario runs on
+        """
+        self.path = path
+        self.data = {'version': RUN_STATE_VERSION, 'image_url': image_url,
+                     'host_type': host_type, 'status': 'running',
+                     'started': time.time(), 'phases': [], 'playbooks': [],
+                     'environment': None, 'host_data_out': None}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path, image_url, host_type):
+        """Reads the state of a previous run to resume it
+
+        Args:
+            path (str): The path of the state file
+            image_url (str): The image being validated
+            host_type (str): The platform the scenario runs on
+
+        Raises:
+            Exception: A generic exception if there is no state file, or it
+                belongs to another image or platform
+
+        Returns:
+            RunState: The state
+        """
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (IOError, ValueError) as e:
+            msg = 'Unable to read the state of the previous run from {0}: {1}'
+            raise Exception(msg.format(path, e))
+        if data.get('version') != RUN_STATE_VERSION:
+            msg = '{0} was written by another version of cvengine'
+            raise Exception(msg.format(path))
+        if (data.get('image_url'), data.get('host_type')) != \
+                (image_url, host_type):
+            msg = ('{0} belongs to the validation of {1} on {2}, not of {3} '
+                   'on {4}')
+            raise Exception(msg.format(path, data.get('image_url'),
+                                       data.get('host_type'), image_url,
+                                       host_type))
+        state = cls(path, image_url, host_type)
+        state.data.update(data)
+        state.data['resumed'] = state.data.get('resumed', 0) + 1
+        return state
+
+    @property
+    def environment(self):
+        """dict: The handler and details of the environment, or None"""
+        return self.data['environment']
+
+    def record_environment(self, handler, details):
+        """Records how to reattach to the environment
+
+        Args:
+            handler (str): The name of the environment handler
+            details (dict): The details returned by its checkpoint method
+        """
+        with self._lock:
+            self.data['environment'] = {'handler': handler,
+                                        'details': details,
+                                        'torn_down': False}
+        self.save()
+
+    def environment_torn_down(self):
+        """Records that the environment was destroyed at teardown"""
+        with self._lock:
+            if self.data['environment'] is not None:
+                self.data['environment']['torn_down'] = True
+        self.save()
+
+    def reset_progress(self):
+        """Forgets the completed work, when it has to be done again
+
+        Used when a run is resumed but its environment is gone, so the hosts
+        have to be prepared from scratch.
+        """
+        with self._lock:
+            self.data['phases'] = []
+            self.data['playbooks'] = []
+            self.data['environment'] = None
+            self.data['host_data_out'] = None
+        self.save()
+
+    def phase_done(self, name):
+        """Returns whether a phase was completed by this or an earlier run"""
+        return name in self.data['phases']
+
+    def complete_phase(self, name):
+        """Records that a phase was completed"""
+        self._append('phases', name)
+
+    def playbook_done(self, name):
+        """Returns whether a playbook passed in this or an earlier run"""
+        return name in self.data['playbooks']
+
+    def complete_playbook(self, name):
+        """Records that a playbook passed"""
+        self._append('playbooks', name)
+
+    def set(self, key, value):
+        """Records a value, such as the host_data_out directory or status"""
+        with self._lock:
+            self.data[key] = value
+        self.save()
+
+    def _append(self, key, name):
+        with self._lock:
+            if name not in self.data[key]:
+                self.data[key].append(name)
+        self.save()
+
+    def save(self):
+        """Writes the state, replacing the previous file atomically"""
+        with self._lock:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            tmp_path = self.path + '.tmp'
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                         0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.data, f, indent=2, sort_keys=True)
+            os.rename(tmp_path, self.path)
@@ -1,16 +1,54 @@
+import errno
 import logging
 import os
 import paramiko
+import pipes
 import scp
+import socket
+import stat
+import subprocess
+import tempfile
+import threading
+import time
+import weakref
+
+from distutils.spawn import find_executable
+
+from . import trace
+
+
+# Seconds an unused pooled connection is kept open
+DEFAULT_IDLE_TIMEOUT = 300
+# How directories are fetched. "tar" streams a compressed tar archive over
+# one channel and falls back to "scp" if the remote host has no tar. "sync"
+# only fetches new and changed files (see cvengine.util.sync) and falls back
+# to "tar".
+TRANSFER_METHODS = ('tar', 'scp', 'sync')
+# The number of times a sync is attempted over a new connection when the
+# connection drops
+SYNC_ATTEMPTS = 3
+COMPRESSIONS = ('auto', 'zstd', 'gzip', 'none')
+# Preferred compressors, fastest first. "auto" picks the first one that is
+# installed on both ends.
+COMPRESSORS = ('zstd', 'gzip')
+TRANSFER_READ_SIZE = 65536
+TRANSFER_POLL_INTERVAL = 0.5
+
+# The compressors installed on each remote host, keyed by transport
+_remote_compressors = weakref.WeakKeyDictionary()
+_remote_compressors_lock = threading.Lock()
+
+
+class ArtifactMissing(Exception):
+    """Raised when an artifact to be fetched does not exist"""
 
 
 def get_file_type(ssh_connection, file_path):
     """Function to determine if a remote file is a flat file or directory
 
-    Executes a "file" command in a shell against the target file path
-    then parses the output to determine the file type. This is intended to
-    be run against a remote machine to facilitate fetching artifacts from
-    a remote host.
+    Looks up the remote path with an SFTP stat over the given connection.
+    Symbolic links are followed. To look up many paths at once, use
+    stat_remote_paths.
 
     Args:
         ssh_connection (:obj: `SSHClient`): Preconfigured ssh connection
@@ -24,37 +62,117 @@ def get_file_type(ssh_connection, file_path):
             flat file.
 
     """
-    cmd = 'file {0}'.format(file_path)
-    stdin, stdout, stderr = ssh_connection.exec_command(cmd)
-    # Stdout will be in the following formats:
-    # No such file:
-    #    foo: cannot open `foo' (No such file or directory)
-    #
-    # File:
-    #    foo: ASCII text
-    #
-    # Directory:
-    #    foo: directory
-    result = stdout.read().strip().split(':')[1].strip()
-    if 'No such file or directory' in result:
-        return 'DoesNotExist'
-    elif result == 'directory':
-        return 'Directory'
-    else:
-        return 'File'
+    return stat_remote_paths(ssh_connection, [file_path])[file_path]['type']
+
+
+def stat_remote_paths(ssh_connection, paths):
+    """Looks up the type and size of many remote paths at once
+
+    Opens one SFTP session and sends a stat request for every path before
+    reading any of the replies, so a whole list of paths costs a single
+    round trip. Symbolic links are followed.
+
+    Args:
+        ssh_connection (:obj: `SSHClient`): The connection to the host
+        paths (list): The remote paths
+
+    Returns:
+        dict: Maps each path to a dictionary with the keys "type" (as
+            returned by get_file_type) and "size" (the size in bytes of a
+            file, None otherwise). Paths that cannot be looked up, for example
+            because of their permissions, are reported as "DoesNotExist" and
+            have an "error" key with the reason.
+
+    """
+    if not paths:
+        return {}
+    sftp = ssh_connection.open_sftp()
+    try:
+        if _can_queue_requests(sftp):
+            return _queued_stat(sftp, set(paths))
+        return dict((path, _plain_stat(sftp, path)) for path in set(paths))
+    finally:
+        sftp.close()
+
+
+def _can_queue_requests(sftp):
+    """Returns whether the installed paramiko lets stat requests be queued
+
+    Queuing relies on interfaces that paramiko does not make public, so
+    versions outside the range pinned in requirements.txt may lack them.
+    """
+    return hasattr(sftp, '_async_request') and \
+        hasattr(sftp, '_read_response') and \
+        hasattr(paramiko.SFTPAttributes, '_from_msg')
+
+
+def _queued_stat(sftp, paths):
+    batch = _StatBatch()
+    requests = {}
+    for path in paths:
+        # paramiko only exposes blocking requests, so the requests are
+        # queued through its asynchronous interface, the one SFTPFile uses
+        # for prefetching
+        num = sftp._async_request(batch, paramiko.sftp.CMD_STAT, path)
+        requests[num] = path
+    while len(batch.responses) < len(requests):
+        sftp._read_response()
+
+    results = {}
+    for num, path in requests.items():
+        t, msg = batch.responses[num]
+        if t == paramiko.sftp.CMD_ATTRS:
+            results[path] = _stat_result(
+                paramiko.SFTPAttributes._from_msg(msg))
+            continue
+        results[path] = {'type': 'DoesNotExist', 'size': None}
+        if t == paramiko.sftp.CMD_STATUS:
+            code = msg.get_int()
+            if code != paramiko.sftp.SFTP_NO_SUCH_FILE:
+                results[path]['error'] = msg.get_text()
+    return results
+
+
+def _plain_stat(sftp, path):
+    """Looks up one path with a blocking stat, one round trip per path"""
+    try:
+        return _stat_result(sftp.stat(path))
+    except IOError as e:
+        result = {'type': 'DoesNotExist', 'size': None}
+        if e.errno != errno.ENOENT:
+            result['error'] = str(e)
+        return result
+
+
+def _stat_result(attributes):
+    if stat.S_ISDIR(attributes.st_mode):
+        return {'type': 'Directory', 'size': None}
+    return {'type': 'File', 'size': attributes.st_size}
+
 
+class _StatBatch(object):
+    """Collects the replies to queued SFTP requests"""
+    def __init__(self):
+        self.responses = {}
 
-def setup_ssh_connection(target_machine, target_credentials, port=22):
+    def _async_response(self, t, msg, num):
+        self.responses[num] = (t, msg)
+
+
+def setup_ssh_connection(target_machine, target_credentials, port=22,
+                         timeout=None):
     """Helper function to instantiate a ssh connection to a remote host
 
-    Instantiates a wrapper around an SSH connection to a remote host. A
-    connection is not created at this point, but the credentials, IP, etc.
-    are all defined.
+    Instantiates a wrapper around an SSH connection to a remote host and
+    connects to it. The client is closed again if the connection fails.
 
     Args:
         target_machine (str): The hostname or IP address of the target host
         target_credentials (dict): Credentials (username, password, private
             key path) for the remote host
+        port (int, optional): The SSH port of the target host
+        timeout (float, optional): The number of seconds to wait for the
+            connection and the SSH banner
 
     Returns:
         SSHClient: A wrapper around the SSH connection
@@ -67,22 +185,240 @@ def setup_ssh_connection(target_machine, target_credentials, port=22):
                  'look_for_keys': True,
                  'allow_agent': True,
                  'port': port}
+    if timeout is not None:
+        ssh_creds['timeout'] = timeout
+        ssh_creds['banner_timeout'] = timeout
     ssh = paramiko.SSHClient()
     ssh.load_system_host_keys()
     ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ssh.connect(target_machine, **ssh_creds)
+    try:
+        ssh.connect(target_machine, **ssh_creds)
+    except Exception:
+        ssh.close()
+        raise
 
     return ssh
 
 
+def send_input(channel, data):
+    """Writes data to the standard input of a remote command and closes it
+
+    The data is sent from a background thread, so the caller can read the
+    output of the command at the same time without either side blocking on
+    a full window.
+
+    Args:
+        channel (:obj: `Channel`): The channel running the command
+        data (str): The input, or a file object it is read from
+
+    Returns:
+        Thread: The thread sending the data
+    """
+    def send():
+        try:
+            if hasattr(data, 'read'):
+                while True:
+                    chunk = data.read(TRANSFER_READ_SIZE)
+                    if not chunk:
+                        break
+                    channel.sendall(chunk)
+            else:
+                channel.sendall(data)
+            channel.shutdown_write()
+        except (socket.error, EOFError, paramiko.SSHException):
+            pass
+
+    thread = threading.Thread(target=send)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+class SSHConnectionPool(object):
+    """Shares authenticated SSH connections between remote helpers
+
+    Connections are keyed by host, port and credentials, so every helper
+    that talks to the same host (remote commands, artifact fetches) reuses
+    one key exchange and login. Connections are checked before they are
+    handed out and replaced if they died, and connections that were not
+    used for the idle timeout are closed. Pooled connections can be used
+    from several threads at once, as every operation opens its own channel.
+
+    Attributes:
+        idle_timeout (float): The number of seconds an unused connection is
+            kept open
+    """
+    def __init__(self, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        """
+        Args:
+            idle_timeout (float, optional): The number of seconds an unused
+                connection is kept open
+        """
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        # Maps each key to a list of [connection, time of last use]
+        self._connections = {}
+
+    def get(self, host, credentials, port=22, timeout=None):
+        """Returns a healthy connection to a host, connecting if needed
+
+        Args:
+            host (str): The hostname or IP address of the host
+            credentials (dict): Credentials (user, password, ssh_key_path)
+                for the host
+            port (int, optional): The SSH port of the host
+            timeout (float, optional): The number of seconds to wait for a
+                new connection
+
+        Returns:
+            SSHClient: The connection
+        """
+        self.evict_idle()
+        key = connection_key(host, credentials, port)
+        with self._lock:
+            entry = self._connections.get(key)
+            if entry is not None:
+                if is_healthy(entry[0]):
+                    entry[1] = time.time()
+                    return entry[0]
+                del self._connections[key]
+                _close(entry[0])
+
+        ssh = setup_ssh_connection(host, credentials, port=port,
+                                   timeout=timeout)
+        with self._lock:
+            entry = self._connections.get(key)
+            if entry is not None:
+                # Another thread connected at the same time
+                _close(ssh)
+                entry[1] = time.time()
+                return entry[0]
+            self._connections[key] = [ssh, time.time()]
+        return ssh
+
+    def add(self, host, credentials, ssh_connection, port=22):
+        """Adds an already authenticated connection to the pool
+
+        Args:
+            host (str): The hostname or IP address of the host
+            credentials (dict): The credentials used for the connection
+            ssh_connection (:obj: `SSHClient`): The connection
+            port (int, optional): The SSH port of the host
+
+        """
+        key = connection_key(host, credentials, port)
+        with self._lock:
+            entry = self._connections.get(key)
+            if entry is not None and entry[0] is not ssh_connection:
+                _close(entry[0])
+            self._connections[key] = [ssh_connection, time.time()]
+
+    def discard(self, host, credentials, port=22):
+        """Closes and removes the connection to a host
+
+        Args:
+            host (str): The hostname or IP address of the host
+            credentials (dict): The credentials of the connection
+            port (int, optional): The SSH port of the host
+
+        """
+        key = connection_key(host, credentials, port)
+        with self._lock:
+            entry = self._connections.pop(key, None)
+        if entry is not None:
+            _close(entry[0])
+
+    def evict_idle(self):
+        """Closes the connections that were not used for the idle timeout"""
+        cutoff = time.time() - self.idle_timeout
+        with self._lock:
+            idle = [key for key, (_, last_used) in self._connections.items()
+                    if last_used < cutoff]
+            entries = [self._connections.pop(key) for key in idle]
+        for ssh, _ in entries:
+            _close(ssh)
+
+    def close(self):
+        """Closes all connections of the pool"""
+        with self._lock:
+            entries = self._connections.values()
+            self._connections = {}
+        for ssh, _ in entries:
+            _close(ssh)
+
+    def __len__(self):
+        return len(self._connections)
+
+
+def connection_key(host, credentials, port):
+    """Returns the key of a connection in a connection pool
+
+    Args:
+        host (str): The hostname or IP address of the host
+        credentials (dict): Credentials (user, password, ssh_key_path)
+        port (int): The SSH port of the host
+
+    Returns:
+        tuple: The key
+    """
+    return (host, int(port or 22), credentials['user'],
+            credentials.get('password'), credentials.get('ssh_key_path'))
+
+
+def is_healthy(ssh_connection):
+    """Checks whether an SSH connection can still be used
+
+    Args:
+        ssh_connection (:obj: `SSHClient`): The connection
+
+    Returns:
+        bool: True if the connection is open and authenticated
+    """
+    transport = ssh_connection.get_transport()
+    if transport is None or not transport.is_active() or \
+            not transport.is_authenticated():
+        return False
+    try:
+        # Fails if the connection was dropped without the transport noticing
+        transport.send_ignore()
+    except Exception:
+        return False
+    return True
+
+
+def _close(ssh_connection):
+    try:
+        ssh_connection.close()
+    except Exception:
+        pass
+
+
+# Used by the remote helpers when no pool is passed in
+default_pool = SSHConnectionPool()
+
+
 def fetch_remote_artifact(target_machine, target_credentials,
                           remote_file_path, artifacts_directory,
                           target_port=22,
-                          connect_from_host={'host': 'localhost'}):
+                          connect_from_host={'host': 'localhost'},
+                          pool=None, transfer='tar', compression='auto',
+                          compression_level=None, file_type=None):
     """Fetch an artifact from a remote machine
 
     Heler function to facilitate fetching the file or directory at a
-    specific path from a remote machine using scp
+    specific path from a remote machine. The SSH connection is taken from a
+    connection pool, so fetching many artifacts from the same host only logs
+    in once.
+
+    Files are copied with scp. Directories are streamed as a compressed tar
+    archive over a single channel and unpacked locally as the data arrives
+    (see fetch_directory_tar), unless transfer is "scp" or the remote host
+    has no tar, in which case scp copies them file by file.
+
+    With the "sync" transfer, files and directories are synced instead (see
+    cvengine.util.sync.sync_remote_artifact): only new and changed files are
+    fetched, and large files resume where an earlier transfer stopped. If
+    the connection drops, the sync is retried over a new connection.
 
     Args:
         target_machine (str): The IP address or hostname of the remote machine
@@ -93,42 +429,288 @@ def fetch_remote_artifact(target_machine, target_credentials,
         artifacts_directory (str): The local path that the fetched artifact
             should be written to
         connect_from_host (dict, optional): Unused
+        pool (SSHConnectionPool, optional): The pool to take the connection
+            from. Defaults to the module level default_pool.
+        transfer (str, optional): How directories are fetched, one of
+            TRANSFER_METHODS. Defaults to "tar".
+        compression (str, optional): The compression of the tar stream, one
+            of COMPRESSIONS. Defaults to "auto".
+        compression_level (int, optional): The compression level. Defaults to
+            the default level of the compressor.
+        file_type (str, optional): The type of the remote path as returned
+            by get_file_type, if it is already known (see
+            stat_remote_paths). Looked up if not given.
 
     Todo:
         * Remote the unused connect_from_host argument
 
     Raises:
-        Exception: A generic exception if the target artifact does not exist
-            on the remote host
+        ArtifactMissing: If the target artifact does not exist on the remote
+            host
+        Exception: A generic exception if the tar stream could not be
+            unpacked
+        ValueError: If transfer or compression is not supported
 
     """
+    if transfer not in TRANSFER_METHODS:
+        msg = '{0} is not a valid artifact transfer method. Supported ' \
+              'values are: {1}'
+        raise ValueError(msg.format(transfer, TRANSFER_METHODS))
+    if compression not in COMPRESSIONS:
+        msg = '{0} is not a valid artifact compression. Supported values ' \
+              'are: {1}'
+        raise ValueError(msg.format(compression, COMPRESSIONS))
 
     if not os.path.isdir(artifacts_directory):
         os.makedirs(artifacts_directory)
     target_basename = os.path.basename(remote_file_path)
     destination_path = os.path.join(artifacts_directory, target_basename)
 
-    ssh_connection = setup_ssh_connection(target_machine,
-                                          target_credentials,
+    if pool is None:
+        pool = default_pool
+    ssh_connection = pool.get(target_machine, target_credentials,
+                              port=target_port)
+
+    if file_type is None:
+        file_type = get_file_type(ssh_connection, remote_file_path)
+    if file_type == 'DoesNotExist':
+        msg = 'The specified file {0} does not exist'
+        full_msg = msg.format(remote_file_path)
+        logging.error(full_msg)
+        raise ArtifactMissing(full_msg)
+    elif file_type == 'Directory':
+        target_is_directory = True
+    else:
+        target_is_directory = False
+
+    if transfer == 'sync':
+        # Imported here because cvengine.util.sync imports this module
+        from .sync import SyncUnavailable, sync_remote_artifact
+        for attempt in range(SYNC_ATTEMPTS):
+            try:
+                compressor = select_compressor(ssh_connection, compression)
+                if compressor is None:
+                    raise SyncUnavailable('tar is not available')
+                sync_remote_artifact(ssh_connection, remote_file_path,
+                                     artifacts_directory, compressor,
+                                     compression_level)
+                return
+            except SyncUnavailable as e:
+                logging.warning('Unable to sync %s from %s (%s), fetching it '
+                                'instead', remote_file_path, target_machine,
+                                e)
+                transfer = 'tar'
+                break
+            except (socket.error, EOFError, paramiko.SSHException):
+                if attempt == SYNC_ATTEMPTS - 1:
+                    raise
+                logging.warning('Connection to %s dropped while syncing %s, '
+                                'retrying', target_machine, remote_file_path)
+                pool.discard(target_machine, target_credentials,
+                             port=target_port)
+                ssh_connection = pool.get(target_machine, target_credentials,
                                           port=target_port)
 
+    if target_is_directory and transfer == 'tar':
+        compressor = select_compressor(ssh_connection, compression)
+        if compressor is not None:
+            fetch_directory_tar(ssh_connection, remote_file_path,
+                                artifacts_directory, compressor,
+                                compression_level)
+            return
+        logging.warning('tar is not available on %s, fetching %s with scp',
+                        target_machine, remote_file_path)
+
+    scp_connection = scp.SCPClient(ssh_connection.get_transport())
     try:
-        file_type = get_file_type(ssh_connection, remote_file_path)
-        if file_type == 'DoesNotExist':
-            msg = 'The specified file {0} does not exist'
-            full_msg = msg.format(remote_file_path)
-            logging.error(full_msg)
-            raise Exception(full_msg)
-        elif file_type == 'Directory':
-            target_is_directory = True
-        else:
-            target_is_directory = False
-
-        scp_connection = scp.SCPClient(ssh_connection.get_transport())
         scp_connection.get(remote_file_path, local_path=destination_path,
                            recursive=target_is_directory)
     finally:
+        scp_connection.close()
+
+
+def remote_compressors(ssh_connection):
+    """Lists the compressors a remote host can produce a tar stream with
+
+    The result is cached for the lifetime of the connection.
+
+    Args:
+        ssh_connection (:obj: `SSHClient`): The connection to the host
+
+    Returns:
+        list: The names of the installed compressors of COMPRESSORS, or None
+            if tar is not installed
+    """
+    transport = ssh_connection.get_transport()
+    with _remote_compressors_lock:
+        if transport in _remote_compressors:
+            return _remote_compressors[transport]
+    probe = 'command -v tar >/dev/null 2>&1 || exit 3; ' + ''.join(
+        'command -v {0} >/dev/null 2>&1 && echo {0}; '.format(name)
+        for name in COMPRESSORS) + 'true'
+    stdin, stdout, stderr = ssh_connection.exec_command(probe)
+    output = stdout.read()
+    if stdout.channel.recv_exit_status() != 0:
+        compressors = None
+    else:
+        compressors = [name for name in output.split() if name in COMPRESSORS]
+    with _remote_compressors_lock:
+        _remote_compressors[transport] = compressors
+    return compressors
+
+
+def select_compressor(ssh_connection, compression='auto'):
+    """Picks the compression for a tar stream from a remote host
+
+    A compressor has to be installed on both ends. If the requested one is
+    not, the best available one is used instead.
+
+    Args:
+        ssh_connection (:obj: `SSHClient`): The connection to the host
+        compression (str, optional): The requested compression, one of
+            COMPRESSIONS
+
+    Returns:
+        str: The compressor to use ("none" for an uncompressed stream), or
+            None if a tar stream cannot be used
+    """
+    if not find_executable('tar'):
+        return None
+    remote = remote_compressors(ssh_connection)
+    if remote is None:
+        return None
+    if compression == 'none':
+        return 'none'
+    available = [name for name in COMPRESSORS
+                 if name in remote and find_executable(name)]
+    if compression in available:
+        return compression
+    if compression != 'auto':
+        logging.warning('%s is not available on both hosts, using %s',
+                        compression, available[0] if available else 'none')
+    return available[0] if available else 'none'
+
+
+def fetch_directory_tar(ssh_connection, remote_path, artifacts_directory,
+                        compressor='gzip', compression_level=None,
+                        members=None):
+    """Fetch a remote directory as a compressed tar stream
+
+    Runs tar piped into the compressor on the remote host and feeds its
+    output into a local tar process as it arrives, so a tree of many small
+    files costs one channel instead of a round trip per file, and nothing is
+    written to a temporary file. The directory is unpacked into the artifacts
+    directory under its own name, like scp does.
+
+    Files that the remote tar cannot read are skipped with a warning.
+
+    Args:
+        ssh_connection (:obj: `SSHClient`): The connection to the host
+        remote_path (str): The path of the remote directory
+        artifacts_directory (str): The local directory to unpack into
+        compressor (str, optional): "zstd", "gzip" or "none"
+        compression_level (int, optional): The compression level. Defaults to
+            the default level of the compressor.
+        members (list, optional): Only fetch these files, given as paths
+            relative to the directory. The names are passed to the remote
+            tar on its standard input, which needs GNU tar.
+
+    Raises:
+        Exception: A generic exception if the stream could not be unpacked
+
+    Returns:
+        int: The number of bytes received
+
+    """
+    # Imported here because cvengine.util.run imports this module
+    from .run import check_deadline
+
+    parent, base = os.path.split(remote_path.rstrip('/'))
+    if members is None:
+        remote_cmd = 'tar -C {0} -cf - {1}'.format(pipes.quote(parent or '/'),
+                                                   pipes.quote(base))
+    else:
+        remote_cmd = 'tar -C {0} -cf - --null -T -'.format(
+            pipes.quote(parent or '/'))
+        names = ''.join(os.path.join(base, member).rstrip('/') + '\0'
+                        for member in members)
+    extract_cmd = ['tar', '-x', '-f', '-', '-C', artifacts_directory]
+    if compressor == 'none':
+        # The exit status of a pipeline is that of its last command, so
+        # warnings of tar itself (such as files changing while they are read)
+        # are not treated as failures for any compressor
+        remote_cmd += ' | cat'
+    else:
+        level = ''
+        if compression_level is not None:
+            level = ' -{0}'.format(int(compression_level))
+        remote_cmd += ' | {0}{1} -c'.format(compressor, level)
+        extract_cmd.insert(1, '--use-compress-program={0}'.format(compressor))
+
+    received = 0
+    remote_errors = ''
+    local_errors = tempfile.TemporaryFile()
+    with trace.span('artifact.tar_stream', path=remote_path,
+                    compressor=compressor) as span:
+        channel = ssh_connection.get_transport().open_session()
+        channel.settimeout(TRANSFER_POLL_INTERVAL)
+        extract = subprocess.Popen(extract_cmd, stdin=subprocess.PIPE,
+                                   stderr=local_errors)
         try:
-            ssh_connection.close()
-        except Exception:
-            pass
+            channel.exec_command(remote_cmd)
+            if members is None:
+                channel.shutdown_write()
+            else:
+                # Sent from another thread, as tar starts writing the archive
+                # before it read all of the names
+                send_input(channel, names)
+            while True:
+                check_deadline()
+                # Drain stderr too, it shares the flow control window
+                while channel.recv_stderr_ready():
+                    remote_errors += channel.recv_stderr(TRANSFER_READ_SIZE)
+                    remote_errors = remote_errors[-TRANSFER_READ_SIZE:]
+                try:
+                    data = channel.recv(TRANSFER_READ_SIZE)
+                except socket.timeout:
+                    continue
+                if not data:
+                    break
+                received += len(data)
+                try:
+                    extract.stdin.write(data)
+                except IOError:
+                    # The local tar exited, its status tells why
+                    break
+            try:
+                extract.stdin.close()
+            except IOError:
+                pass
+            local_rc = extract.wait()
+            if local_rc != 0:
+                # Stop the remote side, which may be blocked on a full window
+                channel.close()
+                remote_rc = None
+            else:
+                remote_rc = channel.recv_exit_status()
+                while channel.recv_stderr_ready():
+                    remote_errors += channel.recv_stderr(TRANSFER_READ_SIZE)
+        finally:
+            channel.close()
+            if extract.poll() is None:
+                extract.kill()
+                extract.wait()
+        span.set('bytes', received)
+
+    local_errors.seek(0)
+    errors = local_errors.read().strip()
+    local_errors.close()
+    if remote_errors:
+        logging.warning('Remote tar of %s reported: %s', remote_path,
+                        remote_errors.strip())
+    if local_rc != 0 or remote_rc != 0:
+        msg = 'Failed to fetch {0} as a tar stream (remote rc {1}, local ' \
+              'rc {2}): {3}'
+        raise Exception(msg.format(remote_path, remote_rc, local_rc,
+                                   errors or remote_errors.strip()))
+    return received
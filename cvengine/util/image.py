@@ -0,0 +1,375 @@
+import json
+import os
+import pipes
+import subprocess
+import tarfile
+import threading
+import time
+import traceback
+import urlparse
+
+from distutils.spawn import find_executable
+
+from . import run, trace
+from .fetch import COMPRESSORS, remote_compressors
+
+
+# "pulled" and "loaded" images were transferred to the host, while "present"
+# ones were already there
+IMAGE_PULL_STATUSES = ('pulled', 'loaded', 'present', 'failed', 'skipped')
+# Prefix of the line the pull command prints with the ID of the image
+IMAGE_ID_STATUS = 'CVENGINE_IMAGE_ID'
+# How often a thread waiting for a pull wakes up to notice cancellation
+WAIT_INTERVAL = 1
+# image_url values with these suffixes point to image archives, which
+# docker cannot pull
+ARCHIVE_SUFFIXES = ('.tar', '.tar.gz', '.tgz', '.tar.xz', '.tar.bz2')
+# URL schemes of image archives that cvengine downloads and loads itself
+ARCHIVE_SCHEMES = ('http', 'https', 'file')
+# The first bytes of archives that are compressed already, which docker load
+# unpacks itself
+COMPRESSED_MAGIC = ('\x1f\x8b', 'BZh', '\xfd7zXZ\x00', '\x28\xb5\x2f\xfd')
+# Suffix of the file next to a cached archive that holds its image ID
+IMAGE_ID_SUFFIX = '.image_id'
+STREAM_READ_SIZE = 65536
+
+
+def pullable(image_url):
+    """Returns whether an image_url is a reference docker can pull
+
+    Args:
+        image_url (str): The location of the container image
+
+    Returns:
+        bool: False for URLs, local paths and image archives
+    """
+    return bool(image_url) and '://' not in image_url and \
+        not image_url.startswith(('/', '.')) and \
+        not image_url.endswith(ARCHIVE_SUFFIXES)
+
+
+def image_archive_url(image_url):
+    """Returns whether an image_url points to an image archive to download
+
+    Args:
+        image_url (str): The location of the container image
+
+    Returns:
+        bool: True for http(s) and file URLs
+    """
+    return bool(image_url) and \
+        urlparse.urlsplit(image_url).scheme in ARCHIVE_SCHEMES
+
+
+def image_pull_script(image_url):
+    """Builds the command pulling an image and printing its ID
+
+    Args:
+        image_url (str): The image reference
+
+    Returns:
+        str: The shell command
+    """
+    quoted = pipes.quote(image_url)
+    return ("docker pull {0} && echo {1} "
+            "$(docker inspect --format '{{{{.Id}}}}' {0})").format(
+                quoted, IMAGE_ID_STATUS)
+
+
+def parse_image_pull_output(lines):
+    """Reads the digest and ID of the image from the output of a pull
+
+    Args:
+        lines (list): The output lines of image_pull_script
+
+    Returns:
+        str: The digest of the image in the registry, or None
+        str: The ID of the image on the host, or None
+    """
+    digest = None
+    image_id = None
+    for line in lines:
+        line = line.strip()
+        if line.startswith('Digest:'):
+            digest = line.split(':', 1)[1].strip()
+        elif line.startswith(IMAGE_ID_STATUS + ' '):
+            image_id = line.split(' ', 1)[1].strip() or None
+    return digest, image_id
+
+
+def pull_image(run_host_cmd, image_url):
+    """Pulls an image on a host
+
+    Args:
+        run_host_cmd (callable): Runs a shell command on the host and
+            returns the last lines of its output, such as
+            BasePlatformHandler.run_host_cmd
+        image_url (str): The image reference
+
+    Raises:
+        CommandError: If the pull failed
+
+    Returns:
+        dict: The "status", "digest" and "image_id" of the image
+    """
+    lines = run_host_cmd(image_pull_script(image_url))
+    digest, image_id = parse_image_pull_output(lines)
+    return {'status': 'pulled', 'digest': digest, 'image_id': image_id}
+
+
+def archive_image_id(path):
+    """Reads the ID of the image in an archive written by docker save
+
+    The ID is the digest of the image config named by the manifest.json of
+    the archive. As finding it means reading through the archive, the ID is
+    kept in a file next to the archive, which goes away with it when the
+    download cache evicts the archive.
+
+    Args:
+        path (str): The path of the archive, which may be compressed
+
+    Returns:
+        str: The image ID, or None if the archive has no docker manifest
+    """
+    id_path = path + IMAGE_ID_SUFFIX
+    try:
+        with open(id_path) as f:
+            return f.read().strip() or None
+    except IOError:
+        pass
+
+    image_id = None
+    try:
+        with tarfile.open(path, 'r:*') as archive:
+            for member in archive:
+                if member.name.lstrip('./') != 'manifest.json':
+                    continue
+                manifest = json.load(archive.extractfile(member))
+                config = os.path.basename(manifest[0]['Config'])
+                if config.endswith('.json'):
+                    config = config[:-len('.json')]
+                image_id = 'sha256:' + config
+                break
+    except (tarfile.TarError, ValueError, KeyError, IndexError) as e:
+        print('Unable to read the image ID of {0}: {1}'.format(path, e))
+    with open(id_path, 'w') as f:
+        f.write(image_id or '')
+    return image_id
+
+
+def image_present_script(image_id):
+    """Builds the command printing the ID of an image if the host has it
+
+    Args:
+        image_id (str): The image ID
+
+    Returns:
+        str: The shell command
+    """
+    return ("docker inspect --type=image --format '{{{{.Id}}}}' {0} "
+            "2>/dev/null || true").format(pipes.quote(image_id))
+
+
+def parse_image_load_output(lines):
+    """Reads the image that docker load loaded from its output
+
+    Args:
+        lines (list): The output lines of docker load
+
+    Returns:
+        str: The ID (for untagged images) or name of the loaded image, or
+            None
+    """
+    loaded = None
+    for line in lines:
+        for prefix in ('Loaded image ID:', 'Loaded image:'):
+            if line.startswith(prefix):
+                loaded = line[len(prefix):].strip()
+    return loaded
+
+
+def load_image_archive(executor, cache, image_url, compression='auto',
+                       compression_level=None):
+    """Loads an image archive into docker on a remote host
+
+    The archive is downloaded into the content-addressed download cache, so
+    it is only fetched again when it changed. If the host already has the
+    image, nothing is transferred. Otherwise the archive is streamed over
+    SSH straight into docker load, without a copy on the host. Archives
+    that are not compressed yet are compressed on the way with the best
+    compressor installed on both ends.
+
+    Args:
+        executor (:obj: `RemoteExecutor`): Runs commands on the host
+        cache (:obj: `DownloadCache`): The cache to download the archive
+            into
+        image_url (str): The URL of the archive
+        compression (str, optional): The compression of the stream, one of
+            cvengine.util.fetch.COMPRESSIONS
+        compression_level (int, optional): The compression level. Defaults
+            to the default level of the compressor.
+
+    Raises:
+        CommandError: If docker load failed
+
+    Returns:
+        dict: The "status" ("loaded" or "present"), "image_id" and "digest"
+            of the image, along with the sha256 of the archive as
+            "archive_sha256" and the number of bytes sent as "bytes"
+    """
+    with trace.span('image_archive_download', url=image_url):
+        path, sha256 = cache.fetch_with_digest(image_url)
+    image_id = archive_image_id(path)
+    result = {'status': 'present', 'image_id': image_id, 'digest': None,
+              'archive_sha256': sha256, 'bytes': 0}
+    if image_id is not None and image_id in [
+            line.strip() for line in
+            executor.run(image_present_script(image_id))]:
+        print('{0} already has image {1}, not transferring {2}'.format(
+            executor.host, image_id, image_url))
+        return result
+
+    with open(path, 'rb') as f:
+        magic = f.read(6)
+    compressor = 'none'
+    if compression != 'none' and not magic.startswith(COMPRESSED_MAGIC):
+        available = [name for name in COMPRESSORS
+                     if name in (remote_compressors(executor.connect()) or [])
+                     and find_executable(name)]
+        if compression in available:
+            compressor = compression
+        elif available:
+            compressor = available[0]
+
+    load_cmd = 'docker load'
+    compress = None
+    with open(path, 'rb') as archive, \
+            trace.span('image_archive_load', url=image_url,
+                       compressor=compressor) as span:
+        stream = _CountingReader(archive)
+        if compressor != 'none':
+            level = []
+            if compression_level is not None:
+                level = ['-{0}'.format(int(compression_level))]
+            compress = subprocess.Popen([compressor, '-c'] + level,
+                                        stdin=archive,
+                                        stdout=subprocess.PIPE)
+            stream = _CountingReader(compress.stdout)
+            load_cmd = '{0} -dc | docker load'.format(compressor)
+        try:
+            lines = executor.run(load_cmd, stdin=stream)
+        finally:
+            if compress is not None:
+                if compress.poll() is None:
+                    compress.kill()
+                compress.wait()
+        span.set('bytes', stream.count)
+    loaded = parse_image_load_output(lines)
+    if image_id is None and loaded and loaded.startswith('sha256:'):
+        image_id = loaded
+    result.update(status='loaded', image_id=image_id, bytes=stream.count)
+    return result
+
+
+class _CountingReader(object):
+    """Wraps a file object and counts the bytes read from it"""
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.count = 0
+
+    def read(self, size=STREAM_READ_SIZE):
+        data = self.fileobj.read(size)
+        self.count += len(data)
+        return data
+
+
+class ImagePull(object):
+    """Brings the image under validation onto a host in the background
+
+    The pull runs on a thread of its own, in the run context and under the
+    tracer of the thread that started it, while that thread carries on with
+    setting up the platform. The pull has a deadline of its own instead of
+    the deadlines of the phases running at the same time.
+
+    Attributes:
+        image_url (str): The image reference
+        timeout (float): The number of seconds the pull may take, or None
+        result (dict): The outcome of the pull, once it finished. See wait.
+    """
+    def __init__(self, pull, image_url, timeout=None):
+        """
+        Args:
+            pull (callable): Brings the image onto the host, such as
+                pull_image or load_image_archive with their other arguments
+                bound. Called with the image_url, it returns a dictionary
+                with the "status", "digest" and "image_id" of the image.
+            image_url (str): The location of the image
+            timeout (float, optional): The number of seconds the pull may
+                take
+        """
+        self.pull = pull
+        self.image_url = image_url
+        self.timeout = timeout
+        self.result = None
+        self._cancel_token = run.CancelToken()
+        self._done = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Starts the pull on a background thread"""
+        context = run.current_context()
+        context['cancel_token'] = self._cancel_token
+        context['deadline'] = None
+        tracer = trace.current_tracer()
+        parent = tracer.current_span() if tracer is not None else None
+        self._thread = threading.Thread(target=self._pull,
+                                        args=(context, tracer, parent))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _pull(self, context, tracer, parent):
+        result = {'status': 'failed', 'digest': None, 'image_id': None}
+        start_time = time.time()
+        try:
+            with run.adopt_context(context), \
+                    trace.activate(tracer, parent=parent), \
+                    trace.span('image_pull', image_url=self.image_url) as span:
+                try:
+                    with run.phase(self.timeout):
+                        result.update(self.pull(self.image_url))
+                finally:
+                    span.set('status', result['status'])
+        except Exception as e:
+            print('Pre-pulling {0} failed: {1}'.format(
+                self.image_url, traceback.format_exc()))
+            result['error'] = str(e)
+        finally:
+            result['duration'] = time.time() - start_time
+            self.result = result
+            self._done.set()
+
+    def wait(self):
+        """Waits for the pull to finish
+
+        Raises:
+            Cancelled: If the run of the waiting thread was cancelled
+            DeadlineExceeded: If the deadline of its current phase passed
+
+        Returns:
+            dict: The result of the pull function along with the "duration"
+                of the pull, or the "error" if it failed. The "status" is
+                one of IMAGE_PULL_STATUSES, and the "digest" and "image_id"
+                of the image are None if they are not known.
+        """
+        if self._thread is None:
+            return {'status': 'skipped', 'digest': None, 'image_id': None}
+        while not self._done.wait(WAIT_INTERVAL):
+            run.check_deadline()
+        return self.result
+
+    def cancel(self):
+        """Stops the pull if it is still running, and waits for it"""
+        if self._thread is None:
+            return
+        self._cancel_token.cancel('The image pull is no longer needed')
+        self._thread.join()
@@ -0,0 +1,264 @@
+import pipes
+import select
+import time
+import uuid
+
+from collections import deque
+
+from . import trace
+from .fetch import SSHConnectionPool, send_input
+from .run import CommandError, CommandTimeout, DEFAULT_TAIL_LINES, \
+    KILL_GRACE_PERIOD, OutputRecorder, POLL_INTERVAL, READ_SIZE, \
+    check_deadline, command_deadline, command_log_path, open_log
+
+
+# Seconds to wait for the remote host to stop a command, on top of the
+# grace period the command gets to exit after SIGTERM
+TERMINATE_TIMEOUT = 10
+
+
+class RemoteExecutor(object):
+    """Runs commands on a remote host over one persistent SSH connection
+
+    Launching "ansible all -m command" for a single remote command costs a
+    python interpreter start, inventory parsing and a new SSH handshake. The
+    executor instead takes its connection from an SSH connection pool and
+    runs each command on a new channel of it. The pool can be shared with
+    the artifact fetching helpers of cvengine.util.fetch, so all of them use
+    the same login. Channels can be opened from several threads at once.
+
+    Commands are run through the login shell of the remote user. Output is
+    streamed, logged and kept in a bounded tail in the same way as run_cmd,
+    and commands are subject to the same timeouts and cancellation. Each
+    command runs in a session of its own on the remote host. Closing the
+    channel does not stop a remote command, so a command that times out or
+    is cancelled has its session killed, like run_cmd kills the process
+    group of a local command.
+
+    Attributes:
+        host (str): The hostname or IP address of the remote host
+        credentials (dict): The credentials (user, password, ssh_key_path)
+            for the remote host
+        port (int): The SSH port of the remote host
+    """
+    def __init__(self, host, credentials, port=22, ssh_connection=None,
+                 pool=None):
+        """
+        Args:
+            host (str): The hostname or IP address of the remote host
+            credentials (dict): The credentials for the remote host
+            port (int, optional): The SSH port of the remote host
+            ssh_connection (:obj: `SSHClient`, optional): An already
+                authenticated connection to the host to be used instead of
+                opening a new one
+            pool (SSHConnectionPool, optional): The pool to take the
+                connection from. The pool is left open by close(). Defaults
+                to a pool of the executor's own.
+        """
+        self.host = host
+        self.credentials = credentials
+        self.port = port
+        self._owns_pool = pool is None
+        self._pool = pool if pool is not None else SSHConnectionPool()
+        if ssh_connection is not None:
+            self._pool.add(host, credentials, ssh_connection, port=port)
+        self._sudo_needs_password = None
+
+    def connect(self):
+        """Returns the SSH connection, opening it on first use
+
+        A connection that died is replaced by a new one.
+
+        Returns:
+            SSHClient: The authenticated connection to the remote host
+        """
+        return self._pool.get(self.host, self.credentials, port=self.port)
+
+    def close(self):
+        """Closes the SSH connection if the executor owns its pool"""
+        if self._owns_pool:
+            self._pool.close()
+
+    def run(self, cmd, sudo=True, timeout=None,
+            tail_lines=DEFAULT_TAIL_LINES, stdin=None):
+        """Runs a command on the remote host
+
+        Args:
+            cmd (str): The shell command to be executed
+            sudo (bool, optional): Whether to run the command with escalated
+                privileges. Ignored when connected as root. Defaults to True.
+            timeout (float, optional): The number of seconds the command may
+                run. Defaults to the command timeout of the current thread.
+            tail_lines (int, optional): The number of output lines to keep in
+                memory
+            stdin (file, optional): A file object streamed to the standard
+                input of the command while its output is read. If sudo needs
+                a password, the password is sent before it.
+
+        Raises:
+            CommandError: If the command returns a non-zero return code
+            CommandTimeout: If the command did not finish in time
+            Cancelled: If the run was cancelled while the command was running
+
+        Returns:
+            list: The last lines of output of the command
+
+        """
+        print('Running on {0}: {1}'.format(self.host, cmd))
+        log_path = command_log_path(cmd)
+        check_deadline()
+        deadline = command_deadline(timeout)
+        tail = deque(maxlen=tail_lines)
+
+        with trace.span('remote_command', host=self.host, cmd=cmd,
+                        log=log_path) as span:
+            tag = 'cvengine-cmd-{0}'.format(uuid.uuid4().hex)
+            full_cmd, password = self._wrap(in_session(cmd, tag), sudo)
+            channel = self.connect().get_transport().open_session()
+            log_file = open_log(log_path)
+            try:
+                channel.exec_command(full_cmd)
+                if password is not None:
+                    channel.sendall(password + '\n')
+                if stdin is None:
+                    channel.shutdown_write()
+                else:
+                    send_input(channel, stdin)
+                self._stream(channel, OutputRecorder(log_file, tail),
+                             deadline, cmd, tail, log_path)
+                rc = channel.recv_exit_status()
+            except BaseException:
+                self._terminate(tag, sudo)
+                raise
+            finally:
+                channel.close()
+                if log_file:
+                    log_file.close()
+            span.set('returncode', rc)
+
+        if rc != 0:
+            print('Non-success return code: ' + str(rc))
+            raise CommandError(cmd, rc, list(tail), log_path)
+        return list(tail)
+
+    def _stream(self, channel, recorder, deadline, cmd, tail, log_path):
+        """Reads the output of a channel until the command exits
+
+        Args:
+            channel (:obj: `Channel`): The channel running the command
+            recorder (OutputRecorder): Records the output
+            deadline (float): The time the command has to finish by, or None
+            cmd (str): The command, for error reporting
+            tail (:obj: `collections.deque`): The tail of the output
+            log_path (str): The path of the command log, or None
+
+        Raises:
+            CommandTimeout: If the deadline passes
+            Cancelled: If the run is cancelled
+
+        """
+        while True:
+            select.select([channel], [], [], POLL_INTERVAL)
+            if deadline is not None and time.time() > deadline:
+                raise CommandTimeout(cmd, list(tail), log_path)
+            check_deadline()
+            while channel.recv_ready():
+                recorder.feed('stdout', channel.recv(READ_SIZE))
+            while channel.recv_stderr_ready():
+                recorder.feed('stderr', channel.recv_stderr(READ_SIZE))
+            if (channel.exit_status_ready() and channel.eof_received and
+                    not channel.recv_ready() and
+                    not channel.recv_stderr_ready()):
+                break
+        recorder.close('stdout')
+        recorder.close('stderr')
+
+    def _terminate(self, tag, sudo):
+        """Kills a command started by run along with its session
+
+        The session first gets SIGTERM, then SIGKILL if it is still running
+        after the grace period. Failures are only printed, as this runs
+        while another error is being raised.
+
+        Args:
+            tag (str): The tag the command was started with (see in_session)
+            sudo (bool): Whether the command was run with sudo
+
+        """
+        # The bracket keeps the pattern from matching this command itself
+        pattern = pipes.quote('{0}[{1}]'.format(tag[:-1], tag[-1]))
+        script = ('stop() {{ for pid in $(pgrep -f {0}); do '
+                  'pkill -$1 -s $pid; kill -$1 $pid; done; }} 2>/dev/null; '
+                  'stop TERM; i=0; '
+                  'while [ $i -lt {1} ] && pgrep -f {0} >/dev/null; do '
+                  'sleep 1; i=$((i + 1)); done; '
+                  'stop KILL').format(pattern, int(KILL_GRACE_PERIOD))
+        full_cmd, password = self._wrap(script, sudo)
+        try:
+            channel = self.connect().get_transport().open_session()
+            try:
+                channel.exec_command(full_cmd)
+                if password is not None:
+                    channel.sendall(password + '\n')
+                channel.shutdown_write()
+                end_time = time.time() + KILL_GRACE_PERIOD + \
+                    TERMINATE_TIMEOUT
+                while not channel.exit_status_ready() and \
+                        time.time() < end_time:
+                    time.sleep(0.1)
+            finally:
+                channel.close()
+        except Exception as e:
+            print('Unable to stop the command on {0}: {1}'.format(self.host,
+                                                                  e))
+
+    def _wrap(self, cmd, sudo):
+        """Wraps a command so that it runs with escalated privileges
+
+        Args:
+            cmd (str): The shell command
+            sudo (bool): Whether to escalate privileges
+
+        Returns:
+            str: The command to execute
+            str: The password that has to be sent to sudo on stdin, or None
+        """
+        if not sudo or self.credentials.get('user') == 'root':
+            return cmd, None
+        password = self.credentials.get('password')
+        if self._sudo_needs_password is None:
+            if password:
+                channel = self.connect().exec_command('sudo -n true')[1] \
+                    .channel
+                try:
+                    rc = channel.recv_exit_status()
+                finally:
+                    channel.close()
+                self._sudo_needs_password = rc != 0
+            else:
+                self._sudo_needs_password = False
+        quoted = pipes.quote(cmd)
+        if self._sudo_needs_password:
+            return "sudo -S -p '' sh -c {0}".format(quoted), password
+        return 'sudo -n sh -c {0}'.format(quoted), None
+
+
+def in_session(cmd, tag):
+    """Wraps a command so that it runs in a session of its own
+
+    The command is started by the shell of the user, named ($0) after the
+    tag, which finds the session again to kill it. Hosts whose setsid
+    cannot wait for the command run it in the session of the SSH channel
+    instead.
+
+    Args:
+        cmd (str): The shell command
+        tag (str): A unique name for the command
+
+    Returns:
+        str: The command to execute
+    """
+    args = '{0} {1}'.format(pipes.quote(cmd), pipes.quote(tag))
+    return ('if setsid -w true >/dev/null 2>&1; '
+            'then exec setsid -w "${{SHELL:-/bin/sh}}" -c {0}; '
+            'else exec "${{SHELL:-/bin/sh}}" -c {0}; fi').format(args)
@@ -1,17 +1,365 @@
+import datetime
+import errno
+import itertools
+import os
+import random
+import re
+import select
+import signal
+import socket
+import sys
+import threading
 import time
 import traceback
 
+from . import trace
 from .fetch import setup_ssh_connection
+from collections import deque
+from contextlib import contextmanager
+from multiprocessing import TimeoutError
 from subprocess import Popen, PIPE
 
 
-def run_cmd(cmd, virtualenv=None, working_directory=None, env_vars={}):
+# Number of output lines kept in memory for each command
+DEFAULT_TAIL_LINES = 200
+# Number of output lines included in the error raised for a failed command
+ERROR_TAIL_LINES = 20
+READ_SIZE = 64 * 1024
+# How often a running command checks its deadline and cancellation token
+POLL_INTERVAL = 0.5
+# Seconds a process group gets to exit after SIGTERM before it is killed
+KILL_GRACE_PERIOD = 5
+# The first interval between two probes of wait_for_ssh, and the longest
+# time a single probe may take
+SSH_PROBE_INTERVAL = 0.5
+SSH_PROBE_TIMEOUT = 10
+# Written by cloud-init once it has run all of its modules
+CLOUD_INIT_MARKER = '/var/lib/cloud/instance/boot-finished'
+
+_command_logs = threading.local()
+_run_context = threading.local()
+_command_ids = itertools.count(1)
+
+
+class CommandError(Exception):
+    """Raised when a command run by run_cmd fails
+
+    Attributes:
+        cmd (str): The command that failed
+        returncode (int): The return code of the command
+        tail (list): The last lines of output of the command
+        log_path (str): The path of the full output log of the command, or
+            None if the output was not logged
+    """
+    def __init__(self, cmd, returncode, tail, log_path, reason=None):
+        self.cmd = cmd
+        self.returncode = returncode
+        self.tail = tail
+        self.log_path = log_path
+        if reason is None:
+            reason = 'Command failed with return code {0}'.format(returncode)
+        msg = '{0}: {1}'.format(reason, cmd)
+        if log_path:
+            msg += '\nFull output: {0}'.format(log_path)
+        if tail:
+            msg += '\nLast lines of output:\n' + '\n'.join(
+                tail[-ERROR_TAIL_LINES:])
+        super(CommandError, self).__init__(msg)
+
+
+class CommandTimeout(CommandError):
+    """Raised when a command run by run_cmd exceeds its deadline"""
+    def __init__(self, cmd, tail, log_path):
+        super(CommandTimeout, self).__init__(cmd, None, tail, log_path,
+                                             reason='Command timed out')
+
+
+class DeadlineExceeded(Exception):
+    """Raised when the deadline of the current phase has passed"""
+
+
+class Cancelled(Exception):
+    """Raised when the run was cancelled through its CancelToken"""
+
+
+class CancelToken(object):
+    """Token used by an orchestrator to abort a running validation
+
+    Cancelling the token kills the command that is currently running (along
+    with its whole process group) and makes the validation raise Cancelled
+    at its next check. Teardown still runs, as it is shielded from
+    cancellation.
+
+    Attributes:
+        reason (str): Why the run was cancelled, or None
+    """
+    def __init__(self):
+        self._event = threading.Event()
+        self.reason = None
+
+    def cancel(self, reason='cancelled'):
+        """Cancels the run
+
+        Args:
+            reason (str, optional): Why the run was cancelled
+
+        """
+        self.reason = reason
+        self._event.set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+
+@contextmanager
+def run_context(cancel_token=None, command_timeout=None):
+    """Sets the cancellation token and default command timeout of a thread
+
+    Args:
+        cancel_token (CancelToken, optional): The token that cancels
+            commands run in this thread
+        command_timeout (float, optional): The default timeout in seconds
+            for each command run in this thread
+
+    """
+    previous = (getattr(_run_context, 'cancel_token', None),
+                getattr(_run_context, 'command_timeout', None))
+    _run_context.cancel_token = cancel_token
+    _run_context.command_timeout = command_timeout
+    try:
+        yield
+    finally:
+        _run_context.cancel_token, _run_context.command_timeout = previous
+
+
+@contextmanager
+def phase(timeout=None):
+    """Runs a block under a deadline
+
+    Commands started within the block are killed once the deadline passes,
+    and check_deadline raises DeadlineExceeded. Phases can be nested, in
+    which case the earliest deadline applies.
+
+    Args:
+        timeout (float, optional): The number of seconds the block may take.
+            None only applies the deadlines of enclosing phases.
+
+    """
+    previous = getattr(_run_context, 'deadline', None)
+    deadline = previous
+    if timeout is not None:
+        deadline = time.time() + timeout
+        if previous is not None:
+            deadline = min(deadline, previous)
+    _run_context.deadline = deadline
+    try:
+        check_deadline()
+        yield
+    finally:
+        _run_context.deadline = previous
+
+
+@contextmanager
+def shielded():
+    """Runs a block that cannot be cancelled
+
+    This is used for teardown, which has to run even after the run was
+    cancelled. Deadlines set by phases within the block still apply.
+
+    """
+    previous = (getattr(_run_context, 'cancel_token', None),
+                getattr(_run_context, 'deadline', None))
+    _run_context.cancel_token = None
+    _run_context.deadline = None
+    try:
+        yield
+    finally:
+        _run_context.cancel_token, _run_context.deadline = previous
+
+
+def current_context():
+    """Returns the run context of the current thread
+
+    The cancellation token, deadlines and command log directory are kept per
+    thread, so work handed to another thread (such as a thread pool) does
+    not see them. Pass the returned context to adopt_context in the thread
+    that does the work.
+
+    Returns:
+        dict: The run context
+    """
+    return {'cancel_token': getattr(_run_context, 'cancel_token', None),
+            'command_timeout': getattr(_run_context, 'command_timeout', None),
+            'deadline': getattr(_run_context, 'deadline', None),
+            'command_log_directory': getattr(_command_logs, 'directory',
+                                             None)}
+
+
+@contextmanager
+def adopt_context(context):
+    """Runs a block in the run context of another thread
+
+    Args:
+        context (dict): A context returned by current_context
+
+    """
+    previous = current_context()
+    _set_context(context)
+    try:
+        yield
+    finally:
+        _set_context(previous)
+
+
+def _set_context(context):
+    _run_context.cancel_token = context['cancel_token']
+    _run_context.command_timeout = context['command_timeout']
+    _run_context.deadline = context['deadline']
+    _command_logs.directory = context['command_log_directory']
+
+
+def check_deadline():
+    """Checks whether the current thread should stop working
+
+    Raises:
+        Cancelled: If the cancellation token of the thread was cancelled
+        DeadlineExceeded: If the deadline of the current phase has passed
+
+    """
+    token = getattr(_run_context, 'cancel_token', None)
+    if token is not None and token.cancelled:
+        raise Cancelled(token.reason)
+    deadline = getattr(_run_context, 'deadline', None)
+    if deadline is not None and time.time() > deadline:
+        raise DeadlineExceeded('The deadline of the current phase passed')
+
+
+def command_deadline(timeout=None):
+    """Returns the time by which a command has to finish
+
+    Args:
+        timeout (float, optional): The timeout of the command. Defaults to
+            the command timeout of the current thread.
+
+    Returns:
+        float: The deadline as a unix timestamp, or None for no deadline
+    """
+    if timeout is None:
+        timeout = getattr(_run_context, 'command_timeout', None)
+    deadline = getattr(_run_context, 'deadline', None)
+    if timeout is not None:
+        command_deadline = time.time() + timeout
+        if deadline is None or command_deadline < deadline:
+            deadline = command_deadline
+    return deadline
+
+
+def wait_for_result(async_result):
+    """Waits for the result of a pool without blocking signal handlers
+
+    In python 2, a thread waiting on a pool result without a timeout cannot
+    be interrupted, so a signal handler cancelling the run would only run
+    once every worker finished. Waiting in short steps lets it run.
+
+    Args:
+        async_result (:obj: `AsyncResult`): The result of map_async or
+            apply_async
+
+    Raises:
+        Exception: The exception raised by the worker, if any
+
+    Returns:
+        object: The value of the result
+    """
+    while True:
+        try:
+            return async_result.get(POLL_INTERVAL)
+        except TimeoutError:
+            pass
+
+
+def kill_process_group(process):
+    """Terminates a process started by run_cmd along with its children
+
+    The process group first gets SIGTERM, then SIGKILL if it has not exited
+    within the grace period.
+
+    Args:
+        process (:obj: `Popen`): A process started in its own session
+
+    """
+    for sig, grace_period in ((signal.SIGTERM, KILL_GRACE_PERIOD),
+                              (signal.SIGKILL, 0)):
+        try:
+            os.killpg(process.pid, sig)
+        except OSError:
+            return
+        end_time = time.time() + grace_period
+        while process.poll() is None and time.time() < end_time:
+            time.sleep(0.1)
+        if process.poll() is not None:
+            return
+
+
+@contextmanager
+def command_logs(directory):
+    """Logs the full output of commands run in the current thread
+
+    While the context is active, run_cmd writes the complete, timestamped
+    output of each command to its own file in the directory.
+
+    Args:
+        directory (str): The directory the command logs are written to
+
+    """
+    previous = getattr(_command_logs, 'directory', None)
+    _command_logs.directory = directory
+    try:
+        yield
+    finally:
+        _command_logs.directory = previous
+
+
+def command_log_path(cmd):
+    """Returns a path for the output log of a command
+
+    Args:
+        cmd (str): The command to be run
+
+    Returns:
+        str: A unique path in the active command log directory, or None if
+            no command log directory is active
+    """
+    directory = getattr(_command_logs, 'directory', None)
+    if directory is None:
+        return None
+    # Name the log after the program being run, skipping over any
+    # environment variable assignments at the start of the command
+    words = [w for w in cmd.split() if '=' not in w] or ['command']
+    name = re.sub(r'[^A-Za-z0-9_.-]+', '_', os.path.basename(words[0]))
+    file_name = '{0:04d}-{1}.log'.format(next(_command_ids), name[:40])
+    return os.path.join(directory, file_name)
+
+
+def run_cmd(cmd, virtualenv=None, working_directory=None, env_vars={},
+            log_path=None, tail_lines=DEFAULT_TAIL_LINES, timeout=None):
     """Helper function for running a local bash command
 
     Execute the speficied command locally in a shell. Supports setting
     environment variables, a working directory, and a python virtual
     environment for the command to be run within.
 
+    The stdout and stderr of the command are read as they are produced and
+    echoed. Only the last lines of output are kept in memory. The complete
+    output, with a timestamp on each line, is written to a log file if a log
+    path is given or a command log directory is active (see command_logs).
+
+    The command runs in its own process group. If it outlives its timeout
+    or the deadline of the current phase, or the run is cancelled, the whole
+    process group is killed so no orphaned ssh or ansible children are left
+    behind.
+
     Args:
         cmd (str): The command to be executed
         virtualenv (str, optional): Path to a python virtual environment.
@@ -21,9 +369,20 @@ def run_cmd(cmd, virtualenv=None, working_directory=None, env_vars={}):
             the command fill be executed.
         env_vars (dict, optional): A set of environment variables to be set
             prior to executing the command.
+        log_path (str, optional): Path of a file to write the full output of
+            the command to
+        tail_lines (int, optional): The number of output lines to keep in
+            memory. None keeps all of the output.
+        timeout (float, optional): The number of seconds the command may
+            run. Defaults to the command timeout set with run_context.
 
     Raises:
-        Exception: Raises a generic exception if the command fails.
+        CommandError: If the command returns a non-zero return code
+        CommandTimeout: If the command did not finish in time
+        Cancelled: If the run was cancelled while the command was running
+
+    Returns:
+        list: The last lines of output of the command
 
     """
     if virtualenv:
@@ -32,20 +391,167 @@ def run_cmd(cmd, virtualenv=None, working_directory=None, env_vars={}):
         for key, val in env_vars.iteritems():
             cmd = '{0}={1} '.format(key, val) + cmd
     print 'Running: {}'.format(cmd)
-    p = Popen(cmd, shell=True, stdout=PIPE, cwd=working_directory)
-    res = []
-    while True:
-        output = p.stdout.readline()
-        if output == '' and p.poll() is not None:
-            break
-        if output:
-            print output.strip()
-            res.append(output.strip())
-    rc = p.poll()
+    if log_path is None:
+        log_path = command_log_path(cmd)
+    check_deadline()
+    deadline = command_deadline(timeout)
+
+    def check():
+        if deadline is not None and time.time() > deadline:
+            raise CommandTimeout(cmd, list(tail), log_path)
+        check_deadline()
+
+    with trace.span('command', cmd=cmd, log=log_path) as span:
+        p = Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE,
+                  cwd=working_directory, preexec_fn=os.setsid)
+        log_file = open_log(log_path)
+        tail = deque(maxlen=tail_lines)
+        try:
+            stream_output(p, log_file, tail, check=check)
+        except BaseException:
+            kill_process_group(p)
+            raise
+        finally:
+            if log_file:
+                log_file.close()
+        rc = p.wait()
+        span.set('returncode', rc)
     if rc != 0:
         print('Non-success return code: ' + str(rc))
-        raise Exception()
-    return res
+        raise CommandError(cmd, rc, list(tail), log_path)
+    return list(tail)
+
+
+def open_log(log_path):
+    """Opens a command log file for writing
+
+    Args:
+        log_path (str): The path of the log file, or None
+
+    Returns:
+        file: The open log file, or None if no path was given
+    """
+    if log_path is None:
+        return None
+    directory = os.path.dirname(log_path)
+    if directory and not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+    return open(log_path, 'w')
+
+
+class OutputRecorder(object):
+    """Splits command output into lines, then echoes, logs and keeps them
+
+    Output arrives in arbitrary chunks from one or more named streams. Each
+    complete line is echoed to the stream's echo target, written to the log
+    file with a timestamp and the stream name, and appended to the tail.
+
+    Attributes:
+        tail (:obj: `collections.deque`): The last lines of output
+    """
+    def __init__(self, log_file, tail, echo=None):
+        """
+        Args:
+            log_file (file): An open file to log the output to, or None
+            tail (:obj: `collections.deque`): A bounded deque that receives
+                the last lines of output
+            echo (dict, optional): The file each stream is echoed to, keyed
+                by stream name. Defaults to sys.stdout for "stdout" and
+                sys.stderr for "stderr".
+        """
+        self.log_file = log_file
+        self.tail = tail
+        self.echo = echo or {'stdout': sys.stdout, 'stderr': sys.stderr}
+        self._partial = {}
+
+    def feed(self, stream, data):
+        """Records a chunk of output
+
+        Args:
+            stream (str): The name of the stream the data was read from
+            data (str): The chunk of output
+
+        """
+        lines = (self._partial.get(stream, '') + data).split('\n')
+        self._partial[stream] = lines.pop()
+        for line in lines:
+            self._handle_line(stream, line)
+
+    def close(self, stream):
+        """Records the last, unterminated line of a stream
+
+        Args:
+            stream (str): The name of the stream that was closed
+
+        """
+        line = self._partial.pop(stream, '')
+        if line:
+            self._handle_line(stream, line)
+
+    def _handle_line(self, stream, line):
+        line = line.rstrip('\r')
+        self.echo[stream].write(line.strip() + '\n')
+        self.tail.append(line)
+        if self.log_file:
+            timestamp = datetime.datetime.utcnow().isoformat()
+            self.log_file.write('{0} {1} {2}\n'.format(timestamp, stream,
+                                                       line))
+
+
+def stream_output(process, log_file, tail, check=None):
+    """Reads the stdout and stderr of a process until both are closed
+
+    Both pipes are multiplexed with poll, so neither can fill up and block
+    the process while the other one is being read. Every complete line is
+    echoed, written to the log file with a timestamp and stream name, and
+    appended to the tail. Reads interrupted by a signal (such as the one
+    cancelling the run) are retried after calling check.
+
+    Args:
+        process (:obj: `Popen`): A process started with stdout and stderr
+            set to PIPE
+        log_file (file): An open file to log the output to, or None
+        tail (:obj: `collections.deque`): A bounded deque that receives the
+            last lines of output
+        check (callable, optional): Called at least every POLL_INTERVAL
+            seconds while waiting for output. Exceptions it raises abort
+            the read.
+
+    """
+    recorder = OutputRecorder(log_file, tail)
+    streams = {process.stdout.fileno(): 'stdout',
+               process.stderr.fileno(): 'stderr'}
+
+    poller = select.poll()
+    for fd in streams:
+        poller.register(fd, select.POLLIN | select.POLLPRI)
+    open_fds = set(streams)
+    while open_fds:
+        try:
+            events = poller.poll(POLL_INTERVAL * 1000)
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            events = []
+        if check:
+            check()
+        for fd, _ in events:
+            try:
+                data = os.read(fd, READ_SIZE)
+            except OSError as e:
+                if e.errno != errno.EINTR:
+                    raise
+                continue
+            if not data:
+                poller.unregister(fd)
+                open_fds.discard(fd)
+                recorder.close(streams[fd])
+                continue
+            recorder.feed(streams[fd], data)
 
 
 def run_ansible_cmd(cmd, inventory, ansible_config,
@@ -92,18 +598,129 @@ def run_ansible_cmd(cmd, inventory, ansible_config,
     return run_cmd(ans)
 
 
-def wait_for_ssh(host, username, password, wait_time=30, sleep_interval=5):
-    creds = {'user': username, 'password': password}
-    start_time = time.time()
-    end_time = start_time + wait_time
-    connected = False
-    while time.time() < end_time:
-        try:
-            setup_ssh_connection(host, creds)
-            connected = True
-            break
-        except Exception:
-            time.sleep(sleep_interval)
-    if not connected:
-        msg = 'The remote host failed to become available via ssh: {0}'
-        raise Exception(msg.format(traceback.format_exc()))
+def wait_for_ssh(host, username, password, wait_time=30, sleep_interval=5,
+                 port=22, ssh_key_path=None, wait_for_cloud_init=False):
+    """Waits until a freshly booted host accepts SSH logins
+
+    The host is first probed with plain TCP connections, which are cheap and
+    fail fast while the host is booting, until its SSH server sends a
+    banner. Only then is a full SSH login attempted, which is retried until
+    the credentials are accepted (cloud-init may still be setting them up).
+    Optionally, the login also waits until cloud-init has finished. Probes
+    are retried with exponential backoff and jitter.
+
+    Args:
+        host (str): The hostname or IP address of the host
+        username (str): The user to log in as
+        password (str): The password of the user, or None
+        wait_time (float, optional): The number of seconds to wait for in
+            total
+        sleep_interval (float, optional): The longest interval between two
+            probes
+        port (int, optional): The SSH port of the host
+        ssh_key_path (str, optional): The path to a private key to log in
+            with
+        wait_for_cloud_init (bool, optional): Whether to also wait for the
+            cloud-init completion marker. Defaults to False.
+
+    Raises:
+        Exception: If the host did not become available in time
+
+    Returns:
+        SSHClient: The authenticated connection to the host. It is handed to
+            the caller so that the host does not have to be logged into
+            again.
+
+    """
+    creds = {'user': username, 'password': password,
+             'ssh_key_path': ssh_key_path}
+    end_time = time.time() + wait_time
+    delays = backoff_delays(SSH_PROBE_INTERVAL, sleep_interval)
+    ssh = None
+    error = None
+    with trace.span('wait_for_ssh', host=host) as span:
+        for attempt in itertools.count(1):
+            check_deadline()
+            remaining = end_time - time.time()
+            if remaining <= 0:
+                break
+            timeout = min(remaining, SSH_PROBE_TIMEOUT)
+            try:
+                if ssh is None:
+                    probe_ssh_port(host, port, timeout)
+                    ssh = setup_ssh_connection(host, creds, port=port,
+                                               timeout=timeout)
+                    span.set('login_attempt', attempt)
+                if not wait_for_cloud_init or cloud_init_finished(ssh):
+                    span.set('attempts', attempt)
+                    return ssh
+                error = 'cloud-init has not finished'
+            except Exception:
+                error = traceback.format_exc()
+                # The session may have dropped, for example when cloud-init
+                # rebooted the host, so log in again on the next attempt
+                if ssh is not None:
+                    ssh.close()
+                    ssh = None
+            time.sleep(min(next(delays), max(0, end_time - time.time())))
+        if ssh is not None:
+            ssh.close()
+    msg = 'The remote host failed to become available via ssh: {0}'
+    raise Exception(msg.format(error))
+
+
+def backoff_delays(initial, maximum):
+    """Generates exponentially growing delays with jitter
+
+    Each delay is drawn from the upper half of an interval that doubles
+    after every attempt, up to the maximum. The jitter keeps many waiting
+    runs from probing in lockstep.
+
+    Args:
+        initial (float): The first interval
+        maximum (float): The largest interval
+
+    Returns:
+        generator: The delays in seconds
+    """
+    interval = initial
+    while True:
+        yield random.uniform(interval / 2.0, interval)
+        interval = min(interval * 2, maximum)
+
+
+def probe_ssh_port(host, port, timeout):
+    """Checks that an SSH server is answering on a port
+
+    Args:
+        host (str): The hostname or IP address of the host
+        port (int): The port to probe
+        timeout (float): The number of seconds to wait for the banner
+
+    Raises:
+        socket.error: If the connection failed
+        IOError: If the server did not send an SSH banner
+
+    """
+    sock = socket.create_connection((host, port), timeout=timeout)
+    try:
+        banner = sock.recv(4)
+    finally:
+        sock.close()
+    if banner != 'SSH-':
+        raise IOError('No SSH banner received from {0}:{1}'.format(host,
+                                                                   port))
+
+
+def cloud_init_finished(ssh):
+    """Checks whether cloud-init has finished on a host
+
+    Args:
+        ssh (:obj: `SSHClient`): A connection to the host
+
+    Returns:
+        bool: True if the cloud-init completion marker exists
+    """
+    cmd = 'test -e {0}'.format(CLOUD_INIT_MARKER)
+    stdin, stdout, stderr = ssh.exec_command(cmd)
+    return stdout.channel.recv_exit_status() == 0
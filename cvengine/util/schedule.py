@@ -0,0 +1,241 @@
+import threading
+import time
+import traceback
+
+from multiprocessing.pool import ThreadPool
+
+from . import run, trace
+
+
+# The most playbooks of a scenario that run at the same time, when their
+# dependencies allow it
+DEFAULT_PLAYBOOK_CONCURRENCY = 4
+PLAYBOOK_STATUSES = ('passed', 'failed', 'not_run')
+# How often the scheduler wakes up to notice cancellation and deadlines
+WAIT_INTERVAL = 1
+
+
+class PlaybookGraph(object):
+    """The playbooks of a scenario and the order they have to run in
+
+    Playbooks run in the order they are listed, unless their entries say
+    otherwise:
+
+      * "name": Identifies the playbook for depends_on. Defaults to its url,
+        followed by "#2", "#3" and so on if the url is listed more than once.
+      * "depends_on": The names of the playbooks that have to pass before
+        this one starts, replacing the dependency on the previous entry. An
+        empty list lets the playbook start right away. Such entries are
+        left out of the listed order, the entry after one waits for the
+        entry before it.
+      * "parallel": A group name. Consecutive entries of the same group may
+        run at the same time. They all wait for the entry before the group,
+        and the entry after the group waits for all of them.
+
+    Attributes:
+        playbooks (dict): The playbook entries, keyed by name
+        names (list): The names of the playbooks, in the order listed
+        dependencies (dict): The names each playbook depends on
+    """
+    def __init__(self, playbooks):
+        """
+        Args:
+            playbooks (list): The playbook entries of the scenario
+
+        Raises:
+            ValueError: If names are duplicated, a dependency does not exist
+                or the dependencies form a cycle
+        """
+        self.names = []
+        self.playbooks = {}
+        self.dependencies = {}
+        urls = {}
+        for playbook in playbooks:
+            name = playbook.get('name')
+            if name is None:
+                urls[playbook['url']] = urls.get(playbook['url'], 0) + 1
+                name = playbook['url']
+                if urls[name] > 1:
+                    name = '{0}#{1}'.format(name, urls[name])
+            if name in self.playbooks:
+                raise ValueError('Playbook {0} is listed twice'.format(name))
+            self.names.append(name)
+            self.playbooks[name] = playbook
+
+        previous_stage = []
+        stage = []
+        group = None
+        for name in self.names:
+            playbook = self.playbooks[name]
+            depends_on = playbook.get('depends_on')
+            if depends_on is None:
+                if playbook.get('parallel') is None or \
+                        playbook['parallel'] != group:
+                    previous_stage, stage = stage or previous_stage, []
+                group = playbook.get('parallel')
+                stage.append(name)
+                depends_on = previous_stage
+            elif not isinstance(depends_on, list):
+                depends_on = [depends_on]
+            for dependency in depends_on:
+                if dependency not in self.playbooks:
+                    msg = 'Playbook {0} depends on {1}, which does not exist'
+                    raise ValueError(msg.format(name, dependency))
+            self.dependencies[name] = list(depends_on)
+        self.order()
+
+    def order(self):
+        """Sorts the playbooks so each comes after its dependencies
+
+        Raises:
+            ValueError: If the dependencies form a cycle
+
+        Returns:
+            list: The names of the playbooks
+        """
+        ordered = []
+        done = set()
+        visiting = set()
+
+        def visit(name, path):
+            if name in done:
+                return
+            if name in visiting:
+                cycle = path[path.index(name):] + [name]
+                msg = 'The playbook dependencies form a cycle: {0}'
+                raise ValueError(msg.format(' -> '.join(cycle)))
+            visiting.add(name)
+            for dependency in self.dependencies[name]:
+                visit(dependency, path + [name])
+            visiting.discard(name)
+            done.add(name)
+            ordered.append(name)
+
+        for name in self.names:
+            visit(name, [])
+        return ordered
+
+    def run(self, run_playbook, concurrency=DEFAULT_PLAYBOOK_CONCURRENCY,
+            completed=(), on_passed=None):
+        """Runs the playbooks as their dependencies allow
+
+        Playbooks whose dependencies passed are started in the order they
+        are listed, up to concurrency at a time, on worker threads that
+        inherit the run context and tracer of the calling thread. Once a
+        playbook fails, or the run of the calling thread is cancelled or
+        runs out of time, no more playbooks are started, and the ones
+        already running are allowed to finish.
+
+        Args:
+            run_playbook (callable): Runs the playbook entry passed to it,
+                raising an exception if it fails
+            concurrency (int, optional): The most playbooks running at once
+            completed (list, optional): The names of playbooks that passed in
+                a previous run, which are not run again
+            on_passed (callable, optional): Called with the name of each
+                playbook that passed, on the thread that ran it
+
+        Raises:
+            Cancelled: If the run was cancelled, once the running playbooks
+                finished
+            DeadlineExceeded: If the deadline of the current phase passed,
+                once the running playbooks finished
+
+        Returns:
+            dict: The outcome of each playbook, keyed by name, with its
+                "status" (one of PLAYBOOK_STATUSES) and, if it ran, its
+                "start" and "end" time, and the exception as "error" if it
+                failed. Playbooks from completed are "passed" and marked as
+                "resumed".
+        """
+        results = dict((name, {'status': 'not_run'}) for name in self.names)
+        pending = []
+        for name in self.names:
+            if name in completed:
+                results[name] = {'status': 'passed', 'resumed': True}
+            else:
+                pending.append(name)
+        running = set()
+        finished = threading.Condition()
+        context = run.current_context()
+        tracer = trace.current_tracer()
+        parent = tracer.current_span() if tracer is not None else None
+
+        def work(name):
+            result = results[name]
+            try:
+                with run.adopt_context(context), \
+                        trace.activate(tracer, parent=parent):
+                    result['start'] = time.time()
+                    run_playbook(self.playbooks[name])
+                    if on_passed is not None:
+                        on_passed(name)
+                result['status'] = 'passed'
+            except Exception as e:
+                print('Playbook {0} failed: {1}'.format(
+                    name, traceback.format_exc()))
+                result['status'] = 'failed'
+                result['error'] = e
+            finally:
+                result['end'] = time.time()
+                with finished:
+                    running.discard(name)
+                    finished.notify()
+
+        stopped = None
+        pool = ThreadPool(max(1, concurrency))
+        try:
+            with finished:
+                while True:
+                    failed = any(r['status'] == 'failed'
+                                 for r in results.values())
+                    for name in list(pending):
+                        if failed or stopped is not None or \
+                                len(running) >= concurrency:
+                            break
+                        if all(results[d]['status'] == 'passed'
+                               for d in self.dependencies[name]):
+                            try:
+                                run.check_deadline()
+                            except (run.Cancelled,
+                                    run.DeadlineExceeded) as e:
+                                print('Not starting any more playbooks: '
+                                      '{0}'.format(e))
+                                stopped = e
+                                break
+                            pending.remove(name)
+                            running.add(name)
+                            pool.apply_async(work, (name,))
+                    if not running:
+                        break
+                    finished.wait(WAIT_INTERVAL)
+        finally:
+            pool.close()
+            pool.join()
+        if stopped is not None:
+            raise stopped
+        return results
+
+    def critical_path(self, results):
+        """Finds the chain of dependent playbooks that took the longest
+
+        Args:
+            results (dict): The outcome of each playbook as returned by run
+
+        Returns:
+            list: The names of the playbooks on the critical path
+            float: The seconds the playbooks on it took together
+        """
+        longest = {}
+        for name in self.order():
+            result = results.get(name, {})
+            if 'start' not in result:
+                continue
+            duration = result['end'] - result['start']
+            before = max([longest[d] for d in self.dependencies[name]
+                          if d in longest] or [([], 0)],
+                         key=lambda path: path[1])
+            longest[name] = (before[0] + [name], before[1] + duration)
+        if not longest:
+            return [], 0
+        return max(longest.values(), key=lambda path: path[1])
@@ -0,0 +1,412 @@
+import hashlib
+import json
+import os
+import pipes
+import socket
+
+from . import trace
+from .fetch import TRANSFER_POLL_INTERVAL, TRANSFER_READ_SIZE, \
+    fetch_directory_tar, send_input
+from .run import check_deadline
+
+
+# Files at least this large are fetched on their own into a partial file,
+# so that an interrupted transfer resumes where it stopped. Smaller files
+# are fetched together in one tar stream.
+RESUME_THRESHOLD = 1024 * 1024
+# Appended to the name of an artifact for its sync manifest, and to the name
+# of a file that is still being transferred
+SYNC_MANIFEST_SUFFIX = '.sync.json'
+PARTIAL_SUFFIX = '.part'
+HASH_READ_SIZE = 1024 * 1024
+
+
+class SyncUnavailable(Exception):
+    """Raised when the remote host lacks the tools needed to sync"""
+
+
+def sync_remote_artifact(ssh_connection, remote_path, artifacts_directory,
+                         compressor='none', compression_level=None):
+    """Fetch only the new and changed files of a remote artifact
+
+    Works like rsync. The remote host lists the size and modification time
+    of every file of the artifact, which are compared with the sync manifest
+    written by the previous sync. Files that did not change are skipped.
+    For the rest, the remote host computes SHA-256 hashes, and files whose
+    local copy already has the same content are skipped too.
+
+    Changed files smaller than RESUME_THRESHOLD are fetched together in one
+    tar stream. Larger files are fetched one by one into a partial file
+    that is kept if the transfer is interrupted, and the next sync continues
+    from the end of it once the remote host confirmed that the partial file
+    matches the start of the remote one. Every fetched file is checked
+    against its remote hash once it is complete, and removed if it does
+    not match.
+
+    The manifest is written next to the artifact, as the artifact name with
+    SYNC_MANIFEST_SUFFIX appended, and is updated after each large file so
+    an interrupted sync keeps its progress.
+
+    Args:
+        ssh_connection (:obj: `SSHClient`): The connection to the host
+        remote_path (str): The path of the remote file or directory
+        artifacts_directory (str): The local directory to sync into
+        compressor (str, optional): The compression of the tar stream,
+            "zstd", "gzip" or "none"
+        compression_level (int, optional): The compression level
+
+    Raises:
+        SyncUnavailable: If the remote host has no sha256sum or GNU find
+        Exception: A generic exception if the files could not be listed, or
+            a fetched file does not match its remote hash
+
+    Returns:
+        dict: Counts of the "files" of the artifact, and of the files that
+            were "skipped", "transferred" and "resumed", plus the number of
+            "bytes" received
+
+    """
+    remote_path = remote_path.rstrip('/') or '/'
+    destination = os.path.join(artifacts_directory,
+                               os.path.basename(remote_path))
+    manifest_path = destination + SYNC_MANIFEST_SUFFIX
+    stats = {'files': 0, 'skipped': 0, 'transferred': 0, 'resumed': 0,
+             'bytes': 0}
+
+    with trace.span('artifact.sync', path=remote_path) as span:
+        remote_files = list_remote_files(ssh_connection, remote_path,
+                                         required_tools=('sha256sum',))
+        stats['files'] = len(remote_files)
+        manifest = load_sync_manifest(manifest_path, remote_path)
+        files = manifest['files']
+
+        changed = []
+        for name, (size, mtime) in sorted(remote_files.items()):
+            entry = files.get(name)
+            local = _local_path(destination, name)
+            if entry is not None and entry['size'] == size and \
+                    entry['mtime'] == mtime and os.path.isfile(local) and \
+                    os.path.getsize(local) == size:
+                stats['skipped'] += 1
+            else:
+                changed.append(name)
+
+        hashes = remote_hashes(ssh_connection, remote_path, changed)
+        batch = []
+        large = []
+        for name in changed:
+            if name not in hashes:
+                # Removed or unreadable since it was listed
+                continue
+            size, mtime = remote_files[name]
+            entry = {'size': size, 'mtime': mtime, 'sha256': hashes[name]}
+            local = _local_path(destination, name)
+            if os.path.isfile(local) and os.path.getsize(local) == size and \
+                    file_sha256(local) == entry['sha256']:
+                files[name] = entry
+                stats['skipped'] += 1
+            elif size >= RESUME_THRESHOLD:
+                large.append((name, entry))
+            else:
+                batch.append((name, entry))
+
+        if batch:
+            if not os.path.isdir(artifacts_directory):
+                os.makedirs(artifacts_directory)
+            stats['bytes'] += fetch_directory_tar(
+                ssh_connection, remote_path, artifacts_directory,
+                compressor, compression_level,
+                members=[name for name, _ in batch])
+            mismatched = []
+            for name, entry in batch:
+                local = _local_path(destination, name)
+                if not os.path.isfile(local):
+                    # Removed since it was hashed
+                    continue
+                if file_sha256(local) == entry['sha256']:
+                    files[name] = entry
+                    stats['transferred'] += 1
+                else:
+                    # Changed while it was fetched, fetch it again next time
+                    os.remove(local)
+                    files.pop(name, None)
+                    mismatched.append(local)
+            write_sync_manifest(manifest_path, manifest)
+            if mismatched:
+                msg = '{0} does not match the hash of the remote file'
+                raise Exception(msg.format(', '.join(mismatched)))
+
+        for name, entry in large:
+            remote_file = os.path.join(remote_path, name) if name \
+                else remote_path
+            received, resumed = fetch_resumable(
+                ssh_connection, remote_file, _local_path(destination, name),
+                entry)
+            files[name] = entry
+            stats['bytes'] += received
+            stats['transferred'] += 1
+            stats['resumed'] += int(resumed)
+            write_sync_manifest(manifest_path, manifest)
+
+        manifest['files'] = dict((name, entry)
+                                 for name, entry in files.items()
+                                 if name in remote_files)
+        write_sync_manifest(manifest_path, manifest)
+        for key, value in stats.items():
+            span.set(key, value)
+    return stats
+
+
+def list_remote_files(ssh_connection, remote_path, required_tools=()):
+    """Lists the files of a remote artifact with their size and mtime
+
+    Args:
+        ssh_connection (:obj: `SSHClient`): The connection to the host
+        remote_path (str): The path of the remote file or directory
+        required_tools (tuple, optional): Other commands the caller needs
+            on the remote host
+
+    Raises:
+        SyncUnavailable: If the remote host has no GNU find or lacks one of
+            the required tools
+        Exception: A generic exception if the path could not be listed
+
+    Returns:
+        dict: Maps the path of each regular file relative to remote_path
+            ("" if remote_path is a file) to its size and modification time
+    """
+    cmd = ''.join('command -v {0} >/dev/null 2>&1 || exit 127; '.format(tool)
+                  for tool in required_tools)
+    cmd += "find {0} -type f -printf '%s %T@ %P\\0'".format(
+        pipes.quote(remote_path))
+    rc, output, errors = _exec(ssh_connection, cmd)
+    if rc == 127 or 'printf' in errors:
+        tools = ('GNU find',) + tuple(required_tools)
+        msg = 'One of {0} is not available'
+        raise SyncUnavailable(msg.format(', '.join(tools)))
+    if rc != 0 and not output:
+        msg = 'Unable to list the files of {0}: {1}'
+        raise Exception(msg.format(remote_path, errors.strip()))
+    files = {}
+    for record in output.split('\0'):
+        if not record:
+            continue
+        size, mtime, name = record.split(' ', 2)
+        files[name] = (int(size), mtime)
+    return files
+
+
+def remote_hashes(ssh_connection, remote_path, names):
+    """Computes the SHA-256 hashes of remote files
+
+    Args:
+        ssh_connection (:obj: `SSHClient`): The connection to the host
+        remote_path (str): The path of the remote file or directory
+        names (list): The files to hash, relative to remote_path
+
+    Returns:
+        dict: Maps each name to its hash. Files that could not be read are
+            left out.
+    """
+    if not names:
+        return {}
+    paths = dict(((os.path.join(remote_path, name) if name else remote_path),
+                  name) for name in names)
+    _, output, _ = _exec(ssh_connection, 'xargs -0 sha256sum --',
+                         ''.join(path + '\0' for path in paths))
+    hashes = {}
+    for line in output.splitlines():
+        digest, _, path = line.partition('  ')
+        if digest.startswith('\\'):
+            # sha256sum escapes names containing newlines or backslashes
+            digest = digest[1:]
+            path = path.replace('\\n', '\n').replace('\\\\', '\\')
+        if path in paths:
+            hashes[paths[path]] = digest
+    return hashes
+
+
+def fetch_resumable(ssh_connection, remote_file, local_path, entry):
+    """Fetch a single file, continuing a previously interrupted transfer
+
+    The file is written to a partial file next to its final path. If a
+    partial file already exists and the remote host confirms that it matches
+    the start of the remote file, only the rest of the file is fetched.
+
+    Args:
+        ssh_connection (:obj: `SSHClient`): The connection to the host
+        remote_file (str): The path of the remote file
+        local_path (str): The local path to fetch it to
+        entry (dict): The size and sha256 of the remote file
+
+    Raises:
+        Exception: A generic exception if the fetched file does not match
+            the remote hash
+
+    Returns:
+        int: The number of bytes received
+        bool: Whether an earlier transfer was resumed
+    """
+    partial = local_path + PARTIAL_SUFFIX
+    directory = os.path.dirname(partial)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    offset = 0
+    if os.path.isfile(partial):
+        offset = os.path.getsize(partial)
+        if offset >= entry['size'] or \
+                remote_prefix_sha256(ssh_connection, remote_file, offset) != \
+                file_sha256(partial):
+            offset = 0
+
+    cmd = 'tail -c +{0} {1}'.format(offset + 1, pipes.quote(remote_file))
+    received = 0
+    with trace.span('artifact.sync_file', path=remote_file,
+                    offset=offset) as span:
+        channel = ssh_connection.get_transport().open_session()
+        channel.settimeout(TRANSFER_POLL_INTERVAL)
+        try:
+            channel.exec_command(cmd)
+            channel.shutdown_write()
+            with open(partial, 'ab' if offset else 'wb') as f:
+                while True:
+                    check_deadline()
+                    try:
+                        data = channel.recv(TRANSFER_READ_SIZE)
+                    except socket.timeout:
+                        continue
+                    if not data:
+                        break
+                    # Written through, so an interrupted transfer keeps
+                    # everything that was received
+                    f.write(data)
+                    f.flush()
+                    received += len(data)
+            channel.recv_exit_status()
+        finally:
+            channel.close()
+        span.set('bytes', received)
+
+    if file_sha256(partial) != entry['sha256']:
+        os.remove(partial)
+        msg = '{0} does not match the hash of the remote file'
+        raise Exception(msg.format(local_path))
+    os.rename(partial, local_path)
+    return received, offset > 0
+
+
+def remote_prefix_sha256(ssh_connection, remote_file, length):
+    """Computes the SHA-256 hash of the first bytes of a remote file
+
+    Args:
+        ssh_connection (:obj: `SSHClient`): The connection to the host
+        remote_file (str): The path of the remote file
+        length (int): The number of bytes to hash
+
+    Returns:
+        str: The hex digest, or None if it could not be computed
+    """
+    cmd = 'head -c {0} {1} | sha256sum'.format(int(length),
+                                               pipes.quote(remote_file))
+    rc, output, _ = _exec(ssh_connection, cmd)
+    if rc != 0 or not output:
+        return None
+    return output.split()[0]
+
+
+def file_sha256(path):
+    """Computes the SHA-256 hash of a local file
+
+    Args:
+        path (str): The path of the file
+
+    Returns:
+        str: The hex digest
+    """
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_READ_SIZE), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def load_sync_manifest(path, remote_path):
+    """Reads the manifest written by the previous sync of an artifact
+
+    Args:
+        path (str): The path of the manifest
+        remote_path (str): The remote path the artifact is synced from
+
+    Returns:
+        dict: The manifest, or an empty one if there is no manifest for the
+            remote path
+    """
+    manifest = {'source': remote_path, 'files': {}}
+    try:
+        with open(path) as f:
+            previous = json.load(f)
+    except (IOError, ValueError):
+        return manifest
+    if previous.get('source') == remote_path:
+        manifest['files'] = previous.get('files', {})
+    return manifest
+
+
+def write_sync_manifest(path, manifest):
+    """Writes a sync manifest, replacing the previous one atomically
+
+    Args:
+        path (str): The path of the manifest
+        manifest (dict): The manifest
+
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.rename(tmp_path, path)
+
+
+def _local_path(destination, name):
+    return os.path.join(destination, name) if name else destination
+
+
+def _exec(ssh_connection, cmd, stdin=None):
+    """Runs a remote command and collects its output
+
+    Args:
+        ssh_connection (:obj: `SSHClient`): The connection to the host
+        cmd (str): The command
+        stdin (str, optional): The input of the command
+
+    Returns:
+        int: The exit status
+        str: The standard output
+        str: The standard error
+    """
+    channel = ssh_connection.get_transport().open_session()
+    channel.settimeout(TRANSFER_POLL_INTERVAL)
+    output = []
+    errors = []
+    try:
+        channel.exec_command(cmd)
+        if stdin is None:
+            channel.shutdown_write()
+        else:
+            send_input(channel, stdin)
+        while True:
+            check_deadline()
+            while channel.recv_stderr_ready():
+                errors.append(channel.recv_stderr(TRANSFER_READ_SIZE))
+            try:
+                data = channel.recv(TRANSFER_READ_SIZE)
+            except socket.timeout:
+                continue
+            if not data:
+                break
+            output.append(data)
+        rc = channel.recv_exit_status()
+        while channel.recv_stderr_ready():
+            errors.append(channel.recv_stderr(TRANSFER_READ_SIZE))
+    finally:
+        channel.close()
+    return rc, ''.join(output), ''.join(errors)
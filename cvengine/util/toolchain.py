@@ -0,0 +1,160 @@
+import json
+import os
+import pipes
+import tempfile
+import threading
+
+from distutils.spawn import find_executable
+
+from .cache import DEFAULT_CACHE_DIRECTORY
+from .run import CommandError, run_cmd
+
+
+TOOLCHAIN_FILE_NAME = 'toolchain.json'
+
+# The command line arguments used to ask each tool for its version
+TOOLS = {
+    'ansible': ['--version'],
+    'ansible-playbook': ['--version'],
+    'docker': ['--version'],
+    # Without --client, oc also asks the configured cluster for its version
+    'oc': ['version', '--client']
+}
+# Seconds a tool may take to print its version
+PROBE_TIMEOUT = 30
+
+# The probed toolchains, keyed by the directory of their on-disk record
+_toolchains = {}
+_toolchain_lock = threading.Lock()
+
+
+def get_toolchain(cache_directory=None):
+    """Returns the local toolchain, probing it at most once per process
+
+    Args:
+        cache_directory (str, optional): The directory holding the on-disk
+            toolchain record. Defaults to the download cache directory.
+
+    Returns:
+        dict: The toolchain record. See probe_toolchain.
+    """
+    if cache_directory is None:
+        cache_directory = os.environ.get('CV_CACHE_DIRECTORY',
+                                         DEFAULT_CACHE_DIRECTORY)
+    with _toolchain_lock:
+        if cache_directory not in _toolchains:
+            _toolchains[cache_directory] = probe_toolchain(
+                cache_directory=cache_directory)
+        return _toolchains[cache_directory]
+
+
+def probe_toolchain(tools=TOOLS, cache_directory=None):
+    """Discovers the paths and versions of the tools cvengine shells out to
+
+    Asking ansible for its version starts a full python interpreter, so the
+    results are kept in a small on-disk record. A tool is only probed again
+    when its location on the PATH or the modification time of its binary
+    changes.
+
+    Args:
+        tools (dict, optional): The arguments used to ask each tool for its
+            version, keyed by the name of the tool
+        cache_directory (str, optional): The directory holding the on-disk
+            toolchain record. Defaults to the download cache directory.
+
+    Returns:
+        dict: Information about each tool, keyed by the name of the tool.
+            Each value has the keys "path" (None if the tool was not found),
+            "mtime", "version" (the first line of the version output) and
+            "version_output".
+    """
+    if cache_directory is None:
+        cache_directory = os.environ.get('CV_CACHE_DIRECTORY',
+                                         DEFAULT_CACHE_DIRECTORY)
+    record_path = os.path.join(cache_directory, TOOLCHAIN_FILE_NAME)
+    try:
+        with open(record_path) as f:
+            record = json.load(f)
+    except (IOError, ValueError):
+        record = {}
+
+    toolchain = {}
+    for name, version_args in tools.items():
+        path = find_executable(name)
+        mtime = os.stat(os.path.realpath(path)).st_mtime if path else None
+        cached = record.get(name)
+        if cached and cached['path'] == path and cached['mtime'] == mtime:
+            toolchain[name] = cached
+        else:
+            toolchain[name] = probe_tool(path, version_args)
+            toolchain[name]['mtime'] = mtime
+
+    if toolchain != record:
+        try:
+            write_toolchain(toolchain, cache_directory)
+        except (IOError, OSError) as e:
+            print('Unable to save the toolchain record: {0}'.format(e))
+    return toolchain
+
+
+def probe_tool(path, version_args, timeout=PROBE_TIMEOUT):
+    """Runs a tool to find out its version
+
+    Args:
+        path (str): The path to the tool, or None if it was not found
+        version_args (list): The arguments that make the tool print its
+            version
+        timeout (float, optional): The number of seconds the tool may take
+
+    Returns:
+        dict: The path, version and full version output of the tool. The
+            version is None if the tool failed or did not answer in time.
+    """
+    info = {'path': path, 'version': None, 'version_output': None}
+    if path is None:
+        return info
+    cmd = ' '.join(pipes.quote(arg) for arg in [path] + version_args)
+    try:
+        output = '\n'.join(run_cmd(cmd, timeout=timeout)).strip()
+    except CommandError as e:
+        print('Unable to find out the version of {0}: {1}'.format(path, e))
+        return info
+    if output:
+        info['version'] = output.splitlines()[0]
+        info['version_output'] = output
+    return info
+
+
+def write_toolchain(toolchain, directory):
+    """Writes a toolchain record as json
+
+    This is used both for the on-disk cache and to store the toolchain used
+    by a run in its artifacts directory.
+
+    Args:
+        toolchain (dict): The toolchain record
+        directory (str): The directory to write toolchain.json to
+
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, tmp_path = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(toolchain, f, indent=2, sort_keys=True)
+    os.rename(tmp_path, os.path.join(directory, TOOLCHAIN_FILE_NAME))
+
+
+def print_toolchain(toolchain):
+    """Prints the version of each tool in a toolchain record
+
+    Args:
+        toolchain (dict): The toolchain record
+
+    """
+    for name in sorted(toolchain):
+        tool = toolchain[name]
+        if tool['path'] is None:
+            print('{0}: not found'.format(name))
+        else:
+            print('{0}: {1} ({2})'.format(name, tool['version'],
+                                          tool['path']))
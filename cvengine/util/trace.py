@@ -0,0 +1,220 @@
+import itertools
+import json
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+
+
+TRACE_FILE_NAME = 'cvengine_trace.json'
+
+_active = threading.local()
+
+
+class Tracer(object):
+    """Collects timed, nested spans describing a validation run
+
+    Spans are recorded per thread, so work running concurrently in several
+    threads (such as a multi-platform run) can share one tracer. Each thread
+    keeps its own stack of open spans, which is used to link a span to its
+    parent. The collected spans are written in the Chrome trace event
+    format, which can be loaded in chrome://tracing or Perfetto, and is also
+    easy to process as plain json.
+
+    Attributes:
+        events (list): The recorded trace events
+    """
+    def __init__(self):
+        self.events = []
+        self.start_time = time.time()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._ids = itertools.count(1)
+
+    def span(self, name, **attributes):
+        """Creates a span that is recorded when its context exits
+
+        Args:
+            name (str): The name of the span
+            **attributes: Attributes to be recorded with the span
+
+        Returns:
+            Span: The span, to be used as a context manager
+        """
+        return Span(self, name, attributes)
+
+    def write(self, path):
+        """Writes the recorded spans to a file
+
+        Args:
+            path (str): The path of the trace file
+
+        """
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with self._lock:
+            events = list(self.events)
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f,
+                      indent=1, default=str)
+
+    def current_span(self):
+        """Returns the innermost open span of the current thread
+
+        Returns:
+            Span: The open span, or None if no span is open
+        """
+        stack = self._stack()
+        return stack[-1] if stack else None
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def _record(self, event):
+        with self._lock:
+            self.events.append(event)
+
+
+class Span(object):
+    """A timed section of a validation run
+
+    Attributes:
+        name (str): The name of the span
+        attributes (dict): The attributes recorded with the span
+    """
+    def __init__(self, tracer, name, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+
+    def set(self, key, value):
+        """Sets an attribute on the span
+
+        Args:
+            key (str): The name of the attribute
+            value: The value of the attribute
+
+        """
+        self.attributes[key] = value
+
+    def __enter__(self):
+        stack = self.tracer._stack()
+        self.span_id = next(self.tracer._ids)
+        self.parent_id = stack[-1].span_id if stack else None
+        stack.append(self)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        end = time.time()
+        self.tracer._stack().pop()
+        if exc_type is not None:
+            self.attributes['error'] = '{0}: {1}'.format(exc_type.__name__,
+                                                         exc_value)
+        args = dict(self.attributes)
+        args['span_id'] = self.span_id
+        args['parent_id'] = self.parent_id
+        self.tracer._record({
+            'name': self.name,
+            'cat': 'cvengine',
+            'ph': 'X',
+            'ts': int((self.start - self.tracer.start_time) * 1000000),
+            'dur': int((end - self.start) * 1000000),
+            'pid': os.getpid(),
+            'tid': threading.current_thread().ident,
+            'args': args
+        })
+        return False
+
+
+class _NullSpan(object):
+    """Span used when no tracer is active. Records nothing."""
+    def set(self, key, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+
+def current_tracer():
+    """Returns the tracer that is active in the current thread
+
+    Returns:
+        Tracer: The active tracer, or None if no tracer is active
+    """
+    return getattr(_active, 'tracer', None)
+
+
+def span(name, **attributes):
+    """Creates a span on the tracer that is active in the current thread
+
+    This is the function that instrumented code should use. If no tracer is
+    active, the returned span does nothing.
+
+    Args:
+        name (str): The name of the span
+        **attributes: Attributes to be recorded with the span
+
+    Returns:
+        Span: The span, to be used as a context manager
+    """
+    tracer = current_tracer()
+    if tracer is None:
+        return _NullSpan()
+    return tracer.span(name, **attributes)
+
+
+@contextmanager
+def activate(tracer, parent=None):
+    """Makes a tracer active in the current thread for a block
+
+    Args:
+        tracer (Tracer): The tracer to activate. Passing None deactivates
+            tracing for the duration of the block.
+        parent (Span, optional): A span opened in another thread. Spans
+            opened at the top level of the block become its children.
+
+    Yields:
+        Tracer: The activated tracer
+    """
+    previous = current_tracer()
+    _active.tracer = tracer
+    if tracer is not None and parent is not None:
+        tracer._stack().append(parent)
+    try:
+        yield tracer
+    finally:
+        if tracer is not None and parent is not None:
+            tracer._stack().pop()
+        _active.tracer = previous
+
+
+@contextmanager
+def recording(path):
+    """Traces a block and writes the trace to a file
+
+    A new tracer is activated in the current thread for the duration of the
+    block. The trace is written on exit, even if the block raised.
+
+    Args:
+        path (str): The path of the trace file
+
+    Yields:
+        Tracer: The new tracer
+    """
+    tracer = Tracer()
+    try:
+        with activate(tracer):
+            yield tracer
+    finally:
+        try:
+            tracer.write(path)
+        except Exception as e:
+            print('Unable to write trace file {0}: {1}'.format(path, e))
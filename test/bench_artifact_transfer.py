@@ -0,0 +1,119 @@
+#! /usr/bin/env python2
+"""Benchmarks fetching artifact directories with scp and as tar streams
+
+Fetches a directory of many small files and a directory of a few large
+files from a local stand-in SSH server (see bench_ssh_transport) with scp,
+and as a tar stream with each compressor installed on this machine, and
+prints how long each fetch took.
+
+Run it with:
+
+    python -m unittest test.bench_artifact_transfer
+
+CV_BENCH_SMALL_FILES sets the number of small files (default 2000). The
+benchmark is skipped if scp or tar are missing.
+"""
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from distutils.spawn import find_executable
+
+import paramiko
+
+from .context import cvengine  # noqa: F401
+from .bench_ssh_transport import StandInSSHServer
+from cvengine.util.fetch import COMPRESSORS, SSHConnectionPool, \
+    fetch_remote_artifact
+
+
+SMALL_FILES = int(os.environ.get('CV_BENCH_SMALL_FILES', '2000'))
+SMALL_FILE_SIZE = 2048
+LARGE_FILES = 4
+LARGE_FILE_SIZE = 8 * 1024 * 1024
+LOG_LINE = 'Oct 17 12:00:00 host dockerd[812]: msg="container {0}"\n'
+
+
+def write_file(path, size, seed):
+    """Writes a file of log lines, half of which is random data"""
+    line = LOG_LINE.format(seed)
+    with open(path, 'wb') as f:
+        f.write(os.urandom(size // 2))
+        f.write((line * (size // 2 // len(line) + 1))[:size - size // 2])
+
+
+@unittest.skipUnless(find_executable('scp') and find_executable('tar'),
+                     'scp and tar are required')
+class ArtifactTransferBenchmark(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='cvengine_bench_')
+        key_path = os.path.join(self.directory, 'key')
+        paramiko.RSAKey.generate(2048).write_private_key_file(key_path)
+        self.credentials = {'user': os.environ.get('USER', 'root'),
+                            'password': None,
+                            'ssh_key_path': key_path}
+        self.server = StandInSSHServer()
+        self.pool = SSHConnectionPool()
+
+        self.layouts = {}
+        small = os.path.join(self.directory, 'many_small')
+        for i in range(SMALL_FILES):
+            subdirectory = os.path.join(small, 'd{0}'.format(i % 20))
+            if not os.path.isdir(subdirectory):
+                os.makedirs(subdirectory)
+            write_file(os.path.join(subdirectory, 'f{0}.log'.format(i)),
+                       SMALL_FILE_SIZE, i)
+        self.layouts['many_small'] = small
+        large = os.path.join(self.directory, 'few_large')
+        os.makedirs(large)
+        for i in range(LARGE_FILES):
+            write_file(os.path.join(large, 'f{0}.log'.format(i)),
+                       LARGE_FILE_SIZE, i)
+        self.layouts['few_large'] = large
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.close()
+        shutil.rmtree(self.directory)
+
+    def time_fetch(self, layout, **options):
+        out = tempfile.mkdtemp(dir=self.directory)
+        start = time.time()
+        fetch_remote_artifact('127.0.0.1', self.credentials,
+                              self.layouts[layout], out,
+                              target_port=self.server.port, pool=self.pool,
+                              **options)
+        elapsed = time.time() - start
+        fetched = os.path.join(out, os.path.basename(self.layouts[layout]))
+        self.assertEqual(sum(len(files) for _, _, files in os.walk(fetched)),
+                         SMALL_FILES if layout == 'many_small'
+                         else LARGE_FILES)
+        shutil.rmtree(out)
+        return elapsed
+
+    def test_transfer_methods(self):
+        methods = [('scp', {'transfer': 'scp'}),
+                   ('tar', {'compression': 'none'})]
+        methods += [('tar+' + name, {'compression': name})
+                    for name in COMPRESSORS if find_executable(name)]
+
+        results = {}
+        for layout in sorted(self.layouts):
+            for name, options in methods:
+                results[layout, name] = self.time_fetch(layout, **options)
+
+        print('\nFetch times ({0} x {1}KB files, {2} x {3}MB files):'.format(
+            SMALL_FILES, SMALL_FILE_SIZE // 1024, LARGE_FILES,
+            LARGE_FILE_SIZE // 1024 // 1024))
+        for layout in sorted(self.layouts):
+            for name, _ in methods:
+                print('  {0:12} {1:10} {2:.2f}s'.format(
+                    layout, name, results[layout, name]))
+        self.assertLess(results['many_small', 'tar'],
+                        results['many_small', 'scp'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,240 @@
+#! /usr/bin/env python2
+"""Benchmarks the per-task latency of the ansible config profiles
+
+Runs the same playbook over SSH against a local SSH server with the plain
+ansible config and with the "fast" profile, and prints the average time
+each task took. The server is a small paramiko based stand-in for sshd that
+runs the requested commands as the current user, so no sshd or root access
+is needed. Its handshakes are slower than those of OpenSSH, which exaggerates
+the cost of a new connection somewhat.
+
+Run it with:
+
+    python -m unittest test.bench_ssh_transport
+
+The benchmark is skipped if ansible-playbook or the OpenSSH client tools are
+missing.
+"""
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from distutils.spawn import find_executable
+
+import paramiko
+
+from .context import cvengine  # noqa: F401
+from cvengine.util.ansible_handler import write_ansible_config
+
+
+TASKS = int(os.environ.get('CV_BENCH_TASKS', '10'))
+# Both configs move files by piping them through dd, as the sftp subsystem
+# of the stand-in only answers stat requests
+COMMON_SECTIONS = {'ssh_connection': {'transfer_method': 'piped'}}
+PLAYBOOK = '''
+- hosts: all
+  gather_facts: false
+  tasks:
+{tasks}
+'''
+TASK = '''    - command: "true"
+'''
+
+
+class CommandServer(paramiko.ServerInterface):
+    """Accepts any public key and runs exec requests with /bin/sh"""
+    def __init__(self, stand_in):
+        self.stand_in = stand_in
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        self.stand_in.commands += 1
+        thread = threading.Thread(target=run_command,
+                                  args=(channel, command))
+        thread.daemon = True
+        thread.start()
+        return True
+
+
+class StatSFTPServer(paramiko.SFTPServerInterface):
+    """Answers sftp stat requests from the local file system"""
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def lstat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.lstat(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+
+def run_command(channel, command):
+    p = subprocess.Popen(['/bin/sh', '-c', command], stdin=subprocess.PIPE,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def pump_stdin():
+        while True:
+            data = channel.recv(32768)
+            if not data:
+                break
+            p.stdin.write(data)
+        p.stdin.close()
+
+    def pump(source, send):
+        for data in iter(lambda: os.read(source.fileno(), 32768), ''):
+            send(data)
+
+    threads = [threading.Thread(target=pump_stdin),
+               threading.Thread(target=pump,
+                                args=(p.stderr, channel.sendall_stderr))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    pump(p.stdout, channel.sendall)
+    threads[1].join()
+    channel.send_exit_status(p.wait())
+    channel.close()
+
+
+class StandInSSHServer(object):
+    """A paramiko based SSH server listening on a random local port"""
+    def __init__(self):
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(100)
+        self.port = self.sock.getsockname()[1]
+        self.connections = 0
+        self.commands = 0
+        thread = threading.Thread(target=self.serve)
+        thread.daemon = True
+        thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                client, _ = self.sock.accept()
+            except socket.error:
+                return
+            self.connections += 1
+            thread = threading.Thread(target=self.handle_connection,
+                                      args=(client,))
+            thread.daemon = True
+            thread.start()
+
+    def handle_connection(self, client):
+        transport = paramiko.Transport(client)
+        transport.add_server_key(self.host_key)
+        transport.set_subsystem_handler('sftp', paramiko.SFTPServer,
+                                        StatSFTPServer)
+        try:
+            transport.start_server(server=CommandServer(self))
+        except (paramiko.SSHException, EOFError):
+            return
+        # paramiko closes channels that are garbage collected, so keep them
+        # referenced for as long as the connection is open
+        channels = []
+        while transport.is_active():
+            channels.append(transport.accept(1))
+
+    def close(self):
+        self.sock.close()
+
+
+@unittest.skipUnless(find_executable('ansible-playbook') and
+                     find_executable('ssh') and find_executable('ssh-keygen'),
+                     'ansible-playbook, ssh and ssh-keygen are required')
+class SSHTransportBenchmark(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='cvengine_bench_')
+        key_path = os.path.join(self.directory, 'id_rsa')
+        subprocess.check_call(['ssh-keygen', '-q', '-t', 'ed25519', '-N', '',
+                               '-f', key_path])
+        self.server = StandInSSHServer()
+
+        self.inventory = os.path.join(self.directory, 'inventory')
+        with open(self.inventory, 'w') as f:
+            f.write('target ansible_host=127.0.0.1 ansible_port={0} '
+                    'ansible_user={1} ansible_ssh_private_key_file={2} '
+                    'ansible_python_interpreter={3} '
+                    'ansible_ssh_common_args="-o UserKnownHostsFile=/dev/null"'
+                    '\n'.format(self.server.port,
+                                os.environ.get('USER', 'root'), key_path,
+                                sys.executable))
+
+        self.playbooks = {}
+        for count in (1, TASKS):
+            path = os.path.join(self.directory, 'tasks_{0}.yml'.format(count))
+            with open(path, 'w') as f:
+                f.write(PLAYBOOK.format(tasks=TASK * count))
+            self.playbooks[count] = path
+
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.directory)
+
+    def time_playbook(self, config, count):
+        env = dict(os.environ, ANSIBLE_CONFIG=config)
+        start = time.time()
+        p = subprocess.Popen(['ansible-playbook', '-i', self.inventory,
+                              self.playbooks[count]],
+                             env=env, stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT)
+        output = p.communicate()[0]
+        self.assertEqual(p.returncode, 0, output)
+        return time.time() - start
+
+    def per_task_latency(self, config):
+        # Subtract the run with a single task to leave out the start up time
+        # of ansible-playbook itself
+        single = self.time_playbook(config, 1)
+        many = self.time_playbook(config, TASKS)
+        return (many - single) / (TASKS - 1)
+
+    def test_fast_profile_latency(self):
+        default_config = write_ansible_config(sections=COMMON_SECTIONS)
+        fast_config = write_ansible_config(sections=COMMON_SECTIONS,
+                                           profile='fast')
+
+        results = []
+        for name, config in (('default', default_config),
+                             ('fast', fast_config)):
+            connections = self.server.connections
+            commands = self.server.commands
+            latency = self.per_task_latency(config)
+            results.append((name, latency,
+                            self.server.connections - connections,
+                            self.server.commands - commands))
+
+        print('\nPer task latency over {0} tasks:'.format(TASKS))
+        for result in results:
+            print('  {0:8} {1:.3f}s ({2} ssh connections, {3} ssh '
+                  'commands)'.format(*result))
+        (_, default_latency, _, default_commands), \
+            (_, fast_latency, _, fast_commands) = results
+        self.assertLess(fast_latency, default_latency)
+        self.assertLess(fast_commands, default_commands)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+#! /usr/bin/env python2
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from .context import cvengine  # noqa: F401
+from cvengine.util.ansible_api import AnsibleApiRunner, format_event
+from cvengine.util.run import CommandError
+
+try:
+    import ansible  # noqa: F401
+    HAVE_ANSIBLE = True
+except ImportError:
+    HAVE_ANSIBLE = False
+
+
+class FormatEventTest(unittest.TestCase):
+    def test_play_and_task_start(self):
+        self.assertEqual(
+            format_event({'event': 'play_start', 'play': 'setup'}),
+            'PLAY [setup]')
+        self.assertEqual(
+            format_event({'event': 'task_start', 'task': 'install'}),
+            'TASK [install]')
+
+    def test_runner_result(self):
+        event = {'event': 'runner_result', 'status': 'changed',
+                 'host': 'web', 'result': {'msg': 'not shown'}}
+        self.assertEqual(format_event(event), 'changed: [web]')
+
+    def test_failure_message(self):
+        event = {'event': 'runner_result', 'status': 'failed',
+                 'host': 'web', 'result': {'msg': 'no package'}}
+        self.assertEqual(format_event(event), 'failed: [web] no package')
+        event['ignore_errors'] = True
+        self.assertEqual(format_event(event),
+                         'failed: [web] no package (ignored)')
+        event = {'event': 'runner_result', 'status': 'unreachable',
+                 'host': 'web', 'result': {}}
+        self.assertEqual(format_event(event), 'unreachable: [web]')
+
+    def test_stats(self):
+        event = {'event': 'stats',
+                 'stats': {'web': {'ok': 2, 'failures': 0},
+                           'db': {'ok': 1, 'failures': 1}}}
+        self.assertEqual(format_event(event),
+                         'PLAY RECAP db: failures=1 ok=1, '
+                         'web: failures=0 ok=2')
+
+    def test_unknown_event(self):
+        self.assertIsNone(format_event({'event': 'done', 'returncode': 0}))
+
+
+PASSING_PLAYBOOK = '''
+- hosts: all
+  gather_facts: false
+  tasks:
+    - name: greet
+      debug:
+        msg: "hello {{ greeting }}"
+    - name: change
+      command: "true"
+'''
+
+FAILING_PLAYBOOK = '''
+- hosts: all
+  gather_facts: false
+  tasks:
+    - name: break
+      fail:
+        msg: broken
+    - name: never
+      debug:
+        msg: unreachable
+'''
+
+
+@unittest.skipUnless(HAVE_ANSIBLE, 'requires ansible')
+class AnsibleApiRunnerTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.ansible_config = os.path.join(self.directory, 'ansible.cfg')
+        with open(self.ansible_config, 'w') as config:
+            config.write('[defaults]\nretry_files_enabled = False\n'
+                         'interpreter_python = {0}\n'.format(sys.executable))
+        self.runner = AnsibleApiRunner('localhost,', self.ansible_config,
+                                       connection='local')
+
+    def tearDown(self):
+        self.runner.close()
+        shutil.rmtree(self.directory)
+
+    def write_playbook(self, name, content):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as playbook:
+            playbook.write(content)
+        return path
+
+    def test_events(self):
+        path = self.write_playbook('pass.yml', PASSING_PLAYBOOK)
+        events = self.runner.run_playbook(path, {'greeting': 'world'})
+        self.assertEqual([e['event'] for e in events],
+                         ['play_start', 'task_start', 'runner_result',
+                          'task_start', 'runner_result', 'stats'])
+        self.assertEqual(events[2]['result']['msg'], 'hello world')
+        self.assertEqual(events[2]['status'], 'ok')
+        self.assertEqual(events[4]['status'], 'changed')
+        stats = events[-1]['stats']['localhost']
+        self.assertEqual(stats['ok'], 2)
+        self.assertEqual(stats['changed'], 1)
+        self.assertEqual(stats['failures'], 0)
+
+    def test_worker_is_reused(self):
+        path = self.write_playbook('pass.yml', PASSING_PLAYBOOK)
+        self.runner.run_playbook(path, {'greeting': 'one'})
+        pid = self.runner._process.pid
+        events = self.runner.run_playbook(path, {'greeting': 'two'})
+        self.assertEqual(self.runner._process.pid, pid)
+        # Extra vars of the first playbook do not leak into the second
+        self.assertEqual(events[2]['result']['msg'], 'hello two')
+
+    def test_failed_task(self):
+        path = self.write_playbook('fail.yml', FAILING_PLAYBOOK)
+        with self.assertRaises(CommandError) as raised:
+            self.runner.run_playbook(path, {})
+        self.assertNotEqual(raised.exception.returncode, 0)
+        self.assertIn('failed: [localhost] broken',
+                      raised.exception.tail)
+
+    def test_worker_error(self):
+        path = os.path.join(self.directory, 'missing.yml')
+        with self.assertRaises(CommandError) as raised:
+            self.runner.run_playbook(path, {})
+        self.assertIsNone(raised.exception.returncode)
+        self.assertTrue(any('Traceback' in line
+                            for line in raised.exception.tail))
+        # The worker keeps serving requests after an error
+        path = self.write_playbook('pass.yml', PASSING_PLAYBOOK)
+        self.runner.run_playbook(path, {'greeting': 'again'})
+
+
+if __name__ == '__main__':
+    unittest.main()
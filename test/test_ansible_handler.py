@@ -0,0 +1,93 @@
+#! /usr/bin/env python2
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from .context import cvengine  # noqa: F401
+from cvengine.util.ansible_handler import fact_cache_directory, \
+    fact_cache_sections, invalidate_facts, write_ansible_config
+
+
+class FactCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.config = {'directory': self.directory}
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def cache_facts(self, host, port):
+        directory = fact_cache_directory(self.config, port)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        path = os.path.join(directory, host)
+        with open(path, 'w') as facts:
+            facts.write('{}')
+        return path
+
+    def test_sections(self):
+        sections = fact_cache_sections(dict(self.config, fact_timeout=60))
+        self.assertEqual(sections, {'defaults': {
+            'gathering': 'smart',
+            'fact_caching': 'jsonfile',
+            'fact_caching_connection': os.path.join(self.directory,
+                                                    'facts'),
+            'fact_caching_timeout': '60'}})
+
+    def test_disabled(self):
+        self.assertEqual(
+            fact_cache_sections(dict(self.config, facts=False), 22), {})
+
+    def test_ports_do_not_share_facts(self):
+        first = fact_cache_sections(self.config, 2222)['defaults']
+        second = fact_cache_sections(self.config, 2223)['defaults']
+        self.assertNotEqual(first['fact_caching_connection'],
+                            second['fact_caching_connection'])
+        self.assertEqual(first['fact_caching_connection'],
+                         fact_cache_directory(self.config, 2222))
+
+    def test_invalidate_facts(self):
+        fresh = self.cache_facts('localhost', 2222)
+        other_port = self.cache_facts('localhost', 2223)
+        other_host = self.cache_facts('10.0.0.1', 2222)
+        invalidate_facts(self.config, 'localhost', 2222)
+        self.assertFalse(os.path.exists(fresh))
+        self.assertTrue(os.path.exists(other_port))
+        self.assertTrue(os.path.exists(other_host))
+        # Hosts without cached facts are ignored
+        invalidate_facts(self.config, 'localhost', 2222)
+        invalidate_facts(self.config, 'localhost', 2224)
+
+
+class AnsibleConfigTest(unittest.TestCase):
+    def read_config(self, path):
+        try:
+            with open(path) as config:
+                return config.read().splitlines()
+        finally:
+            os.remove(path)
+
+    def test_fast_profile(self):
+        before = set(os.listdir(tempfile.gettempdir()))
+        lines = self.read_config(write_ansible_config(
+            options={'forks': '5'}, profile='fast'))
+        self.assertEqual(lines, ['[defaults]',
+                                 'force_color = 1',
+                                 'forks = 5',
+                                 'gathering = smart',
+                                 'host_key_checking = False',
+                                 '',
+                                 '[ssh_connection]',
+                                 'pipelining = True'])
+        # Writing a config leaves nothing else behind
+        self.assertEqual(set(os.listdir(tempfile.gettempdir())), before)
+
+    def test_unknown_profile(self):
+        self.assertRaises(ValueError, write_ansible_config,
+                          profile='slow')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+#! /usr/bin/env python2
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import yaml
+
+from .context import cvengine  # noqa: F401
+from cvengine import batch
+from cvengine.batch import _run_batch_job, job_platform, normalize_job, \
+    run_validation_batch
+
+
+class BatchJobTest(unittest.TestCase):
+    def test_normalize_job(self):
+        job = normalize_job(('image', 'cvdata.yml', 'atomic'), 3)
+        self.assertEqual(job, {'image_url': 'image',
+                               'cvdata_url': 'cvdata.yml',
+                               'target_host_platform': 'atomic',
+                               'name': 'job-3', 'extra_vars': {}})
+        self.assertRaises(ValueError, normalize_job,
+                          {'image_url': 'image'}, 0)
+
+    def test_job_platform(self):
+        metadata = {'Test': [{'host_type': 'fedora'},
+                             {'host_type': 'atomic'}]}
+        job = normalize_job(('image', 'cvdata.yml'), 0)
+        self.assertIsNone(job_platform(job, {}, metadata))
+        self.assertEqual(job_platform(
+            job, {'target_host_platform': 'atomic'}, metadata), 'atomic')
+        self.assertEqual(job_platform(
+            job, {'target_host_platforms': 'all'}, metadata), 'fedora')
+        job['target_host_platform'] = 'atomic'
+        self.assertEqual(job_platform(
+            job, {'target_host_platforms': ['fedora']}, metadata), 'atomic')
+
+
+class BatchRunTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        metadata = {'Test': [], 'Artifacts': []}
+        for host_type in ('fedora', 'atomic'):
+            playbook = os.path.join(self.directory, host_type + '.yml')
+            with open(playbook, 'w') as f:
+                f.write('- hosts: all\n')
+            metadata['Test'].append({'host_type': host_type,
+                                     'playbooks': [{'url': 'file://' +
+                                                    playbook}]})
+        path = os.path.join(self.directory, 'cvdata.yml')
+        with open(path, 'w') as f:
+            yaml.safe_dump(metadata, f)
+        self.cvdata_url = 'file://' + path
+        self.config = {'cache': {'directory':
+                                 os.path.join(self.directory, 'cache')},
+                       'target_host_platforms': ['fedora', 'atomic'],
+                       'environment': {'handler': 'preconfigured'}}
+        self.scenarios = []
+        self.run_scenario = batch.run_scenario
+        batch.run_scenario = self.record_scenario
+
+    def tearDown(self):
+        batch.run_scenario = self.run_scenario
+        shutil.rmtree(self.directory)
+
+    def record_scenario(self, scenario, artifacts, environment_config,
+                        artifacts_directory, extra_variables, config=None,
+                        cancel_token=None):
+        self.scenarios.append((scenario['host_type'], artifacts_directory,
+                               extra_variables))
+        if extra_variables.get('fail'):
+            raise Exception('validation failed')
+
+    def run_job(self, job):
+        job = normalize_job(job, 0)
+        return _run_batch_job((job, self.config, self.directory,
+                               {'shared': 1}, None))
+
+    def test_job_platform_overrides_config(self):
+        result = self.run_job({'image_url': 'image', 'name': 'one',
+                               'cvdata_url': self.cvdata_url,
+                               'target_host_platform': 'atomic',
+                               'extra_vars': {'own': 2}})
+        self.assertEqual(result['status'], 'passed')
+        host_type, artifacts_directory, variables = self.scenarios[0]
+        self.assertEqual(host_type, 'atomic')
+        self.assertEqual(artifacts_directory,
+                         os.path.join(self.directory, 'one'))
+        self.assertEqual(variables, {'shared': 1, 'own': 2,
+                                     'image_url': 'image'})
+
+        # Without a platform of its own, the job runs on the first platform
+        # of the config
+        self.run_job(('image', self.cvdata_url))
+        self.assertEqual(self.scenarios[1][0], 'fedora')
+
+    def test_failed_job(self):
+        result = self.run_job({'image_url': 'image',
+                               'cvdata_url': self.cvdata_url,
+                               'extra_vars': {'fail': True}})
+        self.assertEqual(result['status'], 'failed')
+        self.assertIn('validation failed', result['error'])
+
+    def test_duplicate_names(self):
+        jobs = [{'image_url': 'a', 'cvdata_url': self.cvdata_url,
+                 'name': 'same'},
+                {'image_url': 'b', 'cvdata_url': self.cvdata_url,
+                 'name': 'same'}]
+        self.assertRaises(ValueError, run_validation_batch, jobs,
+                          self.config, self.directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
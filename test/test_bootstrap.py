@@ -0,0 +1,59 @@
+#! /usr/bin/env python2
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from .context import cvengine  # noqa: F401
+from cvengine.util.bootstrap import bootstrap_script, parse_bootstrap_output
+from cvengine.util.run import run_cmd
+
+
+class BootstrapScriptTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.marker = os.path.join(self.directory, 'state', 'fingerprint')
+        self.log = os.path.join(self.directory, 'log')
+        self.steps = [
+            {'name': 'missing', 'packages': ['a', 'b'], 'probe': 'false'},
+            {'name': 'installed', 'packages': ['c'], 'probe': 'true'},
+            {'name': 'also missing', 'packages': ['d'], 'probe': 'false'},
+            {'name': 'service', 'probe': 'false',
+             'apply': 'echo service >> {0}'.format(self.log)},
+            {'name': 'running', 'probe': 'true',
+             'apply': 'echo running >> {0}'.format(self.log)},
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def bootstrap(self, steps):
+        script = bootstrap_script(
+            steps, package_manager='echo install >> {0}; echo'.format(
+                self.log), marker=self.marker)
+        return parse_bootstrap_output(run_cmd(script))
+
+    def logged(self):
+        with open(self.log) as f:
+            return f.read().splitlines()
+
+    def test_bootstrap(self):
+        self.assertEqual(self.bootstrap(self.steps),
+                         ('bootstrapped',
+                          ['missing', 'also missing', 'service']))
+        self.assertEqual(self.logged(), ['install', 'service'])
+
+        self.assertEqual(self.bootstrap(self.steps), ('skipped', []))
+        self.assertEqual(self.logged(), ['install', 'service'])
+
+        # Changing the steps changes the fingerprint
+        self.assertEqual(self.bootstrap(self.steps[3:]),
+                         ('bootstrapped', ['service']))
+
+    def test_invalid_step(self):
+        self.assertRaises(ValueError, bootstrap_script, [{'name': 'empty'}])
+
+
+if __name__ == '__main__':
+    unittest.main()
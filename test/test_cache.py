@@ -0,0 +1,94 @@
+#! /usr/bin/env python2
+
+import BaseHTTPServer
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from .context import cvengine  # noqa: F401
+from cvengine.util.cache import DownloadCache
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    files = {}
+    requests = []
+
+    def do_GET(self):
+        body = self.files[self.path]
+        etag = '"{0}"'.format(hash(body))
+        self.requests.append((self.path,
+                              self.headers.getheader('If-None-Match')))
+        if self.headers.getheader('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class DownloadCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        _Handler.files = {'/a/site.yml': 'a' * 10,
+                          '/b/site.yml': 'b' * 10}
+        _Handler.requests = []
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), _Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.base = 'http://127.0.0.1:{0}'.format(self.server.server_port)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def test_same_basename_does_not_clobber(self):
+        cache = DownloadCache(self.directory)
+        paths = cache.fetch_many([self.base + '/a/site.yml',
+                                  self.base + '/b/site.yml'])
+        a_path = paths[self.base + '/a/site.yml']
+        b_path = paths[self.base + '/b/site.yml']
+        self.assertNotEqual(a_path, b_path)
+        self.assertEqual(os.path.basename(a_path), 'site.yml')
+        with open(a_path) as f:
+            self.assertEqual(f.read(), 'a' * 10)
+
+    def test_revalidates_with_etag(self):
+        cache = DownloadCache(self.directory)
+        url = self.base + '/a/site.yml'
+        first = cache.fetch(url)
+        second = cache.fetch(url)
+        self.assertEqual(first, second)
+        self.assertIsNone(_Handler.requests[0][1])
+        self.assertIsNotNone(_Handler.requests[1][1])
+
+        _Handler.files['/a/site.yml'] = 'changed'
+        with open(cache.fetch(url)) as f:
+            self.assertEqual(f.read(), 'changed')
+
+    def test_fresh_entries_skip_the_server(self):
+        cache = DownloadCache(self.directory, max_age=3600)
+        url = self.base + '/a/site.yml'
+        cache.fetch(url)
+        cache.fetch(url)
+        self.assertEqual(len(_Handler.requests), 1)
+
+    def test_evicts_least_recently_used(self):
+        cache = DownloadCache(self.directory, max_bytes=15)
+        a_path = cache.fetch(self.base + '/a/site.yml')
+        b_path = cache.fetch(self.base + '/b/site.yml')
+        self.assertFalse(os.path.exists(a_path))
+        self.assertTrue(os.path.exists(b_path))
+
+
+if __name__ == '__main__':
+    unittest.main()
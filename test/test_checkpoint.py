@@ -0,0 +1,120 @@
+#! /usr/bin/env python2
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from .context import cvengine  # noqa: F401
+from cvengine.cvengine import environment_handlers, platform_handlers, \
+    run_scenario
+from cvengine.environment_handlers.base_environment_handler import \
+    BaseEnvironmentHandler
+from cvengine.platform_handlers.base_platform_handler import \
+    BasePlatformHandler
+from cvengine.util.checkpoint import RUN_STATE_FILE
+
+
+calls = []
+failing = set()
+gone = []
+
+
+class FakeEnvironment(BaseEnvironmentHandler):
+    def __init__(self, env_config):
+        self.set_required_data('host', '127.0.0.1', 'user', 'secret', None,
+                               22)
+
+    def prepare(self):
+        calls.append('prepare')
+
+    def restore(self, details):
+        super(FakeEnvironment, self).restore(details)
+        calls.append('restore')
+        if gone:
+            raise Exception('The host is gone')
+
+    def teardown(self):
+        calls.append('teardown')
+
+
+class FakePlatform(BasePlatformHandler):
+    def __init__(self, *args):
+        super(FakePlatform, self).__init__(*args)
+        self.run_playbooks_locally = True
+
+    def setup(self):
+        if not self.phase_done('bootstrap'):
+            calls.append('bootstrap')
+            self.complete_phase('bootstrap')
+
+    def run_playbook(self, path, extra_vars, extra_vars_file=None):
+        calls.append(path)
+        if path in failing:
+            raise Exception('{0} failed'.format(path))
+
+
+class ResumeTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        environment_handlers.register('fake', FakeEnvironment)
+        platform_handlers.register('fake', FakePlatform)
+        del calls[:]
+        del gone[:]
+        failing.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_scenario(self, **kwargs):
+        scenario = {'host_type': 'fake',
+                    'playbooks': [{'url': name, 'local_path': name}
+                                  for name in ('a', 'b', 'c')]}
+        del calls[:]
+        run_scenario(scenario, {}, {'handler': 'fake'}, self.directory,
+                     {'image_url': 'image'}, **kwargs)
+
+    def test_resume_after_failure(self):
+        failing.add('b')
+        self.assertRaises(Exception, self.run_scenario,
+                          keep_environment=True)
+        self.assertEqual(calls, ['prepare', 'bootstrap', 'a', 'b'])
+        with open(os.path.join(self.directory, RUN_STATE_FILE)) as f:
+            state = json.load(f)
+        self.assertEqual((state['status'], state['playbooks']),
+                         ('failed', ['a']))
+        self.assertNotIn('password', state['environment']['details'])
+
+        failing.clear()
+        self.run_scenario(resume=True, keep_environment=True)
+        self.assertEqual(calls, ['restore', 'b', 'c', 'teardown'])
+
+        self.run_scenario(resume=True)
+        self.assertEqual(calls, [])
+
+    def test_resume_starts_over_when_restore_fails(self):
+        failing.add('b')
+        self.assertRaises(Exception, self.run_scenario,
+                          keep_environment=True)
+
+        failing.clear()
+        gone.append(True)
+        self.run_scenario(resume=True)
+        self.assertEqual(calls, ['restore', 'prepare', 'bootstrap', 'a', 'b',
+                                 'c', 'teardown'])
+        with open(os.path.join(self.directory, RUN_STATE_FILE)) as f:
+            self.assertEqual(json.load(f)['status'], 'passed')
+
+    def test_failure_tears_down_by_default(self):
+        failing.add('a')
+        self.assertRaises(Exception, self.run_scenario)
+        self.assertEqual(calls, ['prepare', 'bootstrap', 'a', 'teardown'])
+        self.assertRaises(Exception, run_scenario,
+                          {'host_type': 'fake', 'playbooks': []}, {},
+                          {'handler': 'fake'}, self.directory,
+                          {'image_url': 'another image'}, resume=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,196 @@
+#! /usr/bin/env python2
+
+import json
+import os
+import shutil
+import stat
+import tarfile
+import tempfile
+import threading
+import unittest
+
+from distutils.spawn import find_executable
+
+import paramiko
+
+from .context import cvengine  # noqa: F401
+from .bench_ssh_transport import StandInSSHServer
+from cvengine.util.artifacts import ARCHIVE_INDEX, ARTIFACT_MANIFEST, \
+    ArtifactArchive, ArtifactBudget, ArtifactCollector, budget_result, \
+    container_copy_script, copy_planned, fetch_planned, local_file_sizes, \
+    parse_container_copy_output
+from cvengine.util.fetch import ArtifactMissing, SSHConnectionPool
+from cvengine.util.run import run_cmd
+
+
+FAKE_COPY = '''#!/bin/sh
+src=${1#*:}
+if [ ! -e "$src" ]; then
+    echo "Error: No such container:path: $1" >&2
+    exit 1
+fi
+case "$src" in *unreadable*) echo "permission denied" >&2; exit 1 ;; esac
+cp -r "$src" "$2"
+'''
+
+
+class ArtifactCollectorTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_statuses_and_manifest(self):
+        collector = ArtifactCollector(workers=2)
+        barrier = threading.Event()
+
+        def fetched():
+            # Only returns once the other fetch runs at the same time
+            barrier.wait(5)
+            return 10
+
+        def missing():
+            barrier.set()
+            raise ArtifactMissing('gone')
+
+        def failed():
+            raise IOError('connection dropped')
+
+        collector.submit('test_host', '/a', fetched)
+        collector.submit('test_host', '/b', missing)
+        collector.submit('test_host', '/c', failed)
+        collector.record('container', '/d', 'missing', error='not there')
+        collector.join()
+        collector.write_manifest(self.directory)
+
+        with open(os.path.join(self.directory, ARTIFACT_MANIFEST)) as f:
+            entries = json.load(f)['artifacts']
+        self.assertEqual([(e['path'], e['status']) for e in entries],
+                         [('/a', 'fetched'), ('/b', 'missing'),
+                          ('/c', 'failed'), ('/d', 'missing')])
+        self.assertEqual(entries[0]['bytes'], 10)
+        self.assertTrue(barrier.is_set())
+        self.assertEqual(entries[2]['error'], 'connection dropped')
+        self.assertEqual(collector.failed(), [collector.entries[2]])
+
+    def test_container_copy_script(self):
+        copy_cmd = os.path.join(self.directory, 'copy')
+        with open(copy_cmd, 'w') as f:
+            f.write(FAKE_COPY)
+        os.chmod(copy_cmd, stat.S_IRWXU)
+        source = os.path.join(self.directory, 'container')
+        os.makedirs(os.path.join(source, 'logs'))
+        os.makedirs(os.path.join(source, 'unreadable'))
+        with open(os.path.join(source, 'logs', 'app.log'), 'w') as f:
+            f.write('x' * 100)
+        destination = os.path.join(self.directory, 'host_data_out')
+        os.makedirs(destination)
+
+        paths = [os.path.join(source, name)
+                 for name in ('logs', 'missing', 'unreadable')]
+        lines = run_cmd(container_copy_script(copy_cmd, 'instance', paths,
+                                              destination))
+        results = parse_container_copy_output(lines, paths)
+
+        self.assertEqual([r['status'] for r in results],
+                         ['fetched', 'missing', 'failed'])
+        self.assertGreaterEqual(results[0]['bytes'], 100)
+        self.assertEqual(results[2]['error'], 'permission denied')
+        self.assertTrue(os.path.isfile(os.path.join(destination, 'logs',
+                                                    'app.log')))
+
+
+class ArtifactBudgetTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.source = os.path.join(self.directory, 'logs')
+        os.makedirs(os.path.join(self.source, 'journal'))
+        self.files = {'small.log': 'a' * 10,
+                      'journal/medium.log': 'b' * 40 + 'end of b',
+                      'runaway.log': 'c' * 500 + 'end of c'}
+        for name, data in self.files.items():
+            with open(os.path.join(self.source, name), 'w') as f:
+                f.write(data)
+        self.artifacts = os.path.join(self.directory, 'artifacts')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read_archive(self):
+        with tarfile.open(os.path.join(self.artifacts,
+                                       'artifacts.tar.gz')) as tar:
+            return dict((member.name, tar.extractfile(member).read())
+                        for member in tar.getmembers())
+
+    def test_plan(self):
+        budget = ArtifactBudget(max_artifact_bytes=60, max_run_bytes=100)
+        plan = budget.plan(local_file_sizes(self.source))
+        self.assertEqual(plan['whole'], ['journal/medium.log', 'small.log'])
+        self.assertEqual(plan['truncated'], {'runaway.log': 2})
+        self.assertEqual(plan['reason'], 'max_artifact_bytes (60) exceeded')
+
+        # Only 40 bytes of the run budget are left for the second artifact
+        plan = budget.plan({'a': 30, 'b': 30})
+        self.assertEqual((plan['whole'], plan['truncated']),
+                         (['a'], {'b': 10}))
+        self.assertEqual(budget.plan({'c': 1})['skipped'], ['c'])
+        budget.release(plan, 30)
+        self.assertEqual(budget.used, 90)
+
+        split = ArtifactBudget(max_artifact_bytes=50).plan(
+            {'one/a': 40, 'one/b': 40, 'two/c': 40}, split=True)
+        self.assertEqual(split['truncated'], {'one/b': 10})
+        self.assertRaises(ValueError, ArtifactBudget, max_run_bytes=-1)
+
+    def test_copy_into_archive(self):
+        budget = ArtifactBudget(max_artifact_bytes=100)
+        plan = budget.plan(local_file_sizes(self.source))
+        archive = ArtifactArchive(self.artifacts)
+        used = copy_planned(self.source, self.artifacts, plan, archive)
+        archive.close()
+
+        self.assertEqual(budget_result(plan, used)['status'], 'truncated')
+        members = self.read_archive()
+        self.assertEqual(members['logs/small.log'], self.files['small.log'])
+        self.assertEqual(members['logs/runaway.log'], 'c' * 34 + 'end of c')
+        with open(os.path.join(self.artifacts, ARCHIVE_INDEX)) as f:
+            index = json.load(f)['members']
+        self.assertEqual([m['original_bytes'] for m in index
+                          if m['name'] == 'logs/runaway.log'], [508])
+
+    @unittest.skipUnless(find_executable('tar'), 'tar is required')
+    def test_fetch_planned(self):
+        key_path = os.path.join(self.directory, 'key')
+        paramiko.RSAKey.generate(2048).write_private_key_file(key_path)
+        credentials = {'user': os.environ.get('USER', 'root'),
+                       'password': None,
+                       'ssh_key_path': key_path}
+        server = StandInSSHServer()
+        pool = SSHConnectionPool()
+        try:
+            ssh = pool.get('127.0.0.1', credentials, port=server.port)
+            budget = ArtifactBudget(max_artifact_bytes=100)
+            plan = budget.plan(local_file_sizes(self.source))
+
+            fetch_planned(ssh, self.source, self.artifacts, plan)
+            with open(os.path.join(self.artifacts, 'logs',
+                                   'runaway.log')) as f:
+                self.assertEqual(f.read(), 'c' * 34 + 'end of c')
+
+            archive = ArtifactArchive(self.artifacts)
+            fetch_planned(ssh, self.source, self.artifacts, plan, archive)
+            archive.close()
+            members = self.read_archive()
+            self.assertEqual(sorted(members), ['logs/journal/medium.log',
+                                               'logs/runaway.log',
+                                               'logs/small.log'])
+            self.assertEqual(members['logs/journal/medium.log'],
+                             self.files['journal/medium.log'])
+        finally:
+            pool.close()
+            server.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
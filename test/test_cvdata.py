@@ -0,0 +1,87 @@
+#! /usr/bin/env python2
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import yaml
+
+from .context import cvengine  # noqa: F401
+from cvengine import cvdata
+from cvengine.cvdata import CVData
+from cvengine.util.cache import DownloadCache
+
+
+METADATA = {
+    'Test': [
+        {'host_type': 'atomic', 'playbooks': [{'url': 'a.yml'}]},
+        {'host_type': 'fedora', 'default': True,
+         'playbooks': [{'url': 'f.yml'}]},
+        {'host_type': 'atomic', 'playbooks': [{'url': 'ignored.yml'}]},
+    ],
+    'Artifacts': [],
+}
+
+
+class CVDataTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        path = os.path.join(self.directory, 'cvdata.yml')
+        with open(path, 'w') as f:
+            yaml.safe_dump(METADATA, f)
+        self.url = 'file://' + path
+        self.cache = DownloadCache(os.path.join(self.directory, 'cache'))
+        cvdata._parsed_metadata.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def load(self, config):
+        return CVData('image', self.url, config, cache=self.cache)
+
+    def test_platform_selection(self):
+        data = self.load({})
+        self.assertEqual(data.scenario['host_type'], 'fedora')
+        data = self.load({'target_host_platform': 'atomic'})
+        self.assertEqual(data.scenario['playbooks'], [{'url': 'a.yml'}])
+        self.assertIs(data.scenario, data.metadata['Test'][0])
+        data = self.load({'target_host_platforms': 'all'})
+        self.assertEqual([s['host_type'] for s in data.scenarios],
+                         ['atomic', 'fedora'])
+        self.assertRaises(ValueError, self.load,
+                          {'target_host_platform': 'openshift'})
+
+    def test_parse_is_memoized(self):
+        first = self.load({})
+        self.assertEqual(len(cvdata._parsed_metadata), 1)
+        memoized = cvdata._parsed_metadata.values()[0]
+        self.assertEqual(memoized[1], {'atomic': 0, 'fedora': 1, None: 1})
+
+        # Every load gets its own copy to modify
+        first.scenario['playbooks'].append({'url': 'added.yml'})
+        second = self.load({})
+        self.assertEqual(len(cvdata._parsed_metadata), 1)
+        self.assertEqual(second.scenario['playbooks'], [{'url': 'f.yml'}])
+        self.assertIsNot(second.metadata, memoized[0])
+
+    def test_memo_is_bounded(self):
+        self.load({})
+        first_digest = cvdata._parsed_metadata.keys()[0]
+        for count in range(cvdata.MAX_PARSED_METADATA):
+            path = os.path.join(self.directory, 'other{0}.yml'.format(count))
+            with open(path, 'w') as f:
+                yaml.safe_dump(dict(METADATA, Artifacts=[str(count)]), f)
+            CVData('image', 'file://' + path, {}, cache=self.cache)
+            if count == 0:
+                second_digest = cvdata._parsed_metadata.keys()[-1]
+                # Using a document again keeps it from being dropped first
+                self.load({})
+        self.assertEqual(len(cvdata._parsed_metadata),
+                         cvdata.MAX_PARSED_METADATA)
+        self.assertIn(first_digest, cvdata._parsed_metadata)
+        self.assertNotIn(second_digest, cvdata._parsed_metadata)
+
+
+if __name__ == '__main__':
+    unittest.main()
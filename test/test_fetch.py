@@ -0,0 +1,150 @@
+#! /usr/bin/env python2
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from distutils.spawn import find_executable
+
+import paramiko
+
+from .context import cvengine  # noqa: F401
+from .bench_ssh_transport import StandInSSHServer
+from cvengine.util import fetch
+from cvengine.util.fetch import SSHConnectionPool, fetch_remote_artifact, \
+    get_file_type, stat_remote_paths
+from cvengine.util.remote import RemoteExecutor
+from cvengine.util.run import CommandError, CommandTimeout
+
+
+@unittest.skipUnless(find_executable('scp'), 'scp is required')
+class RemoteFetchTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        key_path = os.path.join(self.directory, 'key')
+        paramiko.RSAKey.generate(2048).write_private_key_file(key_path)
+        self.credentials = {'user': os.environ.get('USER', 'root'),
+                            'password': None,
+                            'ssh_key_path': key_path}
+        self.server = StandInSSHServer()
+        self.pool = SSHConnectionPool()
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.close()
+        shutil.rmtree(self.directory)
+
+    def test_one_connection_per_host(self):
+        out = os.path.join(self.directory, 'out')
+        for i in range(20):
+            path = os.path.join(self.directory, 'artifact_{0}'.format(i))
+            with open(path, 'w') as f:
+                f.write(str(i))
+            fetch_remote_artifact('127.0.0.1', self.credentials, path, out,
+                                  target_port=self.server.port,
+                                  pool=self.pool)
+        executor = RemoteExecutor('127.0.0.1', self.credentials,
+                                  port=self.server.port, pool=self.pool)
+        executor.run('true', sudo=False)
+
+        self.assertEqual(len(os.listdir(out)), 20)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_dead_and_idle_connections_are_replaced(self):
+        ssh = self.pool.get('127.0.0.1', self.credentials,
+                            port=self.server.port)
+        ssh.get_transport().close()
+        self.assertIsNot(self.pool.get('127.0.0.1', self.credentials,
+                                       port=self.server.port), ssh)
+
+        self.pool.idle_timeout = 0
+        self.pool.evict_idle()
+        self.assertEqual(len(self.pool), 0)
+        self.assertEqual(self.server.connections, 2)
+
+    def test_stat_remote_paths(self):
+        path = os.path.join(self.directory, 'a:b')
+        with open(path, 'w') as f:
+            f.write('12345')
+        missing = os.path.join(self.directory, 'missing')
+        ssh = self.pool.get('127.0.0.1', self.credentials,
+                            port=self.server.port)
+
+        results = stat_remote_paths(ssh, [path, self.directory, missing])
+        self.assertEqual(results[path], {'type': 'File', 'size': 5})
+        self.assertEqual(results[self.directory]['type'], 'Directory')
+        self.assertEqual(results[missing]['type'], 'DoesNotExist')
+        self.assertEqual(get_file_type(ssh, missing), 'DoesNotExist')
+
+    def test_stat_remote_paths_without_queuing(self):
+        missing = os.path.join(self.directory, 'missing')
+        ssh = self.pool.get('127.0.0.1', self.credentials,
+                            port=self.server.port)
+
+        can_queue_requests = fetch._can_queue_requests
+        fetch._can_queue_requests = lambda sftp: False
+        try:
+            results = stat_remote_paths(ssh, [self.directory, missing])
+        finally:
+            fetch._can_queue_requests = can_queue_requests
+        self.assertEqual(results[self.directory]['type'], 'Directory')
+        self.assertEqual(results[missing],
+                         {'type': 'DoesNotExist', 'size': None})
+
+
+def is_running(pid):
+    try:
+        with open('/proc/{0}/stat'.format(pid)) as f:
+            # Zombies have exited and only wait to be reaped
+            return f.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except IOError:
+        return False
+
+
+class RemoteExecutorTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        key_path = os.path.join(self.directory, 'key')
+        paramiko.RSAKey.generate(2048).write_private_key_file(key_path)
+        credentials = {'user': os.environ.get('USER', 'root'),
+                       'password': None,
+                       'ssh_key_path': key_path}
+        self.server = StandInSSHServer()
+        self.executor = RemoteExecutor('127.0.0.1', credentials,
+                                       port=self.server.port)
+
+    def tearDown(self):
+        self.executor.close()
+        self.server.close()
+        shutil.rmtree(self.directory)
+
+    def test_output_and_return_code(self):
+        tail = self.executor.run("echo out; echo 'err or' >&2", sudo=False)
+        self.assertEqual(sorted(tail), ['err or', 'out'])
+        with self.assertRaises(CommandError) as raised:
+            self.executor.run('exit 4', sudo=False)
+        self.assertEqual(raised.exception.returncode, 4)
+
+    @unittest.skipUnless(find_executable('pkill'), 'pkill is required')
+    def test_timeout_kills_remote_command(self):
+        pid_file = os.path.join(self.directory, 'pids')
+        cmd = 'sleep 60 & echo $! > {0}; echo $$ >> {0}; wait'.format(
+            pid_file)
+        start_time = time.time()
+        self.assertRaises(CommandTimeout, self.executor.run, cmd,
+                          sudo=False, timeout=1)
+        self.assertLess(time.time() - start_time, 10)
+        with open(pid_file) as f:
+            pids = [int(pid) for pid in f.read().split()]
+        self.assertEqual(len(pids), 2)
+        end_time = time.time() + 5
+        while any(is_running(pid) for pid in pids) and \
+                time.time() < end_time:
+            time.sleep(0.1)
+        self.assertEqual([pid for pid in pids if is_running(pid)], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+#! /usr/bin/env python2
+
+import functools
+import io
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import unittest
+
+import paramiko
+
+from .context import cvengine  # noqa: F401
+from .bench_ssh_transport import StandInSSHServer
+from cvengine.platform_handlers.base_platform_handler import \
+    BasePlatformHandler
+from cvengine.util.cache import DownloadCache
+from cvengine.util.fetch import SSHConnectionPool
+from cvengine.util.image import IMAGE_ID_STATUS, ImagePull, \
+    image_archive_url, image_pull_script, load_image_archive, pull_image, \
+    pullable
+from cvengine.util.remote import RemoteExecutor
+from cvengine.util.run import run_cmd
+
+
+DIGEST = 'sha256:' + 'a' * 64
+IMAGE_ID = 'sha256:' + 'b' * 64
+
+
+class ImagePullTest(unittest.TestCase):
+    def test_pullable(self):
+        self.assertTrue(pullable('registry.example.com/ns/image:1.0'))
+        self.assertTrue(pullable('fedora@' + DIGEST))
+        for image_url in ('https://example.com/image.tar', '/tmp/image.tar',
+                          'image.tar.gz', '', None):
+            self.assertFalse(pullable(image_url))
+        self.assertTrue(image_archive_url('https://example.com/image.tar'))
+        self.assertFalse(image_archive_url('/tmp/image.tar'))
+
+    def test_pull_runs_in_background(self):
+        release = threading.Event()
+        commands = []
+
+        def run_host_cmd(cmd):
+            commands.append(cmd)
+            release.wait(5)
+            return ['Digest: ' + DIGEST,
+                    'Status: Downloaded newer image for image:1.0',
+                    '{0} {1}'.format(IMAGE_ID_STATUS, IMAGE_ID)]
+
+        pull = ImagePull(functools.partial(pull_image, run_host_cmd),
+                         'image:1.0')
+        pull.start()
+        # start returns while the pull is still running
+        self.assertIsNone(pull.result)
+        release.set()
+        result = pull.wait()
+        self.assertEqual((result['status'], result['digest'],
+                          result['image_id']), ('pulled', DIGEST, IMAGE_ID))
+        self.assertEqual(commands, [image_pull_script('image:1.0')])
+
+    def test_failed_pull(self):
+        def pull(image_url):
+            raise Exception('manifest unknown')
+
+        image_pull = ImagePull(pull, 'image:missing')
+        image_pull.start()
+        result = image_pull.wait()
+        self.assertEqual((result['status'], result['error']),
+                         ('failed', 'manifest unknown'))
+        self.assertEqual(ImagePull(pull, 'image').wait()['status'],
+                         'skipped')
+
+    def test_cancel(self):
+        pull = ImagePull(lambda cmd: run_cmd('sleep 30'), 'image:1.0')
+        pull.start()
+        pull.cancel()
+        self.assertEqual(pull.result['status'], 'failed')
+        self.assertLess(pull.result['duration'], 10)
+
+    def test_playbooks_wait_for_image(self):
+        release = threading.Event()
+        ran = []
+
+        class Platform(BasePlatformHandler):
+            def run_playbook(self, path, extra_vars, extra_vars_file=None):
+                ran.append((path, extra_vars.get('image_pull_status')))
+
+        platform = Platform({'playbooks': []}, None, {}, {})
+        platform.image_pull = ImagePull(
+            lambda image_url: release.wait(5) and {'status': 'pulled'},
+            'image:1.0')
+        platform.image_pull.start()
+
+        # Playbooks that do not need the image start during the pull
+        platform.run_playbook_entry({'url': 'labels', 'local_path': 'labels',
+                                     'needs_image': False})
+        self.assertEqual(ran, [('labels', None)])
+        release.set()
+        platform.run_playbook_entry({'url': 'smoke', 'local_path': 'smoke'})
+        self.assertEqual(ran[1], ('smoke', 'pulled'))
+        shutil.rmtree(platform.host_data_out)
+
+
+class ImageArchiveTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        key_path = os.path.join(self.directory, 'key')
+        paramiko.RSAKey.generate(2048).write_private_key_file(key_path)
+        self.server = StandInSSHServer()
+        self.pool = SSHConnectionPool()
+        self.executor = RemoteExecutor(
+            '127.0.0.1', {'user': 'root', 'password': None,
+                          'ssh_key_path': key_path},
+            port=self.server.port, pool=self.pool)
+
+        # A docker stand-in that keeps the loaded archive and image ID
+        bin_directory = os.path.join(self.directory, 'bin')
+        os.mkdir(bin_directory)
+        self.loaded = os.path.join(self.directory, 'loaded')
+        with open(os.path.join(bin_directory, 'docker'), 'w') as f:
+            f.write('#!/bin/sh\n'
+                    'case "$1" in\n'
+                    'inspect) cat {0}.id 2>/dev/null ;;\n'
+                    'load) cat > {0}; echo {1} > {0}.id;'
+                    ' echo "Loaded image ID: {1}" ;;\n'
+                    'esac\n'.format(self.loaded, IMAGE_ID))
+        os.chmod(os.path.join(bin_directory, 'docker'), 0o755)
+        self.path = os.environ['PATH']
+        os.environ['PATH'] = bin_directory + os.pathsep + self.path
+
+        self.archive = os.path.join(self.directory, 'image.tar')
+        with tarfile.open(self.archive, 'w') as archive:
+            for name, data in (
+                    ('layer.tar', '\0' * 100000),
+                    ('manifest.json', json.dumps([{
+                        'Config': IMAGE_ID.split(':')[1] + '.json',
+                        'Layers': ['layer.tar']}]))):
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data))
+        self.cache = DownloadCache(os.path.join(self.directory, 'cache'))
+
+    def tearDown(self):
+        os.environ['PATH'] = self.path
+        self.pool.close()
+        self.server.close()
+        shutil.rmtree(self.directory)
+
+    def test_load_once(self):
+        url = 'file://' + self.archive
+        result = load_image_archive(self.executor, self.cache, url)
+        self.assertEqual((result['status'], result['image_id']),
+                         ('loaded', IMAGE_ID))
+        with open(self.archive, 'rb') as f, open(self.loaded, 'rb') as g:
+            self.assertEqual(f.read(), g.read())
+        # The archive is compressed on the way
+        self.assertLess(result['bytes'], os.path.getsize(self.archive))
+
+        result = load_image_archive(self.executor, self.cache, url)
+        self.assertEqual((result['status'], result['image_id'],
+                          result['bytes']), ('present', IMAGE_ID, 0))
+        self.assertEqual(self.server.connections, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
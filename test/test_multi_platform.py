@@ -0,0 +1,115 @@
+#! /usr/bin/env python2
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import yaml
+
+from .context import cvengine  # noqa: F401
+from cvengine import cvengine as engine
+from cvengine.cvengine import run_multi_platform_validation
+
+
+class MultiPlatformTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        metadata = {'Test': [], 'Artifacts': ['/var/log/messages']}
+        for host_type in ('fedora', 'atomic'):
+            playbook = os.path.join(self.directory, host_type + '.yml')
+            with open(playbook, 'w') as f:
+                f.write('- hosts: all\n')
+            metadata['Test'].append({'host_type': host_type,
+                                     'playbooks': [{'url': 'file://' +
+                                                    playbook}]})
+        path = os.path.join(self.directory, 'cvdata.yml')
+        with open(path, 'w') as f:
+            yaml.safe_dump(metadata, f)
+        self.cvdata_url = 'file://' + path
+        self.artifacts = os.path.join(self.directory, 'artifacts')
+        self.config = {'cache': {'directory':
+                                 os.path.join(self.directory, 'cache')},
+                       'target_host_platforms': ['fedora', 'atomic'],
+                       'environment': {'handler': 'preconfigured'},
+                       'environments': {'atomic': {'handler': 'openstack'}}}
+        self.calls = {}
+        self.failing = set()
+        self.lock = threading.Lock()
+        self.run_scenario = engine.run_scenario
+        engine.run_scenario = self.record_scenario
+
+    def tearDown(self):
+        engine.run_scenario = self.run_scenario
+        shutil.rmtree(self.directory)
+
+    def record_scenario(self, scenario, artifacts, environment_config,
+                        artifacts_directory, extra_variables, config=None,
+                        cancel_token=None, resume=False,
+                        keep_environment=False, playbook_download=None):
+        engine.wait_for_download(playbook_download)
+        host_type = scenario['host_type']
+        with self.lock:
+            self.calls[host_type] = {
+                'artifacts': artifacts,
+                'environment': environment_config,
+                'artifacts_directory': artifacts_directory,
+                'extra_variables': extra_variables,
+                'local_path': scenario['playbooks'][0]['local_path']}
+        if host_type in self.failing:
+            raise Exception('{0} validation failed'.format(host_type))
+
+    def read_results(self):
+        with open(os.path.join(self.artifacts, 'results.json')) as f:
+            return json.load(f)
+
+    def test_all_platforms_pass(self):
+        results = run_multi_platform_validation(
+            'image', self.cvdata_url, self.config, self.artifacts,
+            {'shared': 1})
+        self.assertEqual(sorted(results), ['atomic', 'fedora'])
+        self.assertEqual(self.read_results(), json.loads(json.dumps(results)))
+
+        for host_type in ('fedora', 'atomic'):
+            result = results[host_type]
+            self.assertEqual(result['status'], 'passed')
+            self.assertEqual(result['artifacts_directory'],
+                             os.path.join(self.artifacts, host_type))
+            call = self.calls[host_type]
+            self.assertEqual(call['artifacts_directory'],
+                             result['artifacts_directory'])
+            self.assertEqual(call['artifacts'], ['/var/log/messages'])
+            self.assertEqual(call['extra_variables'],
+                             {'shared': 1, 'image_url': 'image'})
+            self.assertTrue(os.path.isfile(call['local_path']))
+        self.assertEqual(self.calls['fedora']['environment'],
+                         {'handler': 'preconfigured'})
+        self.assertEqual(self.calls['atomic']['environment'],
+                         {'handler': 'openstack'})
+
+    def test_failed_platform(self):
+        self.failing.add('atomic')
+        with self.assertRaises(Exception) as raised:
+            run_multi_platform_validation('image', self.cvdata_url,
+                                          self.config, self.artifacts, {},
+                                          platforms=['fedora', 'atomic'])
+        self.assertIn('platforms: atomic', str(raised.exception))
+        results = self.read_results()
+        self.assertEqual(results['fedora']['status'], 'passed')
+        self.assertEqual(results['atomic']['status'], 'failed')
+        self.assertIn('atomic validation failed', results['atomic']['error'])
+        self.assertNotIn('error', results['fedora'])
+        self.assertTrue(os.path.isfile(
+            os.path.join(self.artifacts, 'cvengine_trace.json')))
+
+    def test_unknown_platform(self):
+        self.assertRaises(ValueError, run_multi_platform_validation,
+                          'image', self.cvdata_url, self.config,
+                          self.artifacts, {}, platforms=['openshift'])
+        self.assertEqual(self.calls, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,260 @@
+#! /usr/bin/env python2
+
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from StringIO import StringIO
+
+from .context import cvengine  # noqa: F401
+from cvengine.util import run
+from cvengine.util.run import CancelToken, Cancelled, CommandError, \
+    CommandTimeout, DeadlineExceeded, OutputRecorder, adopt_context, \
+    check_deadline, command_logs, current_context, phase, run_cmd, \
+    run_context, wait_for_result
+
+
+class RunCmdTest(unittest.TestCase):
+    def setUp(self):
+        self.previous_handler = signal.getsignal(signal.SIGALRM)
+
+    def tearDown(self):
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, self.previous_handler)
+
+    def cancel_on_alarm(self, token, delay):
+        signal.signal(signal.SIGALRM,
+                      lambda signum, frame: token.cancel('signal'))
+        signal.setitimer(signal.ITIMER_REAL, delay)
+
+    def test_cancel_from_another_thread(self):
+        token = CancelToken()
+        threading.Timer(0.5, token.cancel).start()
+        start_time = time.time()
+        with run_context(token):
+            self.assertRaises(Cancelled, run_cmd, 'sleep 10')
+        self.assertLess(time.time() - start_time, 5)
+
+    def test_cancel_from_signal_handler(self):
+        token = CancelToken()
+        self.cancel_on_alarm(token, 0.5)
+        with run_context(token):
+            self.assertRaises(Cancelled, run_cmd, 'sleep 10')
+
+    def test_interrupted_command_continues(self):
+        signal.signal(signal.SIGALRM, lambda signum, frame: None)
+        signal.setitimer(signal.ITIMER_REAL, 0.2, 0.2)
+        self.assertEqual(run_cmd('sleep 1; echo done'), ['done'])
+
+    def test_deadlines(self):
+        start_time = time.time()
+        with phase(0.5):
+            # Commands are killed once the deadline of the phase passes
+            self.assertRaises(CommandTimeout, run_cmd, 'sleep 10')
+            self.assertRaises(DeadlineExceeded, check_deadline)
+        self.assertRaises(CommandTimeout, run_cmd, 'sleep 10', timeout=0.5)
+        self.assertLess(time.time() - start_time, 5)
+
+    @unittest.skipUnless(os.path.isdir('/proc'), '/proc is required')
+    def test_timeout_kills_process_group(self):
+        try:
+            run_cmd('sleep 30 & echo $!; wait', timeout=1)
+        except CommandTimeout as e:
+            child = int(e.tail[0])
+        # The background child was killed along with the shell. Without an
+        # init reaping orphans it may be left as a zombie.
+        time.sleep(0.5)
+        try:
+            with open('/proc/{0}/stat'.format(child)) as f:
+                state = f.read().rsplit(')', 1)[1].split()[0]
+        except IOError:
+            state = None
+        self.assertIn(state, (None, 'Z'))
+
+    def test_cancel_while_waiting_for_pool(self):
+        token = CancelToken()
+        self.cancel_on_alarm(token, 0.5)
+        pool = ThreadPool(2)
+        start_time = time.time()
+        try:
+            with run_context(token):
+                context = current_context()
+
+                def work(seconds):
+                    with adopt_context(context):
+                        run_cmd('sleep {0}'.format(seconds))
+
+                self.assertRaises(Cancelled, wait_for_result,
+                                  pool.map_async(work, [6, 6]))
+        finally:
+            pool.close()
+            pool.join()
+        self.assertLess(time.time() - start_time, 5)
+
+
+class OutputRecorderTest(unittest.TestCase):
+    def test_lines_split_across_chunks(self):
+        echo = {'stdout': StringIO(), 'stderr': StringIO()}
+        log_file = StringIO()
+        tail = deque(maxlen=2)
+        recorder = OutputRecorder(log_file, tail, echo=echo)
+        recorder.feed('stdout', 'fir')
+        recorder.feed('stderr', 'oops\r\n')
+        recorder.feed('stdout', 'st\nsecond\nthi')
+        recorder.close('stdout')
+        recorder.close('stderr')
+
+        self.assertEqual(echo['stdout'].getvalue(), 'first\nsecond\nthi\n')
+        self.assertEqual(echo['stderr'].getvalue(), 'oops\n')
+        self.assertEqual(list(tail), ['second', 'thi'])
+        logged = [line.split(' ', 1)[1]
+                  for line in log_file.getvalue().splitlines()]
+        self.assertEqual(logged, ['stderr oops', 'stdout first',
+                                  'stdout second', 'stdout thi'])
+
+
+class RunCmdOutputTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_tail(self):
+        tail = run_cmd('seq 1 500', tail_lines=10)
+        self.assertEqual(tail, [str(n) for n in range(491, 501)])
+
+    def test_command_log(self):
+        with command_logs(self.directory):
+            tail = run_cmd('echo out; echo err >&2; echo done')
+        self.assertEqual(sorted(tail), ['done', 'err', 'out'])
+        logs = os.listdir(self.directory)
+        self.assertEqual(len(logs), 1)
+        self.assertTrue(logs[0].endswith('-echo.log'))
+        with open(os.path.join(self.directory, logs[0])) as f:
+            logged = sorted(line.split(' ', 1)[1] for line in f)
+        self.assertEqual(logged, ['stderr err\n', 'stdout done\n',
+                                  'stdout out\n'])
+
+    def test_failure_keeps_stderr(self):
+        log_path = os.path.join(self.directory, 'fail.log')
+        with self.assertRaises(CommandError) as raised:
+            run_cmd('echo broken >&2; exit 3', log_path=log_path)
+        self.assertEqual(raised.exception.returncode, 3)
+        self.assertEqual(raised.exception.tail, ['broken'])
+        self.assertEqual(raised.exception.log_path, log_path)
+        with open(log_path) as f:
+            self.assertIn(' stderr broken', f.read())
+
+
+class BannerServer(object):
+    """Accepts TCP connections and greets them with a banner"""
+    def __init__(self, banner):
+        self.banner = banner
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.port = self.sock.getsockname()[1]
+        thread = threading.Thread(target=self.serve)
+        thread.daemon = True
+        thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                connection = self.sock.accept()[0]
+            except socket.error:
+                return
+            connection.sendall(self.banner)
+            connection.close()
+
+    def close(self):
+        # Wakes up the accept of the serving thread
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+
+
+class FakeSSH(object):
+    """A connection whose cloud-init check fails until it is marked done"""
+    def __init__(self, outcomes):
+        self.outcomes = outcomes
+        self.closed = False
+
+    def exec_command(self, cmd):
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        channel = type('Channel', (), {
+            'recv_exit_status': lambda self: 0 if outcome else 1})()
+        stdout = type('Stdout', (), {'channel': channel})()
+        return None, stdout, None
+
+    def close(self):
+        self.closed = True
+
+
+class WaitForSSHTest(unittest.TestCase):
+    def setUp(self):
+        self.server = BannerServer('SSH-2.0-test\r\n')
+        self.connections = []
+        self.outcomes = []
+        self.setup_ssh_connection = run.setup_ssh_connection
+        run.setup_ssh_connection = self.connect
+
+    def tearDown(self):
+        run.setup_ssh_connection = self.setup_ssh_connection
+        self.server.close()
+
+    def connect(self, host, creds, port=22, timeout=None):
+        ssh = FakeSSH(self.outcomes.pop(0))
+        self.connections.append(ssh)
+        return ssh
+
+    def test_backoff_delays(self):
+        delays = run.backoff_delays(1, 4)
+        for low, high in ((0.5, 1), (1, 2), (2, 4), (2, 4)):
+            delay = next(delays)
+            self.assertTrue(low <= delay <= high, delay)
+
+    def test_probe_ssh_port(self):
+        run.probe_ssh_port('127.0.0.1', self.server.port, 5)
+        other = BannerServer('HTTP/1.1 400\r\n')
+        try:
+            self.assertRaises(IOError, run.probe_ssh_port, '127.0.0.1',
+                              other.port, 5)
+        finally:
+            other.close()
+        self.server.close()
+        self.assertRaises(socket.error, run.probe_ssh_port, '127.0.0.1',
+                          self.server.port, 5)
+
+    def test_reconnects_after_dropped_session(self):
+        # The first session drops while cloud-init reboots the host
+        self.outcomes = [[False, EOFError('session dropped')], [True]]
+        ssh = run.wait_for_ssh('127.0.0.1', 'root', 'secret', wait_time=20,
+                               sleep_interval=0.1, port=self.server.port,
+                               wait_for_cloud_init=True)
+        self.assertIs(ssh, self.connections[1])
+        self.assertTrue(self.connections[0].closed)
+        self.assertFalse(ssh.closed)
+
+    def test_gives_up(self):
+        self.outcomes = [[False] * 100]
+        self.assertRaises(Exception, run.wait_for_ssh, '127.0.0.1', 'root',
+                          'secret', wait_time=0.5, sleep_interval=0.1,
+                          port=self.server.port, wait_for_cloud_init=True)
+        self.assertTrue(self.connections[0].closed)
+
+
+if __name__ == '__main__':
+    unittest.main()
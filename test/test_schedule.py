@@ -0,0 +1,109 @@
+#! /usr/bin/env python2
+
+import threading
+import time
+import unittest
+
+from .context import cvengine  # noqa: F401
+from cvengine.util import run
+from cvengine.util.schedule import PlaybookGraph
+
+
+URL = 'https://example.com/{0}.yml'
+
+
+def playbooks(*entries):
+    return [dict(entry, url=entry.get('url', URL.format(entry.get('name'))))
+            for entry in entries]
+
+
+class PlaybookGraphTest(unittest.TestCase):
+    def test_dependencies(self):
+        graph = PlaybookGraph(playbooks(
+            {'name': 'setup'},
+            {'name': 'scan', 'parallel': 'checks'},
+            {'name': 'smoke', 'parallel': 'checks'},
+            {'name': 'labels', 'depends_on': []},
+            {'name': 'report'},
+            {'url': URL.format('report')},
+            {'url': URL.format('report')}))
+        self.assertEqual(graph.dependencies, {
+            'setup': [],
+            'scan': ['setup'],
+            'smoke': ['setup'],
+            'labels': [],
+            'report': ['scan', 'smoke'],
+            URL.format('report'): ['report'],
+            URL.format('report') + '#2': [URL.format('report')]})
+
+        self.assertRaises(ValueError, PlaybookGraph, playbooks(
+            {'name': 'a', 'depends_on': ['b']},
+            {'name': 'b', 'depends_on': ['a']}))
+        self.assertRaises(ValueError, PlaybookGraph, playbooks(
+            {'name': 'a', 'depends_on': ['missing']}))
+        self.assertRaises(ValueError, PlaybookGraph, playbooks(
+            {'name': 'a'}, {'name': 'a'}))
+
+    def test_run(self):
+        graph = PlaybookGraph(playbooks(
+            {'name': 'setup'},
+            {'name': 'scan', 'parallel': 'checks'},
+            {'name': 'smoke', 'parallel': 'checks'},
+            {'name': 'report'}))
+        both_running = threading.Event()
+        running = set()
+        lock = threading.Lock()
+
+        def run_playbook(playbook):
+            with lock:
+                running.add(playbook['name'])
+                if running >= set(['scan', 'smoke']):
+                    both_running.set()
+            # The checks only finish once they ran at the same time
+            if playbook['name'] in ('scan', 'smoke'):
+                both_running.wait(5)
+            if playbook['name'] == 'smoke':
+                time.sleep(0.2)
+            with lock:
+                running.discard(playbook['name'])
+
+        results = graph.run(run_playbook, concurrency=2)
+        self.assertTrue(both_running.is_set())
+        self.assertEqual(set(r['status'] for r in results.values()),
+                         set(['passed']))
+        self.assertLessEqual(max(results['scan']['end'],
+                                 results['smoke']['end']),
+                             results['report']['start'])
+        self.assertEqual(graph.critical_path(results)[0],
+                         ['setup', 'smoke', 'report'])
+
+    def test_failure_stops_dependents(self):
+        graph = PlaybookGraph(playbooks(
+            {'name': 'a'}, {'name': 'b'},
+            {'name': 'side', 'depends_on': []}))
+
+        def run_playbook(playbook):
+            if playbook['name'] == 'a':
+                raise Exception('failed')
+
+        results = graph.run(run_playbook, concurrency=1)
+        self.assertEqual(results['a']['status'], 'failed')
+        self.assertEqual(results['b']['status'], 'not_run')
+        self.assertEqual(str(results['a']['error']), 'failed')
+
+    def test_cancel_stops_pending(self):
+        graph = PlaybookGraph(playbooks({'name': 'a'}, {'name': 'b'}))
+        token = run.CancelToken()
+        ran = []
+
+        def run_playbook(playbook):
+            ran.append(playbook['name'])
+            token.cancel('stop')
+
+        with run.run_context(cancel_token=token):
+            self.assertRaises(run.Cancelled, graph.run, run_playbook)
+        self.assertEqual(ran, ['a'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+#! /usr/bin/env python2
+
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+from .context import cvengine  # noqa: F401
+
+
+# Importing cvengine must stay cheap, since it is paid by every job. The
+# budget can be raised on slow machines with CV_IMPORT_TIME_BUDGET.
+IMPORT_TIME_BUDGET = float(os.environ.get('CV_IMPORT_TIME_BUDGET', '1.0'))
+# Handler modules the registries import on first use. The openstack
+# environment pulls in the openstack clients.
+LAZY_MODULES = ('cvengine.environment_handlers.openstack_environment',
+                'cvengine.environment_handlers.preconfigured_environment',
+                'cvengine.platform_handlers.atomic_host_handler',
+                'cvengine.platform_handlers.fedora_handler')
+IMPORT_SCRIPT = '''
+import json
+import sys
+import time
+start = time.time()
+import cvengine
+elapsed = time.time() - start
+print(json.dumps({'elapsed': elapsed, 'modules': list(sys.modules)}))
+'''
+
+
+class StartupTest(unittest.TestCase):
+    def import_cvengine(self):
+        root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+        output = subprocess.check_output([sys.executable, '-c',
+                                          IMPORT_SCRIPT], cwd=root)
+        return json.loads(output.strip().splitlines()[-1])
+
+    def test_import_time_budget(self):
+        # Take the best of a few runs to smooth out noise from a cold cache
+        elapsed = min(self.import_cvengine()['elapsed'] for _ in range(3))
+        self.assertLess(elapsed, IMPORT_TIME_BUDGET)
+
+    def test_handlers_are_imported_lazily(self):
+        modules = self.import_cvengine()['modules']
+        for name in LAZY_MODULES:
+            self.assertNotIn(name, modules)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+#! /usr/bin/env python2
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from distutils.spawn import find_executable
+
+import paramiko
+
+from .context import cvengine  # noqa: F401
+from .bench_ssh_transport import StandInSSHServer
+from cvengine.util.fetch import SSHConnectionPool
+from cvengine.util import sync
+from cvengine.util.sync import PARTIAL_SUFFIX, RESUME_THRESHOLD, \
+    SYNC_MANIFEST_SUFFIX, sync_remote_artifact
+
+
+@unittest.skipUnless(find_executable('sha256sum') and find_executable('tar'),
+                     'sha256sum and tar are required')
+class SyncTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        key_path = os.path.join(self.directory, 'key')
+        paramiko.RSAKey.generate(2048).write_private_key_file(key_path)
+        credentials = {'user': os.environ.get('USER', 'root'),
+                       'password': None,
+                       'ssh_key_path': key_path}
+        self.server = StandInSSHServer()
+        self.pool = SSHConnectionPool()
+        self.ssh = self.pool.get('127.0.0.1', credentials,
+                                 port=self.server.port)
+
+        self.remote = os.path.join(self.directory, 'remote', 'logs')
+        os.makedirs(os.path.join(self.remote, 'journal'))
+        self.write('a.log', 'a' * 100)
+        self.write('journal/b.log', 'b' * 100)
+        self.core = os.urandom(RESUME_THRESHOLD * 2)
+        self.write('core', self.core)
+        self.artifacts = os.path.join(self.directory, 'artifacts')
+        self.local = os.path.join(self.artifacts, 'logs')
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.close()
+        shutil.rmtree(self.directory)
+
+    def write(self, name, data):
+        with open(os.path.join(self.remote, name), 'wb') as f:
+            f.write(data)
+
+    def sync(self):
+        return sync_remote_artifact(self.ssh, self.remote, self.artifacts)
+
+    def test_only_changes_are_transferred(self):
+        stats = self.sync()
+        self.assertEqual((stats['files'], stats['transferred']), (3, 3))
+        with open(os.path.join(self.local, 'core'), 'rb') as f:
+            self.assertEqual(f.read(), self.core)
+        self.assertTrue(os.path.isfile(self.local + SYNC_MANIFEST_SUFFIX))
+
+        stats = self.sync()
+        self.assertEqual((stats['skipped'], stats['bytes']), (3, 0))
+
+        self.write('a.log', 'changed')
+        self.write('journal/c.log', 'c' * 100)
+        stats = self.sync()
+        self.assertEqual((stats['files'], stats['transferred']), (4, 2))
+        with open(os.path.join(self.local, 'a.log')) as f:
+            self.assertEqual(f.read(), 'changed')
+
+    def test_interrupted_transfer_is_resumed(self):
+        self.sync()
+        self.core = os.urandom(RESUME_THRESHOLD * 3)
+        self.write('core', self.core)
+        # The state after a connection drop half way through the new file
+        local_core = os.path.join(self.local, 'core')
+        os.remove(local_core)
+        with open(local_core + PARTIAL_SUFFIX, 'wb') as f:
+            f.write(self.core[:RESUME_THRESHOLD])
+
+        stats = self.sync()
+        self.assertEqual(stats['resumed'], 1)
+        self.assertEqual(stats['bytes'], RESUME_THRESHOLD * 2)
+        with open(local_core, 'rb') as f:
+            self.assertEqual(f.read(), self.core)
+        self.assertFalse(os.path.exists(local_core + PARTIAL_SUFFIX))
+
+    def test_changed_small_file_is_rejected(self):
+        remote_hashes = sync.remote_hashes
+
+        def stale_hashes(ssh_connection, remote_path, names):
+            # As if a.log was written to after it was hashed
+            hashes = remote_hashes(ssh_connection, remote_path, names)
+            hashes['a.log'] = '0' * 64
+            return hashes
+
+        sync.remote_hashes = stale_hashes
+        try:
+            self.assertRaises(Exception, self.sync)
+        finally:
+            sync.remote_hashes = remote_hashes
+        self.assertFalse(os.path.exists(os.path.join(self.local, 'a.log')))
+        self.assertTrue(os.path.isfile(
+            os.path.join(self.local, 'journal', 'b.log')))
+
+        stats = self.sync()
+        self.assertEqual((stats['skipped'], stats['transferred']), (1, 2))
+        with open(os.path.join(self.local, 'a.log')) as f:
+            self.assertEqual(f.read(), 'a' * 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+#! /usr/bin/env python2
+
+import json
+import os
+import shutil
+import stat
+import tempfile
+import time
+import unittest
+
+from .context import cvengine  # noqa: F401
+from cvengine.util.toolchain import TOOLCHAIN_FILE_NAME, probe_tool, \
+    probe_toolchain, write_toolchain
+
+
+FAKE_TOOL = '''#!/bin/sh
+echo call >> "{calls}"
+echo "cvfake version {version}"
+echo "build details"
+'''
+
+
+class ToolchainTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.bin = os.path.join(self.directory, 'bin')
+        os.makedirs(self.bin)
+        self.cache = os.path.join(self.directory, 'cache')
+        self.calls = os.path.join(self.directory, 'calls')
+        self.previous_path = os.environ['PATH']
+        os.environ['PATH'] = self.bin + os.pathsep + self.previous_path
+        self.tool = self.write_tool('cvfake', FAKE_TOOL.format(
+            calls=self.calls, version='1.0'))
+
+    def tearDown(self):
+        os.environ['PATH'] = self.previous_path
+        shutil.rmtree(self.directory)
+
+    def write_tool(self, name, script):
+        path = os.path.join(self.bin, name)
+        with open(path, 'w') as f:
+            f.write(script)
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+        return path
+
+    def probe_count(self):
+        if not os.path.exists(self.calls):
+            return 0
+        with open(self.calls) as f:
+            return len(f.readlines())
+
+    def probe(self):
+        return probe_toolchain(tools={'cvfake': ['--version'],
+                                      'cvmissing': ['--version']},
+                               cache_directory=self.cache)
+
+    def test_record_is_keyed_on_path_and_mtime(self):
+        toolchain = self.probe()
+        self.assertEqual(self.probe_count(), 1)
+        tool = toolchain['cvfake']
+        self.assertEqual(tool['path'], self.tool)
+        self.assertEqual(tool['version'], 'cvfake version 1.0')
+        self.assertEqual(tool['version_output'],
+                         'cvfake version 1.0\nbuild details')
+        self.assertEqual(toolchain['cvmissing'],
+                         {'path': None, 'version': None,
+                          'version_output': None, 'mtime': None})
+        with open(os.path.join(self.cache, TOOLCHAIN_FILE_NAME)) as f:
+            self.assertEqual(json.load(f), toolchain)
+
+        # Unchanged tools are not run again
+        self.assertEqual(self.probe(), toolchain)
+        self.assertEqual(self.probe_count(), 1)
+
+        # An upgrade in place changes the modification time
+        self.write_tool('cvfake', FAKE_TOOL.format(calls=self.calls,
+                                                   version='2.0'))
+        later = time.time() + 10
+        os.utime(self.tool, (later, later))
+        self.assertEqual(self.probe()['cvfake']['version'],
+                         'cvfake version 2.0')
+        self.assertEqual(self.probe_count(), 2)
+
+    def test_probe_timeout(self):
+        path = self.write_tool('cvslow', '#!/bin/sh\nsleep 10\n')
+        start_time = time.time()
+        info = probe_tool(path, ['--version'], timeout=0.5)
+        self.assertLess(time.time() - start_time, 5)
+        self.assertEqual(info, {'path': path, 'version': None,
+                                'version_output': None})
+
+    def test_failing_tool(self):
+        path = self.write_tool('cvbroken', '#!/bin/sh\nexit 1\n')
+        self.assertIsNone(probe_tool(path, ['--version'])['version'])
+
+    def test_write_toolchain(self):
+        directory = os.path.join(self.directory, 'artifacts', 'run')
+        toolchain = {'cvfake': {'path': self.tool, 'version': '1.0'}}
+        write_toolchain(toolchain, directory)
+        write_toolchain(toolchain, directory)
+        self.assertEqual(os.listdir(directory), [TOOLCHAIN_FILE_NAME])
+        with open(os.path.join(directory, TOOLCHAIN_FILE_NAME)) as f:
+            self.assertEqual(json.load(f), toolchain)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+#! /usr/bin/env python2
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from .context import cvengine  # noqa: F401
+from cvengine.util import trace
+
+
+class TraceTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'out', trace.TRACE_FILE_NAME)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read_events(self):
+        with open(self.path) as f:
+            document = json.load(f)
+        self.assertEqual(document['displayTimeUnit'], 'ms')
+        return dict((event['name'], event)
+                    for event in document['traceEvents'])
+
+    def test_nested_spans_across_threads(self):
+        def worker(tracer, parent, name):
+            with trace.activate(tracer, parent=parent):
+                with trace.span(name, worker=True) as span:
+                    span.set('done', 1)
+                    with trace.span(name + '.step'):
+                        pass
+
+        with trace.recording(self.path) as tracer:
+            with trace.span('run', scenario='x') as run_span:
+                threads = [threading.Thread(target=worker,
+                                            args=(tracer, run_span, name))
+                           for name in ('platform.a', 'platform.b')]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                with trace.span('local'):
+                    pass
+        self.assertIsNone(trace.current_tracer())
+
+        events = self.read_events()
+        self.assertEqual(sorted(events),
+                         ['local', 'platform.a', 'platform.a.step',
+                          'platform.b', 'platform.b.step', 'run'])
+        run = events['run']
+        self.assertEqual(run['ph'], 'X')
+        self.assertIsNone(run['args']['parent_id'])
+        self.assertEqual(run['args']['scenario'], 'x')
+        run_id = run['args']['span_id']
+        for name in ('local', 'platform.a', 'platform.b'):
+            self.assertEqual(events[name]['args']['parent_id'], run_id)
+        for name in ('platform.a', 'platform.b'):
+            event = events[name]
+            step = events[name + '.step']
+            self.assertEqual(step['args']['parent_id'],
+                             event['args']['span_id'])
+            self.assertEqual(step['tid'], event['tid'])
+            self.assertNotEqual(event['tid'], run['tid'])
+            self.assertEqual(event['args']['done'], 1)
+            self.assertGreaterEqual(event['ts'], run['ts'])
+            # Allow for the rounding of both to whole microseconds
+            self.assertLessEqual(event['ts'] + event['dur'],
+                                 run['ts'] + run['dur'] + 1)
+
+    def test_error_is_recorded_and_trace_written(self):
+        with self.assertRaises(ValueError):
+            with trace.recording(self.path):
+                with trace.span('failing'):
+                    raise ValueError('broken')
+        events = self.read_events()
+        self.assertEqual(events['failing']['args']['error'],
+                         'ValueError: broken')
+
+    def test_no_active_tracer(self):
+        with trace.span('ignored') as span:
+            span.set('key', 'value')
+        self.assertIsNone(trace.current_tracer())
+
+
+if __name__ == '__main__':
+    unittest.main()